@@ -0,0 +1,158 @@
+"""/analyze: a multi-PV search that deepens in a worker process while one
+message shows the best lines found so far.
+
+Every depth is its own engine.analyse call on a dedicated worker, so game
+moves never wait behind an analysis, the worker's transposition table carries
+over from one depth to the next, and stopping an analysis means not asking
+for the next depth and telling the worker, through a shared value, to drop
+the depth it is searching. The message is edited at most every EDIT_INTERVAL
+seconds, through the outbox which merges edits still waiting for the rate
+limit. The deepest lines of each position are kept in an LRU cache by
+position key, so asking again shows them at once and carries on from there.
+"""
+import asyncio
+import itertools
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import disnake
+
+import shitty_chessgamelogic as chess
+import engine
+import metrics
+import sessions
+
+BUDGET = 30.0 # seconds of search per analysis
+MAXDEPTH = 20
+LINES = 3
+EDIT_INTERVAL = 2.0 # seconds between edits of the message
+CACHE_SIZE = 1024 # positions
+
+def initworker(stop):
+    metrics.disable()
+    engine.STOP = stop
+
+stopping = multiprocessing.RawValue('q', 0) # job whose search the worker gives up, so a stopped analysis does not hold up the next ones
+jobs = itertools.count(1)
+analysis_pool = ProcessPoolExecutor(max_workers = 1, initializer = initworker, initargs = (stopping,))
+cache = collections.OrderedDict() # position key: SearchResults of the deepest analysis
+running = {} # user id: their Analysis
+
+
+def lookup(key, lines):
+    results = cache.get(key)
+    if results is None or len(results) < lines:
+        return []
+    cache.move_to_end(key)
+    return results[:lines]
+
+def remember(key, results):
+    previous = cache.get(key)
+    if previous and (previous[0].depth > results[0].depth or (previous[0].depth == results[0].depth and len(previous) > len(results))):
+        return
+    cache[key] = results
+    cache.move_to_end(key)
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last = False)
+
+def score(result, turn):
+    """White's point of view: +0.35, or #3 / #-3 for mates."""
+    value = result.score * turn
+    if abs(result.score) > engine.MATE // 2:
+        return ('#' if value > 0 else '#-') + str((engine.MATE - abs(result.score) + 1) // 2)
+    return '{:+.2f}'.format(value / 100)
+
+def numbered(pv, turn, fullmove):
+    parts = []
+    for i, san in enumerate(pv):
+        if turn == 1:
+            parts.append('{}. {}'.format(fullmove, san))
+        else:
+            parts.append('{}... {}'.format(fullmove, san) if i == 0 else san)
+            fullmove += 1
+        turn = -turn
+    return ' '.join(parts)
+
+
+class Analysis:
+    def __init__(self, moves, lines = LINES, budget = BUDGET):
+        """moves leading to the position, raises the chess exceptions if they do not replay."""
+        game = chess.Game('bitboard')
+        for move in moves:
+            game.all_moves()
+            game.playturn(move)
+        self.moves = list(moves)
+        self.key = game.position_key
+        self.turn = game.turn
+        self.fullmove = game.fullmove
+        game.all_moves()
+        self.over = not game.legal_moves() # mate or stalemate, nothing to search
+        self.lines = lines
+        self.budget = budget
+        self.results = lookup(self.key, lines)
+        self.user = None
+        self.task = None
+
+    def describe(self, done = False):
+        side = 'White' if self.turn == 1 else 'Black'
+        if not self.results:
+            if not done:
+                return 'Analysing the position after move {} ({} to play)...'.format(len(self.moves), side)
+            return 'Nothing to analyse, the game is over.' if self.over else 'Analysis stopped before the first depth was searched.'
+        header = 'Depth {}, {} to play{}'.format(self.results[0].depth, side, '' if done else ', searching...')
+        return '\n'.join([header] + ['**{}** {}'.format(score(result, self.turn), numbered(result.pv, self.turn, self.fullmove)) for result in self.results])
+
+    def start(self, user, message):
+        """Runs the analysis, editing message, and stops the previous one of user."""
+        previous = running.get(user)
+        if previous is not None:
+            previous.stop()
+        self.user = user
+        running[user] = self
+        self.task = asyncio.get_running_loop().create_task(self.run(message))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self, message):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.budget
+        edited = loop.time()
+        depth = self.results[0].depth if self.results else 0
+        job = 0
+        try:
+            while depth < MAXDEPTH and not (self.results and abs(self.results[0].score) > engine.MATE // 2):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                job = next(jobs)
+                found = await loop.run_in_executor(analysis_pool, engine.analyse, self.moves, depth + 1, self.lines, remaining, None, job)
+                if not found: # out of time, or no legal moves
+                    break
+                depth += 1
+                self.results = found
+                remember(self.key, found)
+                if loop.time() - edited >= EDIT_INTERVAL:
+                    edited = loop.time()
+                    sessions.outgoing.edit(message, content = self.describe())
+        finally:
+            stopping.value = job # nothing to stop if it is done, job numbers are not reused
+            if running.get(self.user) is self:
+                del running[self.user]
+            sessions.outgoing.edit(message, content = self.describe(done = True), view = None)
+
+
+class StopView(disnake.ui.View):
+    def __init__(self, analysis):
+        super().__init__(timeout = BUDGET + 30)
+        self.analysis = analysis
+
+    @disnake.ui.button(label = "Stop", style = disnake.ButtonStyle.grey)
+    async def stop_analysis(self, button: disnake.ui.Button, interaction: disnake.MessageInteraction):
+        if interaction.user.id != self.analysis.user:
+            await interaction.response.send_message("Only who asked for this analysis can stop it.", ephemeral = True)
+            return
+        self.analysis.stop()
+        await interaction.response.defer()
@@ -0,0 +1,310 @@
+"""Finished games, archived with an index of every position they went through.
+
+Each game is kept as PGN text, for people and other programs, and as a move
+list of two bytes per ply in the Polyglot move encoding. Every position of
+every game is a row of archive_positions keyed by its Polyglot hash, holding
+the guild, the move played next and the result, so these are range scans of
+one index instead of replays of the archive. The moves played in the first
+OPENING_PLIES plies are also counted by position in archive_openings, so the
+statistics of the start position do not scan a row per archived game.
+
+    await archive.games(guild_id, key)       # (count, newest games that reached the position)
+    await archive.openings(guild_id, key)    # the moves played from it and how they scored
+    await archive.player(guild_id, player)   # a player's results as white and as black
+
+    python archive.py --export games.pgn     # every archived game as one PGN file
+    python archive.py --benchmark 100000     # query latency with that many games archived
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import struct
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import textwrap
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import shitty_chessgamelogic as chess
+import polyglot
+
+BUSY_TIMEOUT = 30.0 # seconds to wait for another process's write
+OPENING_PLIES = 24 # plies of each game counted in archive_openings
+RESULTS = {1: '1-0', -1: '0-1', 0: '1/2-1/2'}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archive (
+    game INTEGER PRIMARY KEY, -- the game thread
+    guild INTEGER, result INTEGER, plies INTEGER, finished REAL,
+    pgn TEXT,
+    moves BLOB -- big-endian Polyglot moves, 2 bytes per ply
+);
+CREATE TABLE IF NOT EXISTS archive_positions (
+    key INTEGER, -- Polyglot hash as a signed 64-bit integer
+    guild INTEGER, game INTEGER, ply INTEGER,
+    next INTEGER, -- Polyglot move played in the position, NULL at the end of the game
+    result INTEGER,
+    PRIMARY KEY (key, guild, game, ply)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS archive_openings (
+    key INTEGER, guild INTEGER, next INTEGER,
+    games INTEGER, white INTEGER, draws INTEGER, black INTEGER,
+    PRIMARY KEY (key, guild, next)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS archive_players (
+    guild INTEGER, player INTEGER, game INTEGER,
+    color INTEGER, moves INTEGER, result INTEGER,
+    PRIMARY KEY (guild, player, game)
+) WITHOUT ROWID;
+'''
+
+ArchivedGame = collections.namedtuple('ArchivedGame', 'game guild result plies finished pgn moves positions players')
+
+
+def signed(key):
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+def pack(moves):
+    return struct.pack('>{}H'.format(len(moves)), *moves)
+
+def unpack(data):
+    return [polyglot.decode(move) for move in struct.unpack('>{}H'.format(len(data) // 2), data)]
+
+def pgn(headers, sans, result):
+    """PGN text of a game, the movetext wrapped at 80 columns."""
+    tags = ['[{} "{}"]'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in headers.items()]
+    tokens = []
+    for ply, san in enumerate(sans):
+        if ply % 2 == 0:
+            tokens.append('{}.'.format(ply // 2 + 1))
+        tokens.append(san)
+    tokens.append(RESULTS.get(result, '*'))
+    return '\n'.join(tags) + '\n\n' + textwrap.fill(' '.join(tokens), 79, break_long_words = False, break_on_hyphens = False) + '\n'
+
+def entry(game, guild, board, result, players, engine_color = None, finished = None):
+    """ArchivedGame of the finished chess.Game board, played in thread game.
+    players maps member ids to (color, moves played) like Session.players."""
+    finished = finished or time.time()
+    played = board.played()
+    moves = [polyglot.encode(move) for _, move in played]
+    positions = [(key, ply, move) for ply, ((key, _), move) in enumerate(zip(played, moves))]
+    positions.append((board.position_key, len(played), None))
+
+    def side(color):
+        if engine_color == color:
+            return 'chessbot engine'
+        return ', '.join(str(player) for player, (team, _) in players.items() if team == color) or '?'
+    headers = {'Event': 'chessbot game', 'Site': 'Discord', 'Date': time.strftime('%Y.%m.%d', time.gmtime(finished)), 'Round': '-',
+               'White': side(1), 'Black': side(-1), 'Result': RESULTS.get(result, '*'), 'Guild': guild, 'Thread': game}
+    if board.game_status:
+        headers['Termination'] = re.sub(r'[>*`]', '', board.game_status).strip()
+    return ArchivedGame(game, guild, result, len(played), finished, pgn(headers, board.history, result), pack(moves), positions, dict(players))
+
+def position(moves):
+    """chess.Game after the SAN moves, raises the chess exceptions if they do not replay."""
+    board = chess.Game('bitboard')
+    for move in moves:
+        board.all_moves()
+        board.playturn(move)
+    return board
+
+
+class Archive:
+    def __init__(self, path = 'chessbot.sqlite3'):
+        self.connection = sqlite3.connect(path, timeout = BUSY_TIMEOUT, check_same_thread = False, isolation_level = None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.executor = ThreadPoolExecutor(max_workers = 1)
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def record(self, game, guild, board, result, players, engine_color = None):
+        try:
+            await self.run(self.insert, [entry(game, guild, board, result, players, engine_color)])
+        except sqlite3.Error as e:
+            print('Could not archive game', game, e)
+
+    def insert(self, entries):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for game in entries:
+                # a game finished again after a restart is only archived once
+                if connection.execute('INSERT OR IGNORE INTO archive VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                      (game.game, game.guild, game.result, game.plies, game.finished, game.pgn, game.moves)).rowcount:
+                    connection.executemany('INSERT OR IGNORE INTO archive_positions VALUES (?, ?, ?, ?, ?, ?)',
+                                           [(signed(key), game.guild, game.game, ply, move, game.result) for key, ply, move in game.positions])
+                    connection.executemany('INSERT INTO archive_openings VALUES (?, ?, ?, 1, ?, ?, ?) ON CONFLICT (key, guild, next) DO UPDATE SET '
+                                           'games = games + 1, white = white + excluded.white, draws = draws + excluded.draws, black = black + excluded.black',
+                                           [(signed(key), game.guild, move, game.result == 1, game.result == 0, game.result == -1)
+                                            for key, ply, move in game.positions if ply < OPENING_PLIES and move is not None])
+                    connection.executemany('INSERT INTO archive_players VALUES (?, ?, ?, ?, ?, ?)',
+                                           [(game.guild, player, game.game, color, moves, game.result) for player, (color, moves) in game.players.items()])
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def loadgames(self, guild, key, limit = 10):
+        key = signed(key)
+        count, = self.connection.execute('SELECT count(DISTINCT game) FROM archive_positions WHERE key = ? AND guild = ?', (key, guild)).fetchone()
+        games = self.connection.execute('SELECT game, min(ply), result FROM archive_positions WHERE key = ? AND guild = ? GROUP BY game ORDER BY game DESC LIMIT ?',
+                                        (key, guild, limit)).fetchall()
+        return count, games
+
+    def loadopenings(self, guild, key):
+        key = signed(key)
+        rows = self.connection.execute('SELECT next, games, white, draws, black FROM archive_openings WHERE key = ? AND guild = ? ORDER BY games DESC', (key, guild)).fetchall()
+        if rows:
+            return rows
+        # only reached after the opening, by few games
+        return [(move, games, int(white), int(draws), int(black)) for move, games, white, draws, black in self.connection.execute(
+            'SELECT next, count(*), total(result = 1), total(result = 0), total(result = -1) FROM archive_positions '
+            'WHERE key = ? AND guild = ? AND next IS NOT NULL GROUP BY next ORDER BY count(*) DESC', (key, guild))]
+
+    def loadplayer(self, guild, player):
+        return {color: (games, int(wins), int(draws), int(losses)) for color, games, wins, draws, losses in self.connection.execute(
+            'SELECT color, count(*), total(result = color), total(result = 0), total(result = -color) FROM archive_players WHERE guild = ? AND player = ? GROUP BY color',
+            (guild, player))}
+
+    def loadgame(self, game):
+        return self.connection.execute('SELECT pgn, moves FROM archive WHERE game = ?', (game,)).fetchone()
+
+    async def games(self, guild, key, limit = 10):
+        """(how many games of guild reached the position of key, [(game, first ply there, result)] of the newest limit of them)."""
+        return await self.run(self.loadgames, guild, key, limit)
+
+    async def openings(self, guild, key):
+        """[(Polyglot move, games, white wins, draws, black wins)] of the moves played in the position of key, most played first.
+        Within the opening a game counts once per time it was in the position."""
+        return await self.run(self.loadopenings, guild, key)
+
+    async def player(self, guild, player):
+        """{color: (games, wins, draws, losses)} of a player."""
+        return await self.run(self.loadplayer, guild, player)
+
+    async def pgn(self, game):
+        row = await self.run(self.loadgame, game)
+        return row[0] if row else None
+
+    async def moves(self, game):
+        """[(origin, to, promote)] of an archived game, None if it is not archived."""
+        row = await self.run(self.loadgame, game)
+        return unpack(row[1]) if row else None
+
+    def export(self, guild = None):
+        """Yields the PGN of every archived game, oldest first."""
+        if guild is None:
+            rows = self.connection.execute('SELECT pgn FROM archive ORDER BY game')
+        else:
+            rows = self.connection.execute('SELECT pgn FROM archive WHERE guild = ? ORDER BY game', (guild,))
+        for text, in rows:
+            yield text
+
+    def close(self):
+        self.executor.shutdown()
+        self.connection.close()
+
+
+def synthetic(count, seed = 1, openings = 300, players = 1000):
+    """Yields count ArchivedGames for the benchmark. Their first 4 to 16 plies follow one of a few
+    hundred random opening lines, so early positions are shared like in a real archive; the rest
+    of each game gets random keys, later positions being almost never reached twice."""
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(openings):
+        board = chess.Game('bitboard')
+        for _ in range(16):
+            board.all_moves()
+            board.push(rng.choice(board.legal_moves()))
+        lines.append([(key, polyglot.encode(move)) for key, move in board.played()])
+
+    for i in range(count):
+        line = rng.choice(lines)[:rng.randint(4, 16)]
+        plies = rng.randint(20, 120)
+        played = line + [(rng.getrandbits(64), rng.getrandbits(12)) for _ in range(plies - len(line))]
+        moves = [move for _, move in played]
+        positions = [(key, ply, move) for ply, (key, move) in enumerate(played)] + [(rng.getrandbits(64), plies, None)]
+        result = rng.choice((1, 0, -1))
+        white, black = rng.sample(range(players), 2)
+        text = pgn({'Event': 'benchmark', 'Result': RESULTS[result]}, [chess.Game.longnotation(polyglot.decode(move)) for move in moves], result)
+        yield ArchivedGame(10 ** 17 + i, 1, result, plies, time.time(), text, pack(moves), positions, {white: (1, plies // 2), black: (-1, plies // 2)})
+
+def benchmark(count = 100000, repeat = 100, batch = 1000):
+    """Archives count synthetic games in a temporary database, then times each query repeat times."""
+    with tempfile.TemporaryDirectory() as directory:
+        archive = Archive(os.path.join(directory, 'archive.sqlite3'))
+        start = time.perf_counter()
+        chunk = []
+        for game in synthetic(count):
+            chunk.append(game)
+            if len(chunk) == batch:
+                archive.insert(chunk)
+                chunk = []
+        if chunk:
+            archive.insert(chunk)
+        seconds = time.perf_counter() - start
+        rows, = archive.connection.execute('SELECT count(*) FROM archive_positions').fetchone()
+        size = os.path.getsize(os.path.join(directory, 'archive.sqlite3')) + os.path.getsize(os.path.join(directory, 'archive.sqlite3-wal'))
+
+        start = chess.Game.startkey or chess.Game('bitboard').position_key
+        opening = archive.connection.execute('SELECT key FROM archive_positions WHERE ply = 2 LIMIT 1').fetchone()[0] % (1 << 64)
+        deep = archive.connection.execute('SELECT key FROM archive_positions WHERE ply = 60 LIMIT 1').fetchone()[0] % (1 << 64)
+        queries = {'games_start': lambda: archive.loadgames(1, start), 'games_opening': lambda: archive.loadgames(1, opening),
+                   'games_unique': lambda: archive.loadgames(1, deep), 'openings_start': lambda: archive.loadopenings(1, start),
+                   'openings_opening': lambda: archive.loadopenings(1, opening), 'openings_unique': lambda: archive.loadopenings(1, deep), 'player': lambda: archive.loadplayer(1, 7)}
+        results = {'name': 'archive', 'games': count, 'positions': rows, 'megabytes': size / 1e6, 'insert_games_per_second': count / seconds}
+        for name, query in queries.items():
+            times = []
+            for _ in range(repeat):
+                begin = time.perf_counter()
+                query()
+                times.append(time.perf_counter() - begin)
+            times.sort()
+            results[name + '_ms'] = {'median': 1000 * times[len(times) // 2], 'p99': 1000 * times[min(len(times) - 1, len(times) * 99 // 100)]}
+        archive.close()
+    return results
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Export the archive of finished games, or benchmark its queries.')
+    parser.add_argument('--database', default = 'chessbot.sqlite3')
+    parser.add_argument('--export', metavar = 'PGN', help = 'write every archived game to this PGN file')
+    parser.add_argument('--guild', type = int, help = 'only export the games of this guild')
+    parser.add_argument('--benchmark', type = int, nargs = '?', const = 100000, metavar = 'GAMES', help = 'time the queries over that many synthetic games (default 100000)')
+    parser.add_argument('--json', action = 'store_true', help = 'print the benchmark as one JSON line')
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        result = benchmark(args.benchmark)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('{games} games, {positions} positions, {megabytes:.0f} MB, archived at {insert_games_per_second:.0f} games/s'.format(**result))
+            for name, times in result.items():
+                if name.endswith('_ms'):
+                    print('{:<20} median {:.2f} ms, p99 {:.2f} ms'.format(name[:-3], times['median'], times['p99']))
+        return 0
+    if args.export:
+        archive = Archive(args.database)
+        count = 0
+        with open(args.export, 'w', encoding = 'utf-8') as file:
+            for text in archive.export(args.guild):
+                file.write(text + '\n')
+                count += 1
+        archive.close()
+        print(count, 'games written to', args.export)
+        return 0
+    parser.print_usage()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
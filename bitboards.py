@@ -0,0 +1,357 @@
+"""Bitboard move generation backend for shitty_chessgamelogic.Game.
+
+Squares are numbered row * 8 + column, using the same (row, column) pairs as
+Game.board, so a1 is 0, h1 is 7 and h8 is 63. Colours are indexed like the
+rest of the game logic: 0 for white (1) and 1 for black (-1).
+
+The attack tables only depend on the geometry of the board, so they are
+computed once and kept in a versioned binary file (CACHE, 64-bit words) that
+later imports map into memory instead of building the sliding piece tables
+again, which is most of the import time. A missing, stale or damaged file is
+rebuilt; bump VERSION when a table changes.
+"""
+import os
+import sys
+import mmap
+import struct
+
+FULL = 0xFFFFFFFFFFFFFFFF
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+
+PIECETYPES = ['P', 'N', 'B', 'R', 'Q', 'K']
+TYPEINDEX = {type: i for i, type in enumerate(PIECETYPES)}
+
+ROOK_DIRECTIONS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+BISHOP_DIRECTIONS = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+
+def square(pos):
+    return pos[0] * 8 + pos[1]
+
+def position(sq):
+    return divmod(sq, 8)
+
+POSITIONS = [divmod(sq, 8) for sq in range(64)]
+
+def squares(bb):
+    while bb:
+        lsb = bb & -bb
+        yield lsb.bit_length() - 1
+        bb ^= lsb
+
+def leaper(sq, shifts):
+    row, col = position(sq)
+    bb = 0
+    for drow, dcol in shifts:
+        if 0 <= row + drow < 8 and 0 <= col + dcol < 8:
+            bb |= 1 << square((row + drow, col + dcol))
+    return bb
+
+def ray(sq, direction, stop = 0):
+    # every square from sq (excluded) towards the edge, stopping on the first square of stop
+    row, col = position(sq)
+    drow, dcol = direction
+    bb = 0
+    row, col = row + drow, col + dcol
+    while 0 <= row < 8 and 0 <= col < 8:
+        bit = 1 << square((row, col))
+        bb |= bit
+        if stop & bit:
+            break
+        row, col = row + drow, col + dcol
+    return bb
+
+def relevant(sq, directions):
+    # occupancy bits that can change the attacks of a slider on sq (the edge squares never do)
+    bb = 0
+    for direction in directions:
+        line = ray(sq, direction)
+        if line:
+            edge = line.bit_length() - 1 if direction[0] * 8 + direction[1] > 0 else (line & -line).bit_length() - 1
+            bb |= line ^ 1 << edge
+    return bb
+
+def sliding_table(sq, directions, mask):
+    # one entry per subset of the relevant occupancy: the dict hash plays the part of the magic multiply
+    table = {}
+    occupancy = 0
+    while True:
+        attacks = 0
+        for direction in directions:
+            attacks |= ray(sq, direction, occupancy)
+        table[occupancy] = attacks
+        occupancy = (occupancy - mask) & mask
+        if occupancy == 0:
+            return table
+
+
+DIRECTIONS = ROOK_DIRECTIONS + BISHOP_DIRECTIONS
+
+VERSION = 1
+MAGIC = b'CBBB'
+HEADER = struct.Struct('=4sIQ') # magic, version, number of words after the header
+CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', 'bitboards.v{}.bin'.format(VERSION))
+# name: number of words, None for the sliding tables whose size follows from the masks
+TABLES = {'knight': 64, 'king': 64, 'pawn': 128, 'rays': 64 * len(DIRECTIONS), 'between': 4096, 'masks': 128, 'keys': None, 'values': None}
+
+
+def computetables():
+    """Every table, as flat lists of words in the order of the cache file."""
+    masks = [relevant(sq, ROOK_DIRECTIONS) for sq in range(64)] + [relevant(sq, BISHOP_DIRECTIONS) for sq in range(64)]
+    rays = [ray(sq, direction) for direction in DIRECTIONS for sq in range(64)]
+    between = [0] * 4096
+    for d, direction in enumerate(DIRECTIONS):
+        for sq in range(64):
+            line = rays[d * 64 + sq]
+            for target in squares(line):
+                between[sq * 64 + target] = line & ~rays[d * 64 + target] & ~(1 << target)
+    keys, values = [], []
+    for sq in range(128):
+        for occupancy, attacks in sliding_table(sq % 64, ROOK_DIRECTIONS if sq < 64 else BISHOP_DIRECTIONS, masks[sq]).items():
+            keys.append(occupancy)
+            values.append(attacks)
+    return {'knight': [leaper(sq, [(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)]) for sq in range(64)],
+            'king': [leaper(sq, [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]) for sq in range(64)],
+            'pawn': [leaper(sq, [(1, -1), (1, 1)]) for sq in range(64)] + [leaper(sq, [(-1, -1), (-1, 1)]) for sq in range(64)],
+            'rays': rays, 'between': between, 'masks': masks, 'keys': keys, 'values': values}
+
+def savetables(tables, path = CACHE):
+    words = [word for name in TABLES for word in tables[name]]
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(words)))
+        f.write(struct.pack('={}Q'.format(len(words)), *words))
+    os.replace(temporary, path) # readers never see half a file
+
+def loadtables(path = CACHE):
+    """The tables of the cache file, None if it is missing or not the right one."""
+    try:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    with data:
+        if len(data) < HEADER.size:
+            return None
+        magic, version, size = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION or len(data) != HEADER.size + 8 * size:
+            return None
+        words = memoryview(data)[HEADER.size:].cast('Q')
+        try:
+            tables = {}
+            start = 0
+            for name in TABLES:
+                length = TABLES[name] if TABLES[name] is not None else sum(1 << bin(mask).count('1') for mask in tables['masks'])
+                tables[name] = words[start:start + length].tolist()
+                start += length
+            return tables if start == size else None
+        finally:
+            words.release()
+
+def attacktables():
+    loaded = loadtables()
+    if loaded is not None:
+        return loaded
+    computed = computetables()
+    try:
+        os.makedirs(os.path.dirname(CACHE), exist_ok = True)
+        savetables(computed)
+    except OSError as e: # read-only install, still works, only slower to import
+        print('Could not write', CACHE, e, file = sys.stderr)
+    return computed
+
+def split(tables):
+    """Per square sliding dicts from the flat keys and values, rook squares then bishop squares."""
+    result = []
+    start = 0
+    keys, values = tables['keys'], tables['values']
+    for mask in tables['masks']:
+        stop = start + (1 << bin(mask).count('1'))
+        result.append(dict(zip(keys[start:stop], values[start:stop])))
+        start = stop
+    return result
+
+cached = attacktables()
+KNIGHT_ATTACKS = cached['knight']
+KING_ATTACKS = cached['king']
+PAWN_ATTACKS = [cached['pawn'][:64],  # white
+                cached['pawn'][64:]]  # black
+RAYS = [cached['rays'][d * 64:(d + 1) * 64] for d in range(len(DIRECTIONS))] # [direction][square], in DIRECTIONS order
+
+ROOK_MASKS = cached['masks'][:64]
+BISHOP_MASKS = cached['masks'][64:]
+sliding = split(cached)
+ROOK_TABLES = sliding[:64]
+BISHOP_TABLES = sliding[64:]
+
+# squares strictly between two aligned squares, 0 if they do not share a line
+BETWEEN = [cached['between'][sq * 64:(sq + 1) * 64] for sq in range(64)]
+del cached, sliding
+
+# (rights bit, king destination, squares that must be empty, squares that must not be attacked, rook square)
+CASTLING = [[(1, 6, 0x60, 0x60, 7), (2, 2, 0x0E, 0x0C, 0)],
+            [(4, 62, 0x60 << 56, 0x60 << 56, 63), (8, 58, 0x0E << 56, 0x0C << 56, 56)]]
+
+
+def rook_attacks(sq, occupied):
+    return ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+
+def bishop_attacks(sq, occupied):
+    return BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]]
+
+
+class Bitboards:
+    def __init__(self):
+        self.pieces = [[0] * 6, [0] * 6]  # [colour][piece type]
+        self.occupied = [0, 0]
+        self.turn = 1
+        self.castling = 0  # 1: white short, 2: white long, 4: black short, 8: black long
+        self.enpassant = None  # square a pawn can capture to, if the last move was a double push
+
+    @classmethod
+    def from_game(cls, game):
+        self = cls()
+        self.turn = game.turn
+        bypos = {}
+        for piece in game.pieces.flat:
+            if piece is not None:
+                sq = square(piece.pos)
+                colour = 0 if piece.color == 1 else 1
+                self.pieces[colour][TYPEINDEX[piece.type]] |= 1 << sq
+                self.occupied[colour] |= 1 << sq
+                bypos[sq] = piece
+
+        self.castling = game.castlingrights()
+
+        if game.enpassant is not None:
+            self.enpassant = square(game.enpassant)
+        return self, bypos
+
+    def attackers(self, sq, colour, occupied):
+        """Bitboard of the pieces of colour attacking sq."""
+        pawns, knights, bishops, rooks, queens, kings = self.pieces[colour]
+        return (PAWN_ATTACKS[1 - colour][sq] & pawns
+                | KNIGHT_ATTACKS[sq] & knights
+                | KING_ATTACKS[sq] & kings
+                | bishop_attacks(sq, occupied) & (bishops | queens)
+                | rook_attacks(sq, occupied) & (rooks | queens))
+
+    def attacked(self, colour, occupied):
+        """Bitboard of every square attacked by colour."""
+        pawns, knights, bishops, rooks, queens, kings = self.pieces[colour]
+        if colour == 0:
+            bb = ((pawns & ~FILE_A) << 7 | (pawns & ~FILE_H) << 9) & FULL
+        else:
+            bb = (pawns & ~FILE_A) >> 9 | (pawns & ~FILE_H) >> 7
+        for sq in squares(knights):
+            bb |= KNIGHT_ATTACKS[sq]
+        for sq in squares(bishops | queens):
+            bb |= bishop_attacks(sq, occupied)
+        for sq in squares(rooks | queens):
+            bb |= rook_attacks(sq, occupied)
+        for sq in squares(kings):
+            bb |= KING_ATTACKS[sq]
+        return bb
+
+    def legal_moves(self):
+        """Returns (moves, checkers, attacked): moves is a list of (from, to) squares for the
+        side to move, promotions appear once, checkers and attacked are bitboards."""
+        us = 0 if self.turn == 1 else 1
+        them = 1 - us
+        own, opp = self.occupied[us], self.occupied[them]
+        occupied = own | opp
+        pawns, knights, bishops, rooks, queens, kings = self.pieces[us]
+        theirs = self.pieces[them]
+
+        ksq = kings.bit_length() - 1
+        attacked = self.attacked(them, occupied ^ kings)
+        checkers = self.attackers(ksq, them, occupied)
+
+        moves = []
+        for to in squares(KING_ATTACKS[ksq] & ~own & ~attacked):
+            moves.append((ksq, to))
+
+        if checkers & (checkers - 1):  # double check, only the king can move
+            return moves, checkers, attacked
+
+        if checkers:
+            mask = BETWEEN[ksq][checkers.bit_length() - 1] | checkers
+        else:
+            mask = FULL
+            for rights, to, empty, safe, rook in CASTLING[us]:
+                if self.castling & rights and not occupied & empty and not attacked & safe:
+                    moves.append((ksq, to))
+
+        pins = {}
+        snipers = (rook_attacks(ksq, opp) & (theirs[3] | theirs[4])) | (bishop_attacks(ksq, opp) & (theirs[2] | theirs[4]))
+        for sniper in squares(snipers):
+            blockers = BETWEEN[ksq][sniper] & occupied
+            if blockers and not blockers & (blockers - 1) and blockers & own:
+                pins[blockers.bit_length() - 1] = BETWEEN[ksq][sniper] | 1 << sniper
+
+        targets = ~own & mask
+        for sq in squares(knights):
+            if sq not in pins:
+                for to in squares(KNIGHT_ATTACKS[sq] & targets):
+                    moves.append((sq, to))
+        for sq in squares(bishops | queens):
+            for to in squares(bishop_attacks(sq, occupied) & targets & pins.get(sq, FULL)):
+                moves.append((sq, to))
+        for sq in squares(rooks | queens):
+            for to in squares(rook_attacks(sq, occupied) & targets & pins.get(sq, FULL)):
+                moves.append((sq, to))
+
+        forward = 8 if us == 0 else -8
+        start = 1 if us == 0 else 6
+        for sq in squares(pawns):
+            pin = pins.get(sq, FULL)
+            one = sq + forward
+            if not occupied >> one & 1:
+                if 1 << one & mask & pin:
+                    moves.append((sq, one))
+                two = one + forward
+                if sq >> 3 == start and not occupied >> two & 1 and 1 << two & mask & pin:
+                    moves.append((sq, two))
+            for to in squares(PAWN_ATTACKS[us][sq] & opp & mask & pin):
+                moves.append((sq, to))
+            if self.enpassant is not None and PAWN_ATTACKS[us][sq] >> self.enpassant & 1 and self.legal_enpassant(sq, ksq, us):
+                moves.append((sq, self.enpassant))
+
+        return moves, checkers, attacked
+
+    def legal_enpassant(self, sq, ksq, us):
+        # en passant removes two pieces from a line at once, so play it out and look for checks
+        captured = self.enpassant - (8 if us == 0 else -8)
+        occupied = (self.occupied[0] | self.occupied[1]) ^ (1 << sq) ^ (1 << captured) | 1 << self.enpassant
+        them = self.pieces[1 - us]
+        self.pieces[1 - us] = [them[0] ^ 1 << captured] + them[1:]
+        try:
+            return not self.attackers(ksq, 1 - us, occupied)
+        finally:
+            self.pieces[1 - us] = them
+
+
+def all_moves(game):
+    """Drop-in replacement for Game.all_moves: fills Piece.moves, Game.moves and the king's check info."""
+    dico = {1 : (0,1), -1: (1,0)}
+    current, opponent = dico[game.turn]
+
+    for piece in game.pieces.flat:
+        if piece is not None:
+            piece.reset()
+
+    bitboards, bypos = Bitboards.from_game(game)
+    moves, checkers, attacked = bitboards.legal_moves()
+
+    game.moves[opponent] = [POSITIONS[sq] for sq in squares(attacked)]
+    game.moves[current] = targets = []
+    for origin, to in moves:
+        to = POSITIONS[to]
+        bypos[origin].moves.append(to)
+        targets.append(to)
+
+    king = game.pieces[current][1, 4]
+    king.incheck = [POSITIONS[sq] for sq in squares(checkers)]
+    if len(king.incheck) == 1:
+        king.blockcheck = [POSITIONS[sq] for sq in squares(BETWEEN[square(king.pos)][checkers.bit_length() - 1])]
@@ -6,102 +6,57 @@ from disnake.ext import commands
 from dotenv import dotenv_values
 
 import shitty_chessgamelogic as chess
+import sessions as chesssessions
+import storage
+import polyglot
+import metrics
+import supervisor
+import globalstats
+import guildindex
+import analysis
+import archive
+import pgnstream
+import history
+import clocks
 
 config = dotenv_values(".env")
 
 token = config['token']
 
-async def playOverwrite(self, lobby):
-
-    await lobby.send("> Welcome to this new game of chess, you have **10** minutes to make **a** move or you lose.\nGLHF all !")
-    hello = await lobby.send("Use this thread to navigate to previous moves")
-    await hello.pin()
-
-    thread = await lobby.create_thread(name = "You can click the moves to go see its board state.\n", message=hello)
-
-    white = disnake.utils.get(lobby.guild.roles, name="chessbot team white")
-    black = disnake.utils.get(lobby.guild.roles, name="chessbot team black")
-
-    roles = [white, black]
-
-    def createcheck(role):
-        return lambda message: message.channel == lobby and role in message.author.roles
-
-    dict = {1 : "**White**", -1 : "**Black**"}
-
-    while True:
-
-        if self.history:
-            lastmove = ' *' + self.history[-1] + '*'
-
-        else:
-            lastmove = 'None'
-
-        payload = disnake.Embed(title = dict[self.turn] + " to play.", description = "Last move:" + lastmove)
-        payload.add_field(name = "Current boardstate:", value = str(self).replace('♟', '\\♟').replace('.', '   .   ') )
-
-        # dict[self.turn] + " to play. Last move:" + lastmove + '\n\n\n' + str(self).replace('♟', '\\♟').replace('.', '   .   ')
-
-        board_msg = await lobby.send(embed = payload)
-
-        if self.history:
-            lastmove = self.history[-1]
-            button = disnake.ui.Button(label = lastmove, url = board_msg.jump_url)
-            if self.turn == -1:
-                view = disnake.ui.View(timeout = None)
-                view.add_item(button)
-                thread_msg = await thread.send(content = str(len(self.history)//2) + '. ', view = view )
-            else:
-                view.add_item(button)
-                await thread_msg.edit(content = str(len(self.history)//2) + '. ', view = view )
-        else:
-            button = disnake.ui.Button(label = "Game Start", url = board_msg.jump_url)
-            view = disnake.ui.View(timeout = None)
-            view.add_item(button)
-            thread_msg = await thread.send(content = str(len(self.history)//2) + '. ', view = view )
-
-        self.checkgamestatus()
-
-        if self.game_status != '':
-            break
-
-        while True:
-            try:
-                move = await bot.wait_for('message', timeout=600.0, check = createcheck(roles[(self.turn-1)//2]))
-                print(move.content)
-
-            except asyncio.TimeoutError:
-                self.game_status = '> ' + dict[self.turn] + " `lost` on time."
-            else:
-
-                try:
-                    if move.content == 'resign':
-                        self.game_status = dict[self.turn] + ' resigns.'
-                    else:
-                        self.playturn(move.content)
-                        break
-
-                except chess.InvalidMove:
-                    await lobby.send('Invalid Move (can be my fault)')
-                except chess.AmbiguousMove:
-                    await lobby.send('Ambiguous Move')
-                except chess.ParseError:
-                    await lobby.send('Failed to parse Move')
-                else:
-                    break
-
-
-    await lobby.send('> **' + self.game_status + '**')
-
-chess.Game.play = playOverwrite
-
-bot = commands.Bot(
-    command_prefix=commands.when_mentioned,
-    # Insert IDs of your test guilds below, if
-    # you want the context menus to instantly appear.
-    # Without test_guilds specified, your commands will
-    # register globally in ~1 hour.
-)
+# set when supervisor.py started this process for some of the shards
+owns = supervisor.owner()
+if owns is None:
+    bot = commands.Bot(
+        command_prefix=commands.when_mentioned,
+        # Insert IDs of your test guilds below, if
+        # you want the context menus to instantly appear.
+        # Without test_guilds specified, your commands will
+        # register globally in ~1 hour.
+    )
+else:
+    bot = commands.AutoShardedBot(
+        command_prefix=commands.when_mentioned,
+        shard_ids=[int(id) for id in os.environ['CHESSBOT_SHARD_IDS'].split(',')],
+        shard_count=int(os.environ['CHESSBOT_SHARD_COUNT']),
+    )
+
+sessions = chesssessions.SessionRegistry()
+resources = guildindex.GuildIndex()
+resources.attach(bot)
+store = storage.GameStore(config.get('database') or 'chessbot.sqlite3')
+chesssessions.STATS = globalstats.Stats(config.get('database') or 'chessbot.sqlite3')
+chesssessions.ARCHIVE = archive.Archive(config.get('database') or 'chessbot.sqlite3')
+history.HistoryViewer(sessions, store, chesssessions.renderer).attach(bot)
+chesssessions.BOOK = config.get('book')
+chesssessions.TABLEBASES = config.get('tablebases')
+metrics.gauge('games_active', lambda: len(sessions))
+if config.get('metrics_port'):
+    metrics.enable()
+metrics_server = None
+
+@bot.listen('on_message')
+async def dispatch(message):
+    await sessions.dispatch(message)
 
 @bot.event
 async def on_ready():
@@ -109,6 +64,15 @@ async def on_ready():
     print(f"Logged in as {bot.user} (ID: {bot.user.id})")
     print("------")
 
+    # on_ready also fires after reconnects, resume skips the games that are still running
+    store.start()
+    global metrics_server
+    if metrics.enabled and metrics_server is None:
+        # shard processes each listen on the port after the previous one's
+        metrics_server = await metrics.serve(int(config['metrics_port']) + (min(bot.shard_ids) if owns is not None else 0))
+        asyncio.get_running_loop().create_task(metrics.samplelag())
+    await chesssessions.resume(bot, sessions, store, owns, resources)
+
 def create_overwrites(ctx, *objects):
     """This is just a helper function that creates the overwrites for the
     voice/text channels.
@@ -164,31 +128,14 @@ async def ask(ctx: commands.Context):
 
 @bot.command(name = 'setupforthefirsttime')
 async def setup(ctx: disnake.ApplicationCommandInteraction):
-    if not disnake.utils.get(ctx.guild.channels, name='chessbot gameroom'):
-
-        white = await ctx.guild.create_role(name="chessbot team white", colour = disnake.Colour.from_rgb(255,255,255), reason="chessbot setup")
-        black = await ctx.guild.create_role(name="chessbot team black", colour = disnake.Colour.from_rgb(1,1,1), reason="chessbot setup")
-
-        roles = [white, black]
-
-        category = await ctx.guild.create_category_channel(name = "chessbot gameroom", reason="chessbot setup")
-        lobby = await ctx.guild.create_text_channel(name = "chessbot lobby", category = category, reason="chessbot setup")
-
-        for role in roles:
-            overwrites = create_overwrites(ctx, role)
-            await ctx.guild.create_text_channel(name = role.name, overwrites=overwrites, category = category, reason="chessbot setup")
-            await ctx.guild.create_voice_channel(name = role.name, overwrites=overwrites, category = category, reason="chessbot setup")
+    # safe to run again, it only creates what is missing
+    created = await resources.install(ctx.guild, lambda role: create_overwrites(ctx, role))
+    await ctx.send("All set up." if created else "Already set up, nothing was missing.")
 
 @bot.command(name = 'cleanupforthelasttime')
 async def cleanup(ctx: disnake.ApplicationCommandInteraction):
     if await ask(ctx):
-        for channel in ctx.guild.channels:
-            if channel.name in {"chessbot gameroom", "chessbot-team-white", "chessbot-team-black", "chessbot-lobby", "chessbot team black", "chessbot team white"}:
-                await channel.delete(reason = "chessbot cleanup")
-
-        for role in ctx.guild.roles:
-            if role.name in {"chessbot team white", "chessbot team black"}:
-                await role.delete(reason = "chessbot cleanup")
+        await resources.uninstall(ctx.guild)
 
 
 # Defines a custom Select containing colour options
@@ -223,8 +170,7 @@ class Dropdown(disnake.ui.Select):
         # Select object, and the values attribute gets a list of the user's
         # selected options. We only want the first one.
 
-        white = disnake.utils.get(interaction.guild.roles, name="chessbot team white")
-        black = disnake.utils.get(interaction.guild.roles, name="chessbot team black")
+        white, black = resources.teams(interaction.guild)
 
         await interaction.response.send_message(f"Protip: don't tell anyone but you can switch midmatch to spy on others (or just be a server admin)", ephemeral=True)
         if self.values[0] == "White":
@@ -245,12 +191,9 @@ class DropdownView(disnake.ui.View):
         self.add_item(Dropdown())
 
 
-
-game_isrunning = []
-        
 async def chooseside(ctx):
     """Sends a message with our dropdown containing colours"""
-    url = disnake.utils.get(ctx.guild.channels, name='chessbot-lobby').jump_url
+    url = resources.channel(ctx.guild, 'lobby').jump_url
     # Create the view containing our dropdown
     view = DropdownView()
 
@@ -261,24 +204,164 @@ async def chooseside(ctx):
     await ctx.send("", view=view)
 
 @bot.slash_command()
-async def playchess(ctx: disnake.ApplicationCommandInteraction):
-    global game_isrunning
-    
-    lobby = disnake.utils.get(ctx.guild.channels, name='chessbot-lobby')
-    if lobby is None:
+async def playchess(
+    ctx: disnake.ApplicationCommandInteraction,
+    opponent: str = commands.Param(default = "Humans", choices = ["Humans", "Bot"]),
+    bot_plays: str = commands.Param(default = "Black", choices = ["White", "Black"]),
+    clock: str = commands.Param(default = clocks.name(clocks.CONTROLS[0]), choices = list(clocks.CHOICES)),
+):
+    lobby = resources.channel(ctx.guild, 'lobby')
+    white, black = resources.teams(ctx.guild)
+    if lobby is None or white is None or black is None:
         await ctx.response.send_message("Whoops, seems like I was not setup properly...\nTry '@chessbot setmeupforthefirsttime' for the setup\nand '@chessbot cleanupforthelasttime' to delete everything", ephemeral=True)
         return
-    
-    if ctx.guild in game_isrunning:
-        await ctx.response.send_message("A game is still in progress !", ephemeral=True)
-        return
 
-    game_isrunning.append(ctx.guild)
-    
     await chooseside(ctx)
-    game = chess.Game()
-    await game.play(lobby)
-    
-    game_isrunning.remove(ctx.guild)
-    
+
+    session = chesssessions.Session(chess.Game(backend = 'bitboard'), lobby, [white, black], {"White": 1, "Black": -1}[bot_plays] if opponent == "Bot" else None, store,
+                                     clocks.Clock(clocks.CHOICES[clock]))
+    await session.start("Game " + str(len(sessions.inguild(ctx.guild.id)) + 1) + " started by " + ctx.author.display_name, sessions)
+
+@bot.slash_command()
+async def move(ctx: disnake.ApplicationCommandInteraction, move: str):
+    """Plays a move in the game of this thread, like e4, Nxf3 or O-O."""
+    session = sessions.get(ctx.channel.id)
+    if session is None:
+        await ctx.response.send_message("No game is running here.", ephemeral=True)
+        return
+    if not session.allowed(ctx.author):
+        await ctx.response.send_message("It is not your team's turn.", ephemeral=True)
+        return
+
+    # the board can take longer than the 3 seconds an interaction gets to be answered
+    await ctx.response.defer(ephemeral=True)
+    error = await session.submit(ctx.author, move)
+    await ctx.edit_original_message(content=error or "Played **{}**.".format(move))
+
+@move.autocomplete("move")
+async def legalmoves(ctx: disnake.ApplicationCommandInteraction, string: str):
+    session = sessions.get(ctx.channel.id)
+    if session is None:
+        return []
+    with metrics.timer('autocomplete'):
+        return session.suggestions(string)
+
+@bot.slash_command()
+async def book(ctx: disnake.ApplicationCommandInteraction):
+    """Shows the opening book moves of the game played in this thread."""
+    session = sessions.get(ctx.channel.id)
+    if session is None or chesssessions.BOOK is None:
+        await ctx.response.send_message("No game with an opening book here.", ephemeral=True)
+        return
+
+    moves = polyglot.openbook(chesssessions.BOOK).moves(session.game)
+    if not moves:
+        await ctx.response.send_message("Out of book.", ephemeral=True)
+        return
+    total = sum(weight for _, weight in moves) or 1
+    await ctx.response.send_message("Book moves: " + ", ".join("**{}** {:.0f}%".format(san, 100 * weight / total) for san, weight in moves[:10]), ephemeral=True)
+
+@bot.slash_command()
+async def analyze(ctx: disnake.ApplicationCommandInteraction, ply: int = None, lines: int = analysis.LINES):
+    """Shows the best lines in the game of this thread, after ply half-moves (the last position by default)."""
+    session = sessions.get(ctx.channel.id)
+    moves = list(session.game.history) if session is not None else await store.moves(ctx.channel.id)
+    if moves is None:
+        await ctx.response.send_message("No game was played in this thread.", ephemeral=True)
+        return
+    if ply is not None:
+        moves = moves[:max(ply, 0)]
+    try:
+        job = analysis.Analysis(moves, max(1, min(lines, 5)))
+    except (chess.InvalidMove, chess.AmbiguousMove, chess.ParseError):
+        await ctx.response.send_message("Could not replay this game.", ephemeral=True)
+        return
+
+    await ctx.response.send_message(job.describe(), view=analysis.StopView(job))
+    job.start(ctx.author.id, await ctx.original_message())
+
+async def archivedposition(ctx, moves, ply):
+    """The position the archive commands look at: after moves if given, else in the game of this thread
+    (after ply half-moves if given), else the starting position. None, and the user is told, if it does not replay."""
+    if moves is not None:
+        moves = pgnstream.parse_movetext(moves)[0].moves
+    else:
+        session = sessions.get(ctx.channel.id)
+        moves = list(session.game.history) if session is not None else await store.moves(ctx.channel.id) or []
+        if ply is not None:
+            moves = moves[:max(ply, 0)]
+    try:
+        return archive.position(moves)
+    except (chess.InvalidMove, chess.AmbiguousMove, chess.ParseError):
+        await ctx.response.send_message("These moves do not replay.", ephemeral=True)
+        return None
+
+@bot.slash_command()
+async def games(ctx: disnake.ApplicationCommandInteraction, moves: str = None, ply: int = None):
+    """Lists the finished games of this server that reached a position (this thread's game or moves like "e4 c5 Nf3")."""
+    board = await archivedposition(ctx, moves, ply)
+    if board is None:
+        return
+    count, found = await chesssessions.ARCHIVE.games(ctx.guild.id, board.position_key)
+    if not count:
+        await ctx.response.send_message("No finished game of this server reached this position.", ephemeral=True)
+        return
+    lines = ["**{}** finished games reached this position{}:".format(count, ", the newest" if count > len(found) else "")]
+    for game, ply, result in found:
+        lines.append("<#{}> at move {}, {}".format(game, ply // 2 + 1, archive.RESULTS.get(result, '*')))
+    await ctx.response.send_message("\n".join(lines), ephemeral=True)
+
+@bot.slash_command()
+async def openings(ctx: disnake.ApplicationCommandInteraction, moves: str = None, ply: int = None):
+    """Shows the moves this server played in a position and how they scored."""
+    board = await archivedposition(ctx, moves, ply)
+    if board is None:
+        return
+    board.santable()
+    lines = []
+    for move, count, white, draws, black in await chesssessions.ARCHIVE.openings(ctx.guild.id, board.position_key):
+        san = board.sanmoves.get(polyglot.decode(move))
+        if san is not None and len(lines) < 10:
+            lines.append("**{}** {} games: White won {:.0f}%, {:.0f}% draws, Black won {:.0f}%".format(san, count, 100 * white / count, 100 * draws / count, 100 * black / count))
+    await ctx.response.send_message("\n".join(lines) or "No finished game of this server played on from this position.", ephemeral=True)
+
+@bot.slash_command()
+async def player(ctx: disnake.ApplicationCommandInteraction, member: disnake.Member):
+    """Shows how a member did in the finished games of this server, as White and as Black."""
+    results = await chesssessions.ARCHIVE.player(ctx.guild.id, member.id)
+    if not results:
+        await ctx.response.send_message("{} has not finished a game here yet.".format(member.display_name), ephemeral=True)
+        return
+    lines = []
+    for color, name in ((1, "White"), (-1, "Black")):
+        if color in results:
+            count, wins, draws, losses = results[color]
+            lines.append("As {}: {} games, {} wins, {} draws, {} losses ({:.0f}% won)".format(name, count, wins, draws, losses, 100 * wins / count))
+    await ctx.response.send_message("**{}**\n".format(member.display_name) + "\n".join(lines), ephemeral=True)
+
+@bot.slash_command()
+async def stats(ctx: disnake.ApplicationCommandInteraction):
+    """Shows this server's results and its best players."""
+    totals = await chesssessions.STATS.totals(ctx.guild.id)
+    lines = ["**{games}** games: White won {white}, Black won {black}, {draws} draws, {plies} moves played.".format(**totals)]
+    for rank, (player, wins, draws, losses, moves) in enumerate(await chesssessions.STATS.leaderboard(ctx.guild.id), 1):
+        lines.append("{}. <@{}> {} wins, {} draws, {} losses ({} moves)".format(rank, player, wins, draws, losses, moves))
+    await ctx.response.send_message("\n".join(lines), ephemeral=True)
+
+@bot.slash_command()
+@commands.has_permissions(administrator = True)
+async def latency(ctx: disnake.ApplicationCommandInteraction):
+    """Shows the turn pipeline latencies (admins only)."""
+    if not metrics.enabled:
+        await ctx.response.send_message("Metrics are off, set metrics_port in .env to turn them on.", ephemeral=True)
+        return
+    await ctx.response.send_message("```\n" + metrics.report() + "\n```", ephemeral=True)
+
+@latency.error
+async def latency_error(ctx: disnake.ApplicationCommandInteraction, error: commands.CommandError):
+    if isinstance(error, commands.CheckFailure):
+        await ctx.response.send_message("Only admins can see the latencies.", ephemeral=True)
+        return
+    raise error
+
 bot.run(token)
@@ -0,0 +1,153 @@
+"""Chess clocks, and the one scheduler that makes flags fall.
+
+A Clock holds the time left of both sides under a TimeControl: base seconds,
+plus an increment added after each move (Fischer) or a delay at the start of
+each move before the clock runs down (simple delay). It runs on the monotonic
+clock and only moves when a move is accepted: press() charges the side that
+moved and starts the other side's time, typing a wrong move costs nothing.
+
+Every running game has one entry in the Scheduler, at the monotonic time its
+side to play runs out. The entries are a heap served by a single task that
+sleeps until the earliest one, so thousands of games waiting on their clocks
+cost one task; a move replaces its game's entry, cancelled entries are
+dropped lazily.
+"""
+import time
+import json
+import heapq
+import asyncio
+import itertools
+import collections
+
+TimeControl = collections.namedtuple('TimeControl', 'base increment delay') # seconds
+
+# the choices of /playchess, the first one is the default: the old 10 minutes to make each move
+CONTROLS = [TimeControl(0, 0, 600), TimeControl(180, 2, 0), TimeControl(300, 3, 0), TimeControl(600, 5, 0),
+            TimeControl(900, 10, 0), TimeControl(1800, 0, 0), TimeControl(900, 0, 10)]
+COMPACT = 1024 # cancelled entries the scheduler tolerates before rebuilding its heap
+
+
+def name(control):
+    """10 minutes per move, 5+3 (minutes + seconds of increment), 15 min 10s delay."""
+    if not control.base:
+        return '{:g} minutes per move'.format(control.delay / 60)
+    if control.delay:
+        return '{:g} min {}s delay'.format(control.base / 60, control.delay)
+    return '{:g}+{}'.format(control.base / 60, control.increment)
+
+CHOICES = {name(control): control for control in CONTROLS}
+
+def minutes(seconds):
+    seconds = max(int(seconds), 0)
+    if seconds >= 3600:
+        return '{}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return '{}:{:02}'.format(seconds // 60, seconds % 60)
+
+
+class Clock:
+    def __init__(self, control = CONTROLS[0], remaining = None):
+        self.control = control
+        self.remaining = list(remaining) if remaining else [float(control.base)] * 2 # white, black, at the start of their move
+        self.side = None # 1 or -1 while that side's time runs
+        self.started = 0.0 # monotonic time the running side's move started
+
+    @staticmethod
+    def index(side):
+        return {1: 0, -1: 1}[side]
+
+    def start(self, side, now = None):
+        self.side = side
+        self.started = time.monotonic() if now is None else now
+
+    def used(self, now = None):
+        """Time the running side has been charged for this move so far."""
+        spent = (time.monotonic() if now is None else now) - self.started
+        return max(spent - self.control.delay, 0.0)
+
+    def left(self, side, now = None):
+        """Seconds before side runs out, the delay of its move included."""
+        if side == self.side:
+            return self.deadline() - (time.monotonic() if now is None else now)
+        return self.remaining[self.index(side)] + self.control.delay
+
+    def press(self, now = None):
+        """The running side moved: charge it, add its increment and start the other side."""
+        now = time.monotonic() if now is None else now
+        i = self.index(self.side)
+        self.remaining[i] += self.control.increment - self.used(now)
+        self.start(-self.side, now)
+
+    def deadline(self):
+        """Monotonic time the running side runs out."""
+        return self.started + self.control.delay + self.remaining[self.index(self.side)]
+
+    def flagged(self, now = None):
+        return self.side is not None and self.left(self.side, now) <= 0
+
+    def describe(self, now = None):
+        return 'White {} | Black {}'.format(minutes(self.left(1, now)), minutes(self.left(-1, now)))
+
+    def dumps(self):
+        """JSON of the control and of the time left at the start of the current move."""
+        return json.dumps({'control': list(self.control), 'remaining': self.remaining})
+
+    @classmethod
+    def loads(cls, text):
+        data = json.loads(text)
+        return cls(TimeControl(*data['control']), data['remaining'])
+
+
+class Scheduler:
+    """Calls callbacks at monotonic times, from one task sleeping until the earliest one."""
+    def __init__(self):
+        self.heap = [] # [when, seq, callback], callback None once cancelled or called
+        self.counter = itertools.count()
+        self.cancelled = 0 # cancelled entries still in the heap
+        self.wakeup = None
+        self.worker = None
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def at(self, when, callback):
+        """Calls callback() at monotonic time when, returns the entry to cancel()."""
+        entry = [when, next(self.counter), callback]
+        heapq.heappush(self.heap, entry)
+        if self.worker is None or self.worker.done():
+            self.wakeup = asyncio.Event()
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+        elif self.heap[0] is entry: # earlier than what the worker sleeps until
+            self.wakeup.set()
+        return entry
+
+    def cancel(self, entry):
+        if entry[2] is None:
+            return
+        entry[2] = None
+        self.cancelled += 1
+        if self.cancelled > COMPACT and self.cancelled * 2 > len(self.heap):
+            self.heap = [entry for entry in self.heap if entry[2] is not None]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    async def run(self):
+        while self.heap:
+            self.wakeup.clear()
+            now = time.monotonic()
+            while self.heap and (self.heap[0][2] is None or self.heap[0][0] <= now):
+                entry = heapq.heappop(self.heap)
+                callback, entry[2] = entry[2], None
+                if callback is None:
+                    self.cancelled -= 1
+                    continue
+                try:
+                    callback()
+                except Exception as e:
+                    print('Scheduled callback failed:', repr(e))
+            if not self.heap:
+                break
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.heap[0][0] - now)
+            except asyncio.TimeoutError:
+                pass
+        self.worker = None
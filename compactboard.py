@@ -0,0 +1,225 @@
+"""Compact positions: one int8 per square instead of a board of Piece objects.
+
+A position is an int8[64] array, indexed row * 8 + column like bitboards.py,
+holding 0 for an empty square and +1..+6 (white) or -1..-6 (black) for
+P, N, B, R, Q, K, plus four state bytes: side to move, castling rights
+(Polyglot bits), en-passant square (-1 for none) and halfmove clock.
+
+PositionBatch stacks thousands of them into one (N, 64) array so material,
+piece-square evaluation, insufficient material and attack maps are computed
+for the whole batch at once.
+"""
+import numpy as np
+
+import bitboards
+import shitty_chessgamelogic as chess
+
+CODES = {'P': 1, 'N': 2, 'B': 3, 'R': 4, 'Q': 5, 'K': 6}
+LETTERS = '.PNBRQK'
+TURN, CASTLING, ENPASSANT, HALFMOVE = range(4)
+
+VALUES = np.array([0, 100, 320, 330, 500, 900, 0])  # by code, the king is never traded
+
+# simplified evaluation function tables, written rank 8 first from white's side
+TABLES = [
+    [0] * 64,
+    [ 0,  0,  0,  0,  0,  0,  0,  0,
+     50, 50, 50, 50, 50, 50, 50, 50,
+     10, 10, 20, 30, 30, 20, 10, 10,
+      5,  5, 10, 25, 25, 10,  5,  5,
+      0,  0,  0, 20, 20,  0,  0,  0,
+      5, -5,-10,  0,  0,-10, -5,  5,
+      5, 10, 10,-20,-20, 10, 10,  5,
+      0,  0,  0,  0,  0,  0,  0,  0],
+    [-50,-40,-30,-30,-30,-30,-40,-50,
+     -40,-20,  0,  0,  0,  0,-20,-40,
+     -30,  0, 10, 15, 15, 10,  0,-30,
+     -30,  5, 15, 20, 20, 15,  5,-30,
+     -30,  0, 15, 20, 20, 15,  0,-30,
+     -30,  5, 10, 15, 15, 10,  5,-30,
+     -40,-20,  0,  5,  5,  0,-20,-40,
+     -50,-40,-30,-30,-30,-30,-40,-50],
+    [-20,-10,-10,-10,-10,-10,-10,-20,
+     -10,  0,  0,  0,  0,  0,  0,-10,
+     -10,  0,  5, 10, 10,  5,  0,-10,
+     -10,  5,  5, 10, 10,  5,  5,-10,
+     -10,  0, 10, 10, 10, 10,  0,-10,
+     -10, 10, 10, 10, 10, 10, 10,-10,
+     -10,  5,  0,  0,  0,  0,  5,-10,
+     -20,-10,-10,-10,-10,-10,-10,-20],
+    [ 0,  0,  0,  0,  0,  0,  0,  0,
+      5, 10, 10, 10, 10, 10, 10,  5,
+     -5,  0,  0,  0,  0,  0,  0, -5,
+     -5,  0,  0,  0,  0,  0,  0, -5,
+     -5,  0,  0,  0,  0,  0,  0, -5,
+     -5,  0,  0,  0,  0,  0,  0, -5,
+     -5,  0,  0,  0,  0,  0,  0, -5,
+      0,  0,  0,  5,  5,  0,  0,  0],
+    [-20,-10,-10, -5, -5,-10,-10,-20,
+     -10,  0,  0,  0,  0,  0,  0,-10,
+     -10,  0,  5,  5,  5,  5,  0,-10,
+      -5,  0,  5,  5,  5,  5,  0, -5,
+       0,  0,  5,  5,  5,  5,  0, -5,
+     -10,  5,  5,  5,  5,  5,  0,-10,
+     -10,  0,  5,  0,  0,  0,  0,-10,
+     -20,-10,-10, -5, -5,-10,-10,-20],
+    [-30,-40,-40,-50,-50,-40,-40,-30,
+     -30,-40,-40,-50,-50,-40,-40,-30,
+     -30,-40,-40,-50,-50,-40,-40,-30,
+     -30,-40,-40,-50,-50,-40,-40,-30,
+     -20,-30,-30,-40,-40,-30,-30,-20,
+     -10,-20,-20,-20,-20,-20,-20,-10,
+      20, 20,  0,  0,  0,  0, 20, 20,
+      20, 30, 10,  0,  0, 10, 30, 20],
+]
+# PIECE_SQUARE[code, square] for white, rows flipped so that square 0 is a1
+PIECE_SQUARE = np.array(TABLES).reshape(7, 8, 8)[:, ::-1].reshape(7, 64)
+
+# EVALUATION[code + 6, square]: material plus piece-square bonus, from white's point of view
+EVALUATION = np.zeros((13, 64), dtype = np.int32)
+for code in range(1, 7):
+    EVALUATION[6 + code] = VALUES[code] + PIECE_SQUARE[code]
+    EVALUATION[6 - code] = -(VALUES[code] + PIECE_SQUARE[code].reshape(8, 8)[::-1].reshape(64))
+
+def attackmatrix(table):
+    matrix = np.zeros((64, 64), dtype = np.int8)
+    for sq in range(64):
+        for target in bitboards.squares(table[sq]):
+            matrix[sq, target] = 1
+    return matrix
+
+KNIGHT_MATRIX = attackmatrix(bitboards.KNIGHT_ATTACKS)
+KING_MATRIX = attackmatrix(bitboards.KING_ATTACKS)
+PAWN_MATRIX = [attackmatrix(bitboards.PAWN_ATTACKS[0]), attackmatrix(bitboards.PAWN_ATTACKS[1])]
+
+# for every direction and distance, the (origin, target, previous square) triples that stay on the board
+def raysteps(direction):
+    steps = []
+    for distance in range(1, 8):
+        origins, targets, previous = [], [], []
+        for sq in range(64):
+            row, col = divmod(sq, 8)
+            trow, tcol = row + distance * direction[0], col + distance * direction[1]
+            if 0 <= trow < 8 and 0 <= tcol < 8:
+                origins.append(sq)
+                targets.append(trow * 8 + tcol)
+                previous.append((trow - direction[0]) * 8 + tcol - direction[1])
+        steps.append((np.array(origins), np.array(targets), np.array(previous)))
+    return steps
+
+ROOK_STEPS = [raysteps(direction) for direction in bitboards.ROOK_DIRECTIONS]
+BISHOP_STEPS = [raysteps(direction) for direction in bitboards.BISHOP_DIRECTIONS]
+
+
+class CompactPosition:
+    def __init__(self, squares = None, state = None):
+        self.squares = np.zeros(64, dtype = np.int8) if squares is None else squares
+        self.state = np.array([1, 0, -1, 0], dtype = np.int8) if state is None else state
+
+    @classmethod
+    def from_game(cls, game):
+        self = cls()
+        for piece in game.pieces.flat:
+            if piece is not None:
+                self.squares[piece.pos[0] * 8 + piece.pos[1]] = CODES[piece.type] * piece.color
+        self.state[TURN] = game.turn
+        self.state[CASTLING] = game.castlingrights()
+        self.state[ENPASSANT] = -1 if game.enpassant is None else game.enpassant[0] * 8 + game.enpassant[1]
+        self.state[HALFMOVE] = min(game.fiftymoves, 127)
+        return self
+
+    def fen(self):
+        rows = []
+        for row in range(7, -1, -1):
+            text, empty = '', 0
+            for code in self.squares[row * 8:row * 8 + 8]:
+                if code == 0:
+                    empty += 1
+                    continue
+                if empty:
+                    text, empty = text + str(empty), 0
+                text += LETTERS[code] if code > 0 else LETTERS[-code].lower()
+            rows.append(text + (str(empty) if empty else ''))
+
+        castling = ''.join(char for bit, char in zip((1, 2, 4, 8), 'KQkq') if self.state[CASTLING] & bit) or '-'
+        ep = self.state[ENPASSANT]
+        enpassant = '-' if ep < 0 else chr(ep % 8 + 97) + str(ep // 8 + 1)
+        return ' '.join(['/'.join(rows), 'w' if self.state[TURN] == 1 else 'b', castling, enpassant, str(self.state[HALFMOVE]), '1'])
+
+    def to_game(self, backend = 'objects'):
+        return chess.Game.from_fen(self.fen(), backend)
+
+
+class PositionBatch:
+    def __init__(self, squares, state):
+        self.squares = np.asarray(squares, dtype = np.int8).reshape(-1, 64)
+        self.state = np.asarray(state, dtype = np.int8).reshape(-1, 4)
+
+    @classmethod
+    def from_positions(cls, positions):
+        positions = list(positions)
+        return cls(np.stack([p.squares for p in positions]) if positions else np.zeros((0, 64)),
+                   np.stack([p.state for p in positions]) if positions else np.zeros((0, 4)))
+
+    @classmethod
+    def from_games(cls, games):
+        return cls.from_positions(CompactPosition.from_game(game) for game in games)
+
+    def __len__(self):
+        return len(self.squares)
+
+    def __getitem__(self, index):
+        return CompactPosition(self.squares[index].copy(), self.state[index].copy())
+
+    def counts(self):
+        """(N, 2, 7) piece counts by colour (white, black) and code, column 0 is unused."""
+        codes = np.arange(7)
+        white = (self.squares[:, :, None] == codes).sum(axis = 1)
+        black = (self.squares[:, :, None] == -codes).sum(axis = 1)
+        white[:, 0] = black[:, 0] = 0
+        return np.stack([white, black], axis = 1)
+
+    def material(self):
+        """(N,) material balance in centipawns, positive when white is ahead."""
+        counts = self.counts()
+        return (counts[:, 0] - counts[:, 1]) @ VALUES
+
+    def evaluate(self):
+        """(N,) material plus piece-square score in centipawns from white's point of view."""
+        return EVALUATION[self.squares.astype(np.intp) + 6, np.arange(64)].sum(axis = 1)
+
+    def insufficientmaterial(self):
+        """(N,) bool, same rule as Game.insufficientmaterial: each side has at most a knight or a bishop, or two knights."""
+        counts = self.counts()
+        heavy = counts[:, :, [CODES['P'], CODES['R'], CODES['Q']]].sum(axis = 2)
+        knights, bishops = counts[:, :, CODES['N']], counts[:, :, CODES['B']]
+        alone = (heavy == 0) & ((knights + bishops <= 1) | ((knights == 2) & (bishops == 0)))
+        return alone.all(axis = 1)
+
+    def attacks(self):
+        """(N, 2, 64) number of white and black pieces attacking each square."""
+        squares = self.squares
+        empty = squares == 0
+        result = np.zeros((len(squares), 2, 64), dtype = np.int16)
+
+        for colour, sign in ((0, 1), (1, -1)):
+            def mine(code):
+                return (squares == sign * code).astype(np.int16)
+            result[:, colour] += mine(CODES['P']) @ PAWN_MATRIX[colour]
+            result[:, colour] += mine(CODES['N']) @ KNIGHT_MATRIX
+            result[:, colour] += mine(CODES['K']) @ KING_MATRIX
+
+            queens = squares == sign * CODES['Q']
+            for sliders, steps in ((queens | (squares == sign * CODES['R']), ROOK_STEPS), (queens | (squares == sign * CODES['B']), BISHOP_STEPS)):
+                for direction in steps:
+                    reach = sliders.copy()  # sliders still seeing further along this direction
+                    for distance, (origins, targets, previous) in enumerate(direction):
+                        if distance:
+                            # the ray goes on only through an empty square
+                            through = np.zeros_like(reach)
+                            through[:, origins] = reach[:, origins] & empty[:, previous]
+                            reach = through
+                        hits = np.zeros_like(reach)
+                        hits[:, targets] = reach[:, origins]
+                        result[:, colour] += hits
+        return result
@@ -0,0 +1,287 @@
+"""Engine opponent: iterative deepening alpha-beta on a Game, through push and pop.
+
+Moves are ordered transposition table move first, then captures by most
+valuable victim / least valuable attacker, then killer and history moves.
+Leaves are resolved with a captures-only quiescence search and scored with
+the material and piece-square tables of compactboard.py.
+
+think() is the entry point for a worker process: the bot must never run a
+search on its event loop. analyse() is the one of /analyze, a multi-PV search
+one depth at a time.
+"""
+import time
+import collections
+
+import shitty_chessgamelogic as chess
+import compactboard
+import polyglot
+import tablebase
+
+MATE = 100000
+INFINITY = 1000000
+EXACT, LOWER, UPPER = 0, 1, 2
+VALUES = {'P': 100, 'N': 320, 'B': 330, 'R': 500, 'Q': 900, 'K': 20000}
+
+# SCORES[color, type][square]: material plus piece-square bonus from white's point of view
+SCORES = {(color, type): [int(score) for score in compactboard.EVALUATION[6 + color * code]]
+          for color in (1, -1) for type, code in compactboard.CODES.items()}
+
+SearchResult = collections.namedtuple('SearchResult', 'move notation score depth nodes seconds nps pv source', defaults = ('search',))
+
+class SearchTimeout(Exception):
+    pass
+
+
+def notation(game, move):
+    """SAN of the (origin, to, promote) move, like Nf3, exd8=Q or O-O, also valid Game.playturn input."""
+    return game.san(move)
+
+def iscapture(game, move):
+    origin, to, _ = move
+    return game.board[to] is not None or (game.board[origin].type == 'P' and origin[1] != to[1])
+
+
+class Engine:
+    def __init__(self, tablesize = 1 << 20):
+        self.table = {}  # position key -> (depth, score, flag, best move)
+        self.tablesize = tablesize
+        self.nodes = 0
+        self.deadline = 0
+        self.killers = []
+        self.history = {}
+
+    def evaluate(self, game):
+        """Score of the position for the side to move."""
+        score = 0
+        for piece in game.pieces.flat:
+            if piece is not None:
+                score += SCORES[piece.color, piece.type][piece.pos[0] * 8 + piece.pos[1]]
+        return score * game.turn
+
+    def order(self, game, moves, best, ply):
+        killers = self.killers[ply] if ply < len(self.killers) else ()
+
+        def key(move):
+            if move == best:
+                return -INFINITY
+            origin, to, promote = move
+            if promote:
+                return -VALUES[promote] * 10
+            if iscapture(game, move):
+                victim = game.board[to]
+                return -(VALUES[victim.type] if victim is not None else 100) * 10 + VALUES[game.board[origin].type] // 100
+            if move in killers:
+                return 0
+            return 1 + 1 / (1 + self.history.get(move, 0))
+        return sorted(moves, key = key)
+
+    def quiescence(self, game, alpha, beta, ply):
+        self.nodes += 1
+        standpat = self.evaluate(game)
+        if standpat >= beta:
+            return standpat
+        alpha = max(alpha, standpat)
+
+        game.all_moves()
+        captures = [move for move in game.legal_moves() if move[2] in {None, 'Q'} and (move[2] or iscapture(game, move))]
+        for move in self.order(game, captures, None, ply):
+            game.push(move)
+            score = -self.quiescence(game, -beta, -alpha, ply + 1)
+            game.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def negamax(self, game, depth, alpha, beta, ply):
+        self.nodes += 1
+        if self.nodes & 255 == 0 and (time.perf_counter() > self.deadline or (STOP is not None and STOP.value == JOB)):
+            raise SearchTimeout
+
+        if ply and (game.repetitions.get(game.position_key, 0) >= 2 or game.fiftymoves >= 100):
+            return 0
+
+        best = None
+        entry = self.table.get(game.position_key)
+        if entry is not None:
+            edepth, score, flag, best = entry
+            if ply and edepth >= depth:
+                # mate scores are stored relative to the node
+                score = score - ply if score > MATE // 2 else score + ply if score < -MATE // 2 else score
+                if flag == EXACT or (flag == LOWER and score >= beta) or (flag == UPPER and score <= alpha):
+                    return score
+
+        if depth <= 0:
+            return self.quiescence(game, alpha, beta, ply)
+
+        game.all_moves()
+        moves = game.legal_moves()
+        if not moves:
+            king = game.pieces[{1: 0, -1: 1}[game.turn]][1, 4]
+            return -MATE + ply if king.incheck else 0
+
+        start = alpha
+        bestscore, bestmove = -INFINITY, None
+        for move in self.order(game, moves, best, ply):
+            quiet = not iscapture(game, move) and move[2] is None
+            game.push(move)
+            score = -self.negamax(game, depth - 1, -beta, -alpha, ply + 1)
+            game.pop()
+
+            if score > bestscore:
+                bestscore, bestmove = score, move
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                if quiet:
+                    while len(self.killers) <= ply:
+                        self.killers.append([])
+                    self.killers[ply] = [move] + [killer for killer in self.killers[ply] if killer != move][:1]
+                    self.history[move] = self.history.get(move, 0) + depth * depth
+                break
+
+        flag = UPPER if bestscore <= start else LOWER if bestscore >= beta else EXACT
+        stored = bestscore + ply if bestscore > MATE // 2 else bestscore - ply if bestscore < -MATE // 2 else bestscore
+        if len(self.table) >= self.tablesize:
+            self.table.clear()
+        self.table[game.position_key] = (depth, stored, flag, bestmove)
+        return bestscore
+
+    def principalvariation(self, game, length):
+        pv = []
+        seen = set()
+        while len(pv) < length and game.position_key in self.table and game.position_key not in seen:
+            seen.add(game.position_key)
+            move = self.table[game.position_key][3]
+            if move is None:
+                break
+            game.all_moves()
+            if move not in game.legal_moves():
+                break
+            pv.append(notation(game, move))
+            game.push(move)
+        for _ in pv:
+            game.pop()
+        return pv
+
+    def search(self, game, budget = 5.0, maxdepth = 64):
+        """Searches deeper and deeper until budget seconds are spent, returns the SearchResult of the last full depth."""
+        start = time.perf_counter()
+        self.deadline = start + budget
+        self.nodes = 0
+        self.killers = []
+        self.history = {}
+
+        game.all_moves()
+        moves = game.legal_moves()
+        if not moves:
+            raise chess.InvalidMove
+
+        result = SearchResult(moves[0], notation(game, moves[0]), 0, 0, 0, 0.0, 0.0, [])
+        stack = len(game.stack)
+        for depth in range(1, maxdepth + 1):
+            try:
+                score = self.negamax(game, depth, -INFINITY, INFINITY, 0)
+            except SearchTimeout:
+                while len(game.stack) > stack:
+                    game.pop()
+                break
+            move = self.table[game.position_key][3]
+            seconds = time.perf_counter() - start
+            game.all_moves()
+            result = SearchResult(move, notation(game, move), score, depth, self.nodes, seconds, self.nodes / seconds if seconds else 0.0,
+                                  self.principalvariation(game, depth))
+            if abs(score) > MATE // 2 or len(moves) == 1:
+                break
+
+        seconds = time.perf_counter() - start
+        game.all_moves()
+        return result._replace(nodes = self.nodes, seconds = seconds, nps = self.nodes / seconds if seconds else 0.0)
+
+
+    def multipv(self, game, depth, lines = 3, budget = 10.0):
+        """The best lines of game searched to depth, as SearchResults best first: the best move,
+        then the best of the other moves, and so on. Raises SearchTimeout after budget seconds."""
+        start = time.perf_counter()
+        self.deadline = start + budget
+        self.nodes = 0
+        if depth <= 1:
+            self.killers = []
+            self.history = {}
+
+        game.all_moves()
+        remaining = game.legal_moves()
+        entry = self.table.get(game.position_key)
+        previous = entry[3] if entry is not None else None
+        stack = len(game.stack)
+        results = []
+        try:
+            while remaining and len(results) < lines:
+                bestscore, bestmove = -INFINITY, None
+                for move in self.order(game, remaining, previous, 0):
+                    game.push(move)
+                    score = -self.negamax(game, depth - 1, -INFINITY, -bestscore, 1)
+                    game.pop()
+                    if score > bestscore:
+                        bestscore, bestmove = score, move
+                remaining.remove(bestmove)
+                previous = None
+                game.all_moves()
+                san = notation(game, bestmove)
+                game.push(bestmove)
+                pv = [san] + self.principalvariation(game, depth - 1)
+                game.pop()
+                seconds = time.perf_counter() - start
+                results.append(SearchResult(bestmove, san, bestscore, depth, self.nodes, seconds, self.nodes / seconds if seconds else 0.0, pv))
+        except SearchTimeout:
+            while len(game.stack) > stack:
+                game.pop()
+            raise
+        if results:
+            self.table[game.position_key] = (depth, results[0].score, EXACT, results[0].move)
+        game.all_moves()
+        return results
+
+
+ENGINE = None  # one per worker process, so the transposition table carries over between moves
+STOP = None # shared multiprocessing value of the analysis worker: the search of the job it holds gives up at once
+JOB = 0 # job of the running analyse()
+
+def think(moves, budget = 5.0, fen = None, book = None, tablebases = None, until = None):
+    """Worker process entry point: replays the game's move inputs and searches for budget seconds,
+    unless the Polyglot book at path book or the tablebases in directory tablebases know the position
+    (SearchResult.source tells which). until is the time.time() the search has to be over by, the
+    time the call waited for a free worker comes off the budget."""
+    global ENGINE
+    if until is not None:
+        budget = min(budget, max(until - time.time(), 0.0))
+    if ENGINE is None:
+        ENGINE = Engine()
+    game = chess.Game.from_fen(fen, 'bitboard') if fen else chess.Game('bitboard')
+    for move in moves:
+        game.playturn(move)
+    if book is not None:
+        san = polyglot.openbook(book).choose(game)
+        if san is not None:
+            origin, to, _, promote = game.translate(san)
+            return SearchResult((origin, to, promote), san, 0, 0, 0, 0.0, 0.0, [san], 'book')
+    if tablebases is not None:
+        best = tablebase.bestmove(game, tablebases)
+        if best is not None:
+            move, wdl, dtm = best
+            return SearchResult(move, notation(game, move), wdl * (MATE - dtm) if wdl else 0, dtm, 0, 0.0, 0.0, [notation(game, move)], 'tablebase')
+    return ENGINE.search(game, budget)
+
+def analyse(moves, depth, lines = 3, budget = 10.0, fen = None, job = 0):
+    """Worker process entry point for /analyze: the multipv lines of the position after moves at one depth,
+    None if budget seconds were not enough or STOP was set to job. Asking for depth 1, 2, 3... reuses the worker's table."""
+    global ENGINE, JOB
+    JOB = job
+    if ENGINE is None:
+        ENGINE = Engine()
+    game = chess.Game.from_fen(fen, 'bitboard') if fen else chess.Game('bitboard')
+    for move in moves:
+        game.playturn(move)
+    try:
+        return ENGINE.multipv(game, depth, lines, budget)
+    except SearchTimeout:
+        return None
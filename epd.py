@@ -0,0 +1,147 @@
+"""EPD test suites: streamed, checked across a process pool.
+
+    python epd.py wac.epd                       check that every bm/am move is legal, count the legal moves
+    python epd.py wac.epd --budget 1            also let the engine search 1s per position and compare with bm/am
+    python epd.py perftsuite.epd --failures     print the positions that failed
+    python epd.py wac.epd --json                one JSON line per position
+
+A line is the first four FEN fields followed by operations like
+`bm Nf3 Qd2; am e4; id "WAC.001";`. bm lists the best moves, am the moves to
+avoid, id names the position, hmvc and fmvn give the halfmove clock and move
+number and D1 the number of legal moves. Lines are read lazily, so suites of
+any size stream through the pool with flat memory.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import shitty_chessgamelogic as chess
+import engine
+import pgnstream
+
+OPERATION = re.compile(r'\s*([A-Za-z]\w*)((?:\s+(?:"[^"]*"|[^\s;"]+))*)\s*;')
+OPERAND = re.compile(r'"([^"]*)"|([^\s;"]+)')
+
+EPDPosition = collections.namedtuple('EPDPosition', 'index fen operations')
+EPDResult = collections.namedtuple('EPDResult', 'index id fen legal best expected avoid ok error')
+
+
+def parse(line, index = 0):
+    """EPDPosition of one EPD line, operations maps each opcode to its list of operands."""
+    fields = line.split(None, 4)
+    if len(fields) < 4:
+        raise chess.ParseError
+    operations = {}
+    for match in OPERATION.finditer(fields[4] if len(fields) > 4 else ''):
+        operations[match.group(1)] = [quoted or bare for quoted, bare in OPERAND.findall(match.group(2))]
+    halfmove = (operations.get('hmvc') or ['0'])[0]
+    fullmove = (operations.get('fmvn') or ['1'])[0]
+    return EPDPosition(index, ' '.join(fields[:4] + [halfmove, fullmove]), operations)
+
+def read_positions(lines):
+    """Yields an EPDPosition for every EPD line of an iterable of lines, skipping blank and # lines.
+    A line that does not parse comes with the raw line as fen and None operations, evaluate() fails it."""
+    index = 0
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            try:
+                yield parse(line, index)
+            except chess.ParseError:
+                yield EPDPosition(index, line, None)
+            index += 1
+
+def read_file(path):
+    with open(path, encoding = 'utf-8-sig', errors = 'replace') as file:
+        yield from read_positions(file)
+
+
+def evaluate(position, budget = 0.0):
+    """Checks one EPDPosition: its bm/am moves must be legal, D1 must match the legal move count,
+    and with a budget the engine's choice must be a bm move and not an am move."""
+    if position.operations is None:
+        return EPDResult(position.index, str(position.index + 1), position.fen, None, None, [], [], False, 'not an EPD line, fewer than four fields')
+    name = (position.operations.get('id') or [str(position.index + 1)])[0]
+    legal = best = None
+    expected, avoid = [], []
+    try:
+        game = chess.Game.from_fen(position.fen, 'bitboard')
+        game.all_moves()
+        legal = len(game.legal_moves())
+        if 'D1' in position.operations and int(position.operations['D1'][0]) != legal:
+            raise ValueError('{} legal moves, D1 says {}'.format(legal, position.operations['D1'][0]))
+        for opcode, moves in (('bm', expected), ('am', avoid)):
+            for move in position.operations.get(opcode, []):
+                try:
+                    moves.append(game.translate(move)[2])
+                except (chess.InvalidMove, chess.AmbiguousMove, chess.ParseError) as e:
+                    raise ValueError('{} {}: {}'.format(opcode, move, type(e).__name__))
+        if budget and legal:
+            best = engine.think([], budget, position.fen).notation
+    except (chess.ParseError, ValueError) as e:
+        return EPDResult(position.index, name, position.fen, legal, best, expected, avoid, False, str(e) or type(e).__name__)
+
+    ok = best is None or ((not expected or best in expected) and best not in avoid)
+    return EPDResult(position.index, name, position.fen, legal, best, expected, avoid, ok, None)
+
+def evaluate_batch(positions, budget = 0.0):
+    return [evaluate(position, budget) for position in positions]
+
+def evaluate_all(positions, workers = None, budget = 0.0, batch = 16):
+    """Evaluates positions (any iterable, consumed lazily) on a pool of workers processes and yields
+    EPDResults in input order, like pgnstream.replay_all. workers = 0 stays in this process."""
+    if workers == 0:
+        for chunk in pgnstream.batches(positions, batch):
+            yield from evaluate_batch(chunk, budget)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for chunk in pgnstream.batches(positions, batch):
+            pending.append(pool.submit(evaluate_batch, chunk, budget))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Run EPD test suites (bm/am/id/D1) against the move generator and the engine.')
+    parser.add_argument('files', nargs = '+')
+    parser.add_argument('--budget', type = float, default = 0.0, help = 'seconds of engine search per position, 0 to only check the moves')
+    parser.add_argument('--workers', type = int, help = 'worker processes, defaults to the number of cores, 0 to stay in process')
+    parser.add_argument('--batch', type = int, help = 'positions sent to a worker at once (default 16, 1 with a budget)')
+    parser.add_argument('--failures', action = 'store_true', help = 'print every position that failed')
+    parser.add_argument('--json', action = 'store_true', help = 'print one JSON line per position')
+    args = parser.parse_args(argv)
+
+    def positions():
+        for path in args.files:
+            yield from read_file(path)
+
+    start = time.perf_counter()
+    count = passed = errors = 0
+    for result in evaluate_all(positions(), args.workers, args.budget, args.batch or (1 if args.budget else 16)):
+        count += 1
+        passed += result.ok
+        errors += result.error is not None
+        if args.json:
+            print(json.dumps(result._asdict()))
+        elif args.failures and not result.ok:
+            print('{}: {}'.format(result.id, result.error or 'played {}, bm {} am {}'.format(result.best, ' '.join(result.expected) or '-', ' '.join(result.avoid) or '-')))
+    seconds = time.perf_counter() - start
+
+    if not args.json:
+        print('{} positions, {} passed ({:.1f}%), {} errors in {:.2f}s: {:.1f} positions/s'.format(
+            count, passed, 100 * passed / count if count else 0.0, errors, seconds, count / seconds if seconds else 0.0))
+    return 0 if passed == count else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
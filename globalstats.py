@@ -0,0 +1,107 @@
+"""Results and leaderboards shared by every process of the bot.
+
+When the bot runs as several shard processes (supervisor.py), each one only
+sees its own guilds' games, so anything counted across games goes through a
+store all of them can reach: Stats keeps it in SQLite next to the games (WAL
+mode, one connection per process, writes are idempotent per game). MemoryStats
+has the same coroutines on plain dicts, to stand in for it in tests or a single
+throwaway process.
+
+    await stats.record(game_id, guild_id, result, plies, {player_id: (color, moves)})
+    await stats.leaderboard(guild_id)   # [(player_id, wins, draws, losses, moves)]
+    await stats.totals(guild_id)        # {'games', 'white', 'black', 'draws', 'plies'}
+"""
+import time
+import sqlite3
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+BUSY_TIMEOUT = 30.0 # seconds to wait for another process's write
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    game INTEGER PRIMARY KEY, guild INTEGER,
+    result INTEGER, -- 1 white won, -1 black won, 0 draw
+    plies INTEGER, finished REAL
+);
+CREATE TABLE IF NOT EXISTS players (
+    guild INTEGER, player INTEGER,
+    wins INTEGER DEFAULT 0, draws INTEGER DEFAULT 0, losses INTEGER DEFAULT 0, moves INTEGER DEFAULT 0,
+    PRIMARY KEY (guild, player)
+);
+'''
+
+
+def scores(result, color):
+    """(wins, draws, losses) of a player of color in a game that ended with result."""
+    if result == 0:
+        return 0, 1, 0
+    return (1, 0, 0) if result == color else (0, 0, 1)
+
+
+class Stats:
+    def __init__(self, path = 'chessbot.sqlite3'):
+        self.connection = sqlite3.connect(path, timeout = BUSY_TIMEOUT, check_same_thread = False, isolation_level = None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        self.executor = ThreadPoolExecutor(max_workers = 1)
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def record(self, game, guild, result, plies, players):
+        try:
+            await self.run(self.insert, game, guild, result, plies, players)
+        except sqlite3.Error as e:
+            print('Could not record game', game, e)
+
+    def insert(self, game, guild, result, plies, players):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # a game finished again after a restart is only counted once
+            if connection.execute('INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?)', (game, guild, result, plies, time.time())).rowcount:
+                for player, (color, moves) in players.items():
+                    wins, draws, losses = scores(result, color)
+                    connection.execute('INSERT OR IGNORE INTO players (guild, player) VALUES (?, ?)', (guild, player))
+                    connection.execute('UPDATE players SET wins = wins + ?, draws = draws + ?, losses = losses + ?, moves = moves + ? WHERE guild = ? AND player = ?',
+                                       (wins, draws, losses, moves, guild, player))
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    async def leaderboard(self, guild, limit = 10):
+        return await self.run(lambda: self.connection.execute(
+            'SELECT player, wins, draws, losses, moves FROM players WHERE guild = ? ORDER BY wins DESC, draws DESC, losses, moves DESC LIMIT ?', (guild, limit)).fetchall())
+
+    async def totals(self, guild):
+        games, white, black, draws, plies = await self.run(lambda: self.connection.execute(
+            'SELECT count(*), total(result = 1), total(result = -1), total(result = 0), total(plies) FROM results WHERE guild = ?', (guild,)).fetchone())
+        return {'games': games, 'white': int(white), 'black': int(black), 'draws': int(draws), 'plies': int(plies)}
+
+
+class MemoryStats:
+    """Stats in this process's memory, same interface."""
+    def __init__(self):
+        self.results = {} # game: (guild, result, plies)
+        self.players = {} # (guild, player): [wins, draws, losses, moves]
+
+    async def record(self, game, guild, result, plies, players):
+        if game in self.results:
+            return
+        self.results[game] = (guild, result, plies)
+        for player, (color, moves) in players.items():
+            row = self.players.setdefault((guild, player), [0, 0, 0, 0])
+            for i, score in enumerate(scores(result, color) + (moves,)):
+                row[i] += score
+
+    async def leaderboard(self, guild, limit = 10):
+        rows = [(player, *row) for (g, player), row in self.players.items() if g == guild]
+        rows.sort(key = lambda row: (-row[1], -row[2], row[3], -row[4]))
+        return rows[:limit]
+
+    async def totals(self, guild):
+        results = [(result, plies) for g, result, plies in self.results.values() if g == guild]
+        return {'games': len(results), 'white': sum(1 for result, _ in results if result == 1), 'black': sum(1 for result, _ in results if result == -1),
+                'draws': sum(1 for result, _ in results if result == 0), 'plies': sum(plies for _, plies in results)}
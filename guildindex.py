@@ -0,0 +1,175 @@
+"""The chessbot roles and channels of each guild, by ID.
+
+Looking them up with disnake.utils.get scans every role or channel of the
+guild by name. GuildIndex scans a guild once, keeps the IDs of what it found
+and follows the channel and role events to stay right, so a lookup is a dict
+access followed by guild.get_role / guild.get_channel.
+
+install() creates whatever is missing (a partial install is repaired, a
+complete one is left alone) and uninstall() deletes everything, both with the
+API calls running concurrently; disnake's HTTP client holds them back to the
+rate limits of each route.
+"""
+import asyncio
+
+import disnake
+
+# kind: (name, colour)
+ROLES = {'white': ("chessbot team white", (255, 255, 255)), 'black': ("chessbot team black", (1, 1, 1))}
+# kind: (name, channel type), names as Discord stores them (text channels get dashes)
+CATEGORY = ("chessbot gameroom", disnake.ChannelType.category)
+CHANNELS = {'category': CATEGORY,
+            'lobby': ("chessbot-lobby", disnake.ChannelType.text),
+            'white text': ("chessbot-team-white", disnake.ChannelType.text),
+            'white voice': ("chessbot team white", disnake.ChannelType.voice),
+            'black text': ("chessbot-team-black", disnake.ChannelType.text),
+            'black voice': ("chessbot team black", disnake.ChannelType.voice)}
+CONCURRENCY = 5 # API calls of one install or uninstall in flight at once
+REASON = "chessbot setup"
+
+ROLENAMES = {name: kind for kind, (name, _) in ROLES.items()}
+CHANNELNAMES = {spec: kind for kind, spec in CHANNELS.items()}
+
+
+class GuildResources:
+    def __init__(self):
+        self.roles = {} # kind: role id
+        self.channels = {} # kind: channel id
+
+    def addrole(self, role):
+        kind = ROLENAMES.get(role.name)
+        if kind is not None:
+            self.roles.setdefault(kind, role.id)
+
+    def addchannel(self, channel):
+        kind = CHANNELNAMES.get((channel.name, channel.type))
+        if kind is not None:
+            self.channels.setdefault(kind, channel.id)
+
+    def discard(self, id):
+        for ids in (self.roles, self.channels):
+            for kind in [kind for kind, known in ids.items() if known == id]:
+                del ids[kind]
+
+
+class GuildIndex:
+    def __init__(self):
+        self.guilds = {} # guild id: GuildResources
+
+    def resources(self, guild):
+        if guild.id not in self.guilds:
+            resources = GuildResources()
+            for role in guild.roles:
+                resources.addrole(role)
+            for channel in guild.channels:
+                resources.addchannel(channel)
+            self.guilds[guild.id] = resources
+        return self.guilds[guild.id]
+
+    def role(self, guild, kind):
+        id = self.resources(guild).roles.get(kind)
+        return guild.get_role(id) if id is not None else None
+
+    def channel(self, guild, kind):
+        id = self.resources(guild).channels.get(kind)
+        return guild.get_channel(id) if id is not None else None
+
+    def teams(self, guild):
+        """[white role, black role]"""
+        return [self.role(guild, 'white'), self.role(guild, 'black')]
+
+    # events, only guilds already indexed need to follow them
+
+    def attach(self, bot):
+        bot.add_listener(self.created, 'on_guild_channel_create')
+        bot.add_listener(self.created, 'on_guild_role_create')
+        bot.add_listener(self.deleted, 'on_guild_channel_delete')
+        bot.add_listener(self.deleted, 'on_guild_role_delete')
+        bot.add_listener(self.updated, 'on_guild_channel_update')
+        bot.add_listener(self.updated, 'on_guild_role_update')
+        bot.add_listener(self.forget, 'on_guild_remove')
+        bot.add_listener(self.forget, 'on_guild_available') # back after an outage, scan it again
+
+    async def created(self, item):
+        resources = self.guilds.get(item.guild.id)
+        if resources is not None:
+            if isinstance(item, disnake.Role):
+                resources.addrole(item)
+            else:
+                resources.addchannel(item)
+
+    async def deleted(self, item):
+        resources = self.guilds.get(item.guild.id)
+        if resources is not None:
+            resources.discard(item.id)
+
+    async def updated(self, before, after):
+        await self.deleted(before)
+        await self.created(after)
+
+    async def forget(self, guild):
+        self.guilds.pop(guild.id, None)
+
+    # install and uninstall
+
+    async def install(self, guild, overwrites):
+        """Creates the missing roles and channels, returns how many it created.
+        overwrites(role) gives the permission overwrites of a team's channels."""
+        resources = self.resources(guild)
+        limit = asyncio.Semaphore(CONCURRENCY)
+        async def call(coroutine):
+            async with limit:
+                return await coroutine
+
+        roles = await asyncio.gather(*(call(guild.create_role(name = ROLES[kind][0], colour = disnake.Colour.from_rgb(*ROLES[kind][1]), reason = REASON))
+                                       for kind in ROLES if self.role(guild, kind) is None))
+        for role in roles:
+            resources.addrole(role)
+        created = len(roles)
+        fresh = {role.id for role in roles}
+
+        category = self.channel(guild, 'category')
+        if category is None:
+            category = await guild.create_category_channel(name = CATEGORY[0], reason = REASON)
+            resources.addchannel(category)
+            created += 1
+
+        async def channel(kind):
+            name, type = CHANNELS[kind]
+            existing = self.channel(guild, kind)
+            team = self.role(guild, kind.split()[0]) if kind != 'lobby' else None
+            if existing is not None:
+                changes = {}
+                if existing.category_id != category.id: # moved out by hand, put it back
+                    changes['category'] = category
+                if team is not None and team.id in fresh: # its role was deleted and made again
+                    changes['overwrites'] = overwrites(team)
+                if changes:
+                    await call(existing.edit(reason = REASON, **changes))
+                return None
+            options = {'name': name, 'category': category, 'reason': REASON}
+            if team is not None:
+                options['overwrites'] = overwrites(team)
+            if type == disnake.ChannelType.voice:
+                return await call(guild.create_voice_channel(**options))
+            return await call(guild.create_text_channel(**options))
+        for new in await asyncio.gather(*(channel(kind) for kind in CHANNELS if kind != 'category')):
+            if new is not None:
+                resources.addchannel(new)
+                created += 1
+        return created
+
+    async def uninstall(self, guild):
+        """Deletes every chessbot role and channel of guild, duplicates left by old installs too, returns how many."""
+        items = [channel for channel in guild.channels if (channel.name, channel.type) in CHANNELNAMES]
+        items += [role for role in guild.roles if role.name in ROLENAMES]
+        limit = asyncio.Semaphore(CONCURRENCY)
+        async def delete(item):
+            async with limit:
+                try:
+                    await item.delete(reason = "chessbot cleanup")
+                except disnake.NotFound:
+                    pass
+        await asyncio.gather(*(delete(item) for item in items))
+        self.guilds.pop(guild.id, None)
+        return len(items)
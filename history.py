@@ -0,0 +1,147 @@
+"""The move history of a game in one message, with buttons to step through it.
+
+Each game has a single message in its history thread with first / previous /
+next / last buttons and a menu to jump to a move; the board of the ply asked
+for is drawn when someone asks for it, instead of the game posting or editing
+a message full of links to its boards after every move.
+
+A History keeps the moves as Polyglot codes, two bytes each, and a FEN
+snapshot every SNAPSHOT_EVERY plies: showing a ply sets up the snapshot
+before it and plays at most SNAPSHOT_EVERY moves. Snapshots are taken while
+seeking, so playing a move only appends its code.
+
+The message is posted once, at the start of the game, and never edited: its
+forward buttons are always enabled and stop at the latest move at the time of
+the click. The buttons carry the game id and the ply they lead to in their
+custom_id, nothing is kept per message: the buttons of a game keep working
+once it is over and after a restart, its moves are then read back from the
+store.
+"""
+import io
+import array
+import collections
+
+import disnake
+
+import shitty_chessgamelogic as chess
+import polyglot
+
+SNAPSHOT_EVERY = 10 # plies
+CACHE_SIZE = 64 # histories of games that are over
+PREFIX = 'history'
+INTRO = "Use the buttons to replay this game move by move."
+
+
+class History:
+    def __init__(self, sans, moves = ()):
+        """sans is the SAN list of the game, the live game.history of a running one."""
+        self.sans = sans
+        self.moves = array.array('H', (polyglot.encode(move) for move in moves))
+        self.snapshots = {0: None} # ply: FEN, None for the starting position
+
+    def __len__(self):
+        return len(self.moves)
+
+    def append(self, move):
+        """Records the (origin, to, promote) move just played."""
+        self.moves.append(polyglot.encode(move))
+
+    @classmethod
+    def replay(cls, sans):
+        """History of a game given by its SAN moves, raises the chess exceptions if they do not replay."""
+        game = chess.Game('bitboard')
+        history = cls(sans)
+        for ply, san in enumerate(sans):
+            if ply % SNAPSHOT_EVERY == 0 and ply:
+                history.snapshots[ply] = game.fen()
+            game.all_moves()
+            game.playturn(san)
+            history.append(game.stack[-1][0])
+        return history
+
+    def position(self, ply):
+        """chess.Game after ply moves, all_moves done. At least one move is played from the snapshot, for the last move highlight."""
+        start = (ply - 1) // SNAPSHOT_EVERY * SNAPSHOT_EVERY if ply else 0
+        while start not in self.snapshots:
+            start -= SNAPSHOT_EVERY
+        fen = self.snapshots[start]
+        game = chess.Game('bitboard') if fen is None else chess.Game.from_fen(fen, 'bitboard')
+        for i in range(start, ply):
+            if i % SNAPSHOT_EVERY == 0 and i not in self.snapshots:
+                self.snapshots[i] = game.fen()
+            game.push(polyglot.decode(self.moves[i]))
+        game.all_moves()
+        return game
+
+    def label(self, ply):
+        if ply == 0:
+            return "Starting position"
+        return '{}{} {}'.format((ply + 1) // 2, '.' if ply % 2 else '...', self.sans[ply - 1])
+
+
+def controls(game, ply, history):
+    """Buttons and jump menu of the history message of game showing ply of its History.
+    The forward buttons stay enabled, the game may have gone on since they were drawn: clicked() clamps their ply."""
+    last = len(history)
+    def button(label, action, target, disabled):
+        return disnake.ui.Button(label = label, style = disnake.ButtonStyle.grey, disabled = disabled,
+                                 custom_id = '{}:{}:{}:{}'.format(PREFIX, game, action, target))
+    buttons = [button("<<", 'first', 0, ply == 0), button("<", 'previous', max(ply - 1, 0), ply == 0),
+               button(">", 'next', ply + 1, False), button(">>", 'last', last, False)]
+    # the menu holds at most 25 options, long games get evenly spaced ones
+    targets = sorted(set(round(i * last / 24) for i in range(25))) if last > 24 else range(last + 1)
+    return [disnake.ui.ActionRow(*buttons)] + ([disnake.ui.ActionRow(disnake.ui.Select(
+        custom_id = '{}:{}:jump:'.format(PREFIX, game), placeholder = "Jump to a move",
+        options = [disnake.SelectOption(label = history.label(target), value = str(target), default = target == ply) for target in targets]))] if last else [])
+
+
+class HistoryViewer:
+    """Answers the buttons and menus of every history message, attach() it to the bot."""
+    def __init__(self, registry, store, renderer):
+        self.registry = registry
+        self.store = store
+        self.renderer = renderer
+        self.cache = collections.OrderedDict() # game id: History of a game that is over
+
+    def attach(self, bot):
+        bot.add_listener(self.clicked, 'on_button_click')
+        bot.add_listener(self.clicked, 'on_dropdown')
+
+    async def history(self, game):
+        session = self.registry.get(game)
+        if session is not None:
+            return session.history
+        if game in self.cache:
+            self.cache.move_to_end(game)
+            return self.cache[game]
+        sans = await self.store.moves(game)
+        if sans is None:
+            return None
+        try:
+            history = History.replay(sans)
+        except (chess.InvalidMove, chess.AmbiguousMove, chess.ParseError):
+            return None
+        self.cache[game] = history
+        if len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last = False)
+        return history
+
+    async def clicked(self, interaction):
+        if not interaction.data.custom_id.startswith(PREFIX + ':'):
+            return
+        _, game, action, ply = interaction.data.custom_id.split(':')
+        game = int(game)
+        history = await self.history(game)
+        if history is None:
+            await interaction.response.send_message("This game's moves are gone.", ephemeral = True)
+            return
+        ply = int(interaction.values[0] if action == 'jump' else ply)
+        if action == 'last' or ply > len(history):
+            ply = len(history) # the game went on since these buttons were drawn
+        board = history.position(ply)
+        png = await self.renderer.png(board)
+
+        embed = disnake.Embed(title = history.label(ply), description = "Ply {} of {}".format(ply, len(history)))
+        embed.set_image(url = "attachment://board.png")
+        await interaction.response.edit_message(content = None, embed = embed, file = disnake.File(io.BytesIO(png), filename = "board.png"),
+                                                attachments = [], components = controls(game, ply, history))
@@ -0,0 +1,458 @@
+"""Load test: N scripted games at once through the real session code, no network.
+
+    python loadtest.py --games 10,50,100,200          random games, one line per N
+    python loadtest.py --pgn archive.pgn --games 100  replay the games of a PGN corpus
+    python loadtest.py --games 200 --unpaced          lift the outbox rate limits, to find the CPU ceiling
+    python loadtest.py --games 100 --store            also save the games, stats and archive (temporary database)
+    python loadtest.py --clockrace                    check a move made just in time never flags the opponent
+
+FakeBot and the Fake* channels, messages, members and roles stand in for the
+part of disnake the bot uses (send, create_thread, edit, pin, wait_for, roles
+and channels), answering every request after --latency seconds. Each game is
+started like /playchess does and its moves are sent as messages of the team
+members, dispatched to the registry the way the on_message listener does it;
+a share of them (--invalid) are replaced by an illegal, ambiguous or
+unreadable move first. A player waits for the board of their move before
+thinking about the next one, so the bot sees the traffic real players make.
+
+For each N it reports the moves per second, the time from a move's message to
+its board being posted (p50/p95/p99), how late the event loop wakes up a
+sleeping task, and the resident memory added per running game.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+import collections
+
+import shitty_chessgamelogic as chess
+import sessions
+import outbox
+import render
+import pgnstream
+import storage
+import globalstats
+import archive
+import clocks
+
+LATENCY = 0.05 # seconds the fake Discord takes to answer a request
+THINK = 1.0 # mean seconds a player thinks before sending a move
+INVALID = 0.05 # share of moves sent wrong first
+PLIES = 80 # length of the random games
+LAG_INTERVAL = 0.05 # seconds between event loop lag samples
+WAIT = 60.0 # seconds a player waits for the bot's answer before giving up
+
+ids = itertools.count(10 ** 17) # snowflake sized
+
+
+# the fake gateway
+
+class FakeRole:
+    def __init__(self, guild, name):
+        self.id = next(ids)
+        self.guild = guild
+        self.name = name
+
+class FakeMember:
+    def __init__(self, guild, name, roles):
+        self.id = next(ids)
+        self.guild = guild
+        self.name = self.display_name = name
+        self.roles = roles
+        self.bot = False
+        self.mention = '<@{}>'.format(self.id)
+
+class FakeMessage:
+    def __init__(self, channel, author = None, content = None, embed = None, view = None):
+        self.id = next(ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.view = view
+        self.pinned = False
+        self.jump_url = 'https://discord.com/channels/{}/{}/{}'.format(channel.guild.id, channel.id, self.id)
+
+    async def edit(self, **kwargs):
+        await self.channel.gateway.request()
+        for name in ('content', 'embed', 'view'):
+            if name in kwargs:
+                setattr(self, name, kwargs[name])
+        return self
+
+    async def pin(self):
+        await self.channel.gateway.request()
+        self.pinned = True
+
+class FakeChannel:
+    def __init__(self, gateway, guild, name, parent = None):
+        self.gateway = gateway
+        self.id = next(ids)
+        self.guild = guild
+        self.name = name
+        self.parent = parent
+        self.messages = collections.deque(maxlen = 50) # recent ones, for fetch_message
+        self.expected = [] # (check, future) waiting for the bot to send a message here
+        self.sent = 0
+        gateway.channels[self.id] = self
+
+    async def send(self, content = None, embed = None, view = None, file = None, **kwargs):
+        await self.gateway.request()
+        message = FakeMessage(self, self.gateway.user, content, embed, view)
+        self.messages.append(message)
+        self.sent += 1
+        for waiting in list(self.expected):
+            check, future = waiting
+            if not future.done() and check(message):
+                future.set_result(message)
+                self.expected.remove(waiting)
+        return message
+
+    async def create_thread(self, name, message = None, **kwargs):
+        await self.gateway.request()
+        return FakeChannel(self.gateway, self.guild, name, self)
+
+    async def fetch_message(self, id):
+        await self.gateway.request()
+        for message in self.messages:
+            if message.id == id:
+                return message
+        raise LookupError(id)
+
+    def expect(self, check):
+        """Future of the next message the bot sends here that check accepts."""
+        future = asyncio.get_running_loop().create_future()
+        self.expected.append((check, future))
+        return future
+
+    def forget(self, future):
+        self.expected = [(check, waiting) for check, waiting in self.expected if waiting is not future]
+
+class FakeGuild:
+    def __init__(self, gateway, name):
+        self.gateway = gateway
+        self.id = next(ids)
+        self.name = name
+        self.roles = []
+        self.channels = []
+        self.members = []
+
+    def get_role(self, id):
+        return next((role for role in self.roles if role.id == id), None)
+
+    def get_channel(self, id):
+        return next((channel for channel in self.channels if channel.id == id), None)
+
+    async def create_role(self, name, **kwargs):
+        await self.gateway.request()
+        role = FakeRole(self, name)
+        self.roles.append(role)
+        return role
+
+    async def create_text_channel(self, name, **kwargs):
+        await self.gateway.request()
+        channel = FakeChannel(self.gateway, self, name)
+        self.channels.append(channel)
+        return channel
+
+    def member(self, name, roles):
+        member = FakeMember(self, name, roles)
+        self.members.append(member)
+        return member
+
+class FakeBot:
+    """The bot side of the gateway: the listeners and waiters of events, and the requests counted and delayed."""
+    def __init__(self, latency = LATENCY):
+        self.latency = latency
+        self.user = FakeMember(None, 'chessbot', [])
+        self.user.bot = True
+        self.channels = {}
+        self.listeners = collections.defaultdict(list)
+        self.waiters = collections.defaultdict(list)
+        self.requests = 0
+
+    async def request(self):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+    def add_listener(self, function, name):
+        self.listeners[name].append(function)
+
+    def listen(self, name):
+        def decorator(function):
+            self.add_listener(function, name)
+            return function
+        return decorator
+
+    def get_channel(self, id):
+        return self.channels.get(id)
+
+    async def fetch_channel(self, id):
+        await self.request()
+        return self.channels[id]
+
+    def dispatch(self, event, *args):
+        """Runs every on_event listener in its own task, like disnake, and wakes the wait_for of event."""
+        loop = asyncio.get_running_loop()
+        for listener in self.listeners['on_' + event]:
+            loop.create_task(listener(*args))
+        for waiting in list(self.waiters[event]):
+            check, future = waiting
+            if not future.done() and (check is None or check(*args)):
+                future.set_result(args[0] if len(args) == 1 else args)
+                self.waiters[event].remove(waiting)
+
+    async def wait_for(self, event, check = None, timeout = None):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[event].append((check, future))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.waiters[event] = [waiting for waiting in self.waiters[event] if waiting[1] is not future]
+
+    def fakeguild(self, name):
+        guild = FakeGuild(self, name)
+        guild.roles = [FakeRole(guild, "chessbot team white"), FakeRole(guild, "chessbot team black")]
+        guild.channels = [FakeChannel(self, guild, "chessbot-lobby")]
+        return guild
+
+
+# scripts
+
+def wrongmove(board, rng):
+    """A move the bot has to reject in the position of board: ambiguous when there is one, else illegal or unreadable."""
+    table = board.santable()
+    ambiguous = [key for key, move in table.items() if move is None]
+    kind = rng.random()
+    if ambiguous and kind < 0.4:
+        return rng.choice(ambiguous)
+    if kind < 0.8:
+        for _ in range(20):
+            move = rng.choice('KQRBN') + rng.choice('abcdefgh') + rng.choice('12345678')
+            if chess.sankey(move) not in table:
+                return move
+    return rng.choice(['hello', 'O-O-O-O', 'Zz9', 'gg'])
+
+def script(moves, rng, invalid = INVALID):
+    """[(ply, text, whether the bot takes it)] to send for a game of SAN moves, with wrong moves slipped in.
+    Stops before the first move that does not replay."""
+    board = chess.Game('bitboard')
+    steps = []
+    for ply, move in enumerate(moves):
+        board.checkgamestatus()
+        if board.game_status:
+            break
+        if rng.random() < invalid:
+            steps.append((ply, wrongmove(board, rng), False))
+        try:
+            board.playturn(move)
+        except (chess.InvalidMove, chess.AmbiguousMove, chess.ParseError):
+            break
+        steps.append((ply, move, True))
+    return steps
+
+def randomgame(rng, plies = PLIES):
+    board = chess.Game('bitboard')
+    moves = []
+    for _ in range(plies):
+        board.checkgamestatus()
+        if board.game_status:
+            break
+        board.santable()
+        move = rng.choice(sorted(board.sanmoves.values()))
+        board.playturn(move)
+        moves.append(move)
+    return moves
+
+def corpus(count, rng, paths = None, plies = PLIES):
+    """count SAN move lists: the main lines of the PGN files, cycled, or random games."""
+    if not paths:
+        return [randomgame(rng, plies) for _ in range(count)]
+    games = []
+    for path in paths:
+        for game in pgnstream.read_file(path):
+            games.append(game.mainline.moves)
+            if len(games) == count:
+                return games
+    return [games[i % len(games)] for i in range(count)] if games else []
+
+
+# measuring
+
+def rss():
+    """Resident memory of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+class Sampler:
+    """Event loop lag and peak memory, sampled every LAG_INTERVAL seconds."""
+    def __init__(self):
+        self.lags = []
+        self.peak = rss()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lags.append(max(loop.time() - start - LAG_INTERVAL, 0.0))
+            self.peak = max(self.peak, rss())
+
+
+# the driver
+
+async def play(bot, registry, guild, name, steps, think, rng, results, store):
+    lobby = guild.channels[0]
+    white = guild.member(name + ' white', [guild.roles[0]])
+    black = guild.member(name + ' black', [guild.roles[1]])
+    session = sessions.Session(chess.Game('bitboard'), lobby, guild.roles, None, store)
+    await session.start(name, registry)
+    channel = session.channel
+    played = sum(1 for _, _, legal in steps if legal)
+    for ply, text, legal in steps + [(played, 'resign', True)]:
+        if session.game.game_status:
+            break
+        await asyncio.sleep(rng.uniform(0, 2 * think))
+        if legal and text != 'resign':
+            answer = channel.expect(lambda message: message.embed is not None)
+        else:
+            answer = channel.expect(lambda message: message.embed is None and message.content)
+        message = FakeMessage(channel, (white, black)[ply % 2], text)
+        start = time.perf_counter()
+        bot.dispatch('message', message)
+        try:
+            await asyncio.wait_for(answer, WAIT)
+        except asyncio.TimeoutError:
+            channel.forget(answer)
+            results['timeouts'] += 1
+            continue
+        if text == 'resign':
+            continue
+        if legal:
+            results['latencies'].append(time.perf_counter() - start)
+            results['moves'] += 1
+        else:
+            results['rejected'] += 1
+    results['games'] += 1
+
+async def level(count, scripts, options):
+    """Plays count games at once, returns what was measured."""
+    # a fresh outbox and board cache for each level, so one does not warm up the next
+    if options.unpaced:
+        sessions.outgoing = outbox.Outbox(rate = 10 ** 6, per = 1.0, global_rate = 10 ** 6)
+    else:
+        sessions.outgoing = outbox.Outbox()
+    sessions.renderer = render.BoardRenderer()
+    sessions.scheduler = clocks.Scheduler()
+    bot = FakeBot(options.latency)
+    registry = sessions.SessionRegistry()
+    bot.add_listener(registry.dispatch, 'on_message')
+    guilds = [bot.fakeguild('guild {}'.format(i)) for i in range(max(1, count // 25))]
+
+    store = None
+    if options.store:
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, 'loadtest.sqlite3')
+        store = storage.GameStore(path)
+        store.start()
+        sessions.STATS = globalstats.Stats(path)
+        sessions.ARCHIVE = archive.Archive(path)
+
+    rng = random.Random(options.seed)
+    results = {'moves': 0, 'rejected': 0, 'timeouts': 0, 'games': 0, 'latencies': []}
+    sampler = Sampler()
+    baseline = sampler.peak
+    sampling = asyncio.get_running_loop().create_task(sampler.run())
+    start = time.perf_counter()
+    await asyncio.gather(*(play(bot, registry, guilds[i % len(guilds)], 'game {}'.format(i), scripts[i % len(scripts)], options.think, random.Random(rng.random()), results, store)
+                           for i in range(count)))
+    seconds = time.perf_counter() - start
+    sampling.cancel()
+
+    if store is not None:
+        await store.flush()
+        sessions.STATS = sessions.ARCHIVE = None
+        directory.cleanup()
+    latencies = sorted(results['latencies'])
+    lags = sorted(sampler.lags)
+    stats = sessions.outgoing.stats()
+    return {'name': 'loadtest', 'games': count, 'moves': results['moves'], 'rejected': results['rejected'], 'timeouts': results['timeouts'],
+            'seconds': seconds, 'moves_per_second': results['moves'] / seconds if seconds else 0.0,
+            'latency_p50': percentile(latencies, 0.5), 'latency_p95': percentile(latencies, 0.95), 'latency_p99': percentile(latencies, 0.99),
+            'lag_p50': percentile(lags, 0.5), 'lag_p99': percentile(lags, 0.99), 'lag_max': lags[-1] if lags else 0.0,
+            'memory_per_game': (sampler.peak - baseline) / count, 'requests': bot.requests,
+            'coalesced': stats['coalesced'], 'merged': stats['merged']}
+
+async def clockrace(latency):
+    """Plays White's first move with 0.2 seconds left while the board takes latency seconds to post:
+    True if the game goes on, the flag fall of White's deadline must not land on Black."""
+    sessions.outgoing = outbox.Outbox(rate = 10 ** 6, per = 1.0, global_rate = 10 ** 6)
+    sessions.scheduler = clocks.Scheduler()
+    bot = FakeBot(latency)
+    registry = sessions.SessionRegistry()
+    guild = bot.fakeguild('clocks')
+    white = guild.member('white', [guild.roles[0]])
+    session = sessions.Session(chess.Game('bitboard'), guild.channels[0], guild.roles, None, None, clocks.Clock(clocks.TimeControl(3, 0, 0)))
+    await session.start('clock race', registry)
+    await asyncio.sleep(max(session.clock.left(1) - 0.2, 0))
+    error = await session.submit(white, 'e4')
+    await asyncio.sleep(latency + 0.3)
+    status = session.game.game_status
+    await session.finish()
+    return error is None and status == ''
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Play many scripted games at once against a fake Discord and measure the bot.')
+    parser.add_argument('--games', default = '10,50,100', help = 'comma separated numbers of simultaneous games, one run each')
+    parser.add_argument('--pgn', nargs = '*', help = 'PGN files to take the games from, random games if none')
+    parser.add_argument('--plies', type = int, default = PLIES, help = 'length of the random games')
+    parser.add_argument('--think', type = float, default = THINK, help = 'mean seconds a player thinks before a move')
+    parser.add_argument('--latency', type = float, default = LATENCY, help = 'seconds the fake Discord takes to answer')
+    parser.add_argument('--invalid', type = float, default = INVALID, help = 'share of moves sent wrong first')
+    parser.add_argument('--unpaced', action = 'store_true', help = 'no outbox rate limits')
+    parser.add_argument('--store', action = 'store_true', help = 'save games, stats and archive in a temporary database')
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--clockrace', action = 'store_true', help = 'only check that a move made in time never flags the opponent')
+    parser.add_argument('--json', action = 'store_true', help = 'print one JSON line per run')
+    args = parser.parse_args(argv)
+    if args.clockrace:
+        passed = asyncio.run(clockrace(max(args.latency, 0.4)))
+        print('clock race: ' + ('ok' if passed else 'FAILED, the opponent lost on time'))
+        return 0 if passed else 1
+
+    counts = [int(count) for count in args.games.split(',')]
+    rng = random.Random(args.seed)
+    scripts = [script(moves, rng, args.invalid) for moves in corpus(max(counts), rng, args.pgn, args.plies)]
+    if not scripts:
+        print('No games to play')
+        return 1
+
+    for count in counts:
+        result = asyncio.run(level(count, scripts, args))
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('{games} games: {moves} moves ({rejected} rejected, {timeouts} timeouts) in {seconds:.1f}s, {moves_per_second:.1f} moves/s, '
+                  'board after {p50:.0f}/{p95:.0f}/{p99:.0f} ms (p50/p95/p99), loop lag {lag50:.1f}/{lag99:.1f}/{lagmax:.1f} ms (p50/p99/max), '
+                  '{memory:.0f} KB per game'.format(p50 = 1000 * result['latency_p50'], p95 = 1000 * result['latency_p95'], p99 = 1000 * result['latency_p99'],
+                                                    lag50 = 1000 * result['lag_p50'], lag99 = 1000 * result['lag_p99'], lagmax = 1000 * result['lag_max'],
+                                                    memory = result['memory_per_game'] / 1024, **result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
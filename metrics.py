@@ -0,0 +1,191 @@
+"""Latency histograms, counters and event-loop lag, exported for Prometheus.
+
+Nothing is measured until enable() is called: timer() hands out a shared
+do-nothing context manager, and the hot game-logic functions registered with
+instrument() are only wrapped by enable(), so a bot running without metrics
+(or an engine worker process) pays nothing.
+
+    metrics.instrument(chess.Game, 'all_moves')     time every call once enabled
+    with metrics.timer('render'): ...               time a stage of the turn
+    metrics.count('moves')
+    metrics.enable(); await metrics.serve(9108)     GET /metrics in Prometheus text format
+"""
+import time
+import bisect
+import asyncio
+import functools
+
+PREFIX = 'chessbot_'
+# upper bounds in seconds, 10us to about 10s
+BUCKETS = [0.00001 * 2 ** i for i in range(21)]
+LAG_INTERVAL = 0.5 # seconds between event loop lag samples
+
+enabled = False
+histograms = {}
+counters = {}
+gauges = {} # name: function giving the current value
+instrumented = [] # (owner, attribute, stage) to wrap when enabled
+originals = [] # (owner, attribute, function) wrapped
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1) # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Estimated from the buckets, interpolating inside the one that holds it."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            if seen + count >= rank and count:
+                low = BUCKETS[i - 1] if i > 0 else 0.0
+                high = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-1]
+
+class Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+NOTIMER = NoTimer()
+
+
+def histogram(stage):
+    if stage not in histograms:
+        histograms[stage] = Histogram()
+    return histograms[stage]
+
+def timer(stage):
+    """Context manager timing a stage, free when disabled."""
+    return Timer(histogram(stage)) if enabled else NOTIMER
+
+def observe(stage, seconds):
+    if enabled:
+        histogram(stage).observe(seconds)
+
+def count(name, amount = 1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + amount
+
+def gauge(name, function):
+    gauges[name] = function
+
+def instrument(owner, attribute, stage = None):
+    """Times owner.attribute (a function or method) under stage once metrics are enabled."""
+    instrumented.append((owner, attribute, stage or attribute))
+    if enabled:
+        wrap(owner, attribute, stage or attribute)
+
+def wrap(owner, attribute, stage):
+    original = getattr(owner, attribute)
+    timed = histogram(stage)
+    @functools.wraps(original)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            timed.observe(time.perf_counter() - start)
+    originals.append((owner, attribute, original))
+    setattr(owner, attribute, wrapper)
+
+def enable():
+    global enabled
+    if not enabled:
+        enabled = True
+        for owner, attribute, stage in instrumented:
+            wrap(owner, attribute, stage)
+
+def disable():
+    """Puts the instrumented functions back, also the initializer of worker processes forked from an enabled bot."""
+    global enabled
+    enabled = False
+    while originals:
+        owner, attribute, original = originals.pop()
+        setattr(owner, attribute, original)
+
+
+async def samplelag(interval = LAG_INTERVAL):
+    """Measures how late the event loop wakes up a sleeping task, forever."""
+    lag = histogram('event_loop_lag')
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag.observe(max(loop.time() - start - interval, 0.0))
+
+def exposition():
+    """Everything in the Prometheus text format."""
+    lines = ['# TYPE {0}stage_seconds histogram'.format(PREFIX)]
+    for stage, timed in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ['+Inf'], timed.buckets):
+            cumulative += count
+            lines.append('{}stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(PREFIX, stage, bound if bound == '+Inf' else repr(bound), cumulative))
+        lines.append('{}stage_seconds_sum{{stage="{}"}} {!r}'.format(PREFIX, stage, timed.sum))
+        lines.append('{}stage_seconds_count{{stage="{}"}} {}'.format(PREFIX, stage, timed.count))
+    lines.append('# TYPE {0}stage_quantile_seconds gauge'.format(PREFIX))
+    for stage, timed in sorted(histograms.items()):
+        for q in (0.5, 0.95, 0.99):
+            lines.append('{}stage_quantile_seconds{{stage="{}",quantile="{}"}} {!r}'.format(PREFIX, stage, q, timed.quantile(q)))
+    for name, value in sorted(counters.items()):
+        lines.append('# TYPE {0}{1}_total counter\n{0}{1}_total {2}'.format(PREFIX, name, value))
+    for name, function in sorted(gauges.items()):
+        lines.append('# TYPE {0}{1} gauge\n{0}{1} {2}'.format(PREFIX, name, function()))
+    return '\n'.join(lines) + '\n'
+
+def report():
+    """Short human readable summary, for the admin command."""
+    lines = ['{:<24}{:>9}{:>9}{:>9}{:>9}'.format('stage (ms)', 'p50', 'p95', 'p99', 'count')]
+    for stage, timed in sorted(histograms.items()):
+        lines.append('{:<24}{:>9.2f}{:>9.2f}{:>9.2f}{:>9}'.format(stage, *(1000 * timed.quantile(q) for q in (0.5, 0.95, 0.99)), timed.count))
+    for name, value in sorted(counters.items()):
+        lines.append('{:<24}{:>9}'.format(name, value))
+    for name, function in sorted(gauges.items()):
+        lines.append('{:<24}{:>9}'.format(name, function()))
+    return '\n'.join(lines)
+
+async def serve(port, host = '127.0.0.1'):
+    """Starts the HTTP endpoint answering GET /metrics, returns the asyncio server."""
+    async def respond(reader, writer):
+        try:
+            request = (await reader.readline()).split()
+            while (await reader.readline()).strip():
+                pass
+            if len(request) > 1 and request[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', exposition().encode()
+            else:
+                status, body = '404 Not Found', b'Try /metrics\n'
+            writer.write('HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(status, len(body)).encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
+    return await asyncio.start_server(respond, host, port)
@@ -0,0 +1,234 @@
+"""Outbound Discord messages, paced per channel and sent by priority.
+
+Every send and edit goes through one Outbox. Each channel gets a token bucket
+shaped like Discord's message bucket (5 messages per 5 seconds), plus one global
+bucket, so the bot slows itself down instead of running into 429s. These are a
+fixed estimate: disnake does not hand back the rate-limit headers of the
+requests that went through, only those of a 429, whose reset time then stops
+the channel, or every channel if the limit was the global one. While a
+channel is waiting for its bucket:
+
+- URGENT items (boards) go before NORMAL ones (replies) and COSMETIC ones
+  (history buttons), in order within a priority;
+- an edit of a message that already has an edit pending replaces it, only the
+  last content is sent;
+- error replies are merged into one message, repeated lines counted.
+
+stats() gives the queue depth and how long the sent messages waited.
+"""
+import time
+import heapq
+import asyncio
+import itertools
+import collections
+
+import disnake
+
+import metrics
+
+URGENT, NORMAL, COSMETIC = 0, 1, 2
+
+RATE = 5 # messages per channel... (Discord's usual message bucket, it does not tell it in advance)
+PER = 5.0 # ...every PER seconds
+GLOBAL_RATE = 50 # requests per second for the whole bot
+
+
+class Bucket:
+    """Token bucket, with a hard stop until a given time after a 429."""
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.stamp = time.monotonic()
+        self.blocked = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate / self.per)
+        self.stamp = now
+
+    def wait(self, now):
+        """Seconds until a token is available."""
+        self.refill(now)
+        return max(self.blocked - now, (1 - self.tokens) * self.per / self.rate, 0.0)
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class Outgoing:
+    def __init__(self, kind, priority, seq, target, kwargs):
+        self.kind = kind # 'send', 'edit' or 'reply'
+        self.priority = priority
+        self.seq = seq
+        self.target = target # channel, or message for edits
+        self.kwargs = kwargs
+        self.lines = collections.Counter() # reply lines
+        self.futures = []
+        self.queued = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class ChannelQueue:
+    def __init__(self, rate, per):
+        self.heap = []
+        self.edits = {} # message id: pending edit
+        self.reply = None # pending merged reply
+        self.bucket = Bucket(rate, per)
+        self.busy = False # a request of this channel is in flight, keeps them in order
+
+
+class Outbox:
+    def __init__(self, rate = RATE, per = PER, global_rate = GLOBAL_RATE):
+        self.rate = rate
+        self.per = per
+        self.channels = {}
+        self.bucket = Bucket(global_rate, 1.0)
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.worker = None
+        self.sent = self.coalesced = self.merged = self.failed = 0
+        self.waits = collections.deque(maxlen = 1024) # seconds each sent item spent queued
+
+    def queue(self, channel_id):
+        if channel_id not in self.channels:
+            self.channels[channel_id] = ChannelQueue(self.rate, self.per)
+        return self.channels[channel_id]
+
+    def push(self, channel_id, item):
+        heapq.heappush(self.queue(channel_id).heap, item)
+        if self.worker is None or self.worker.done():
+            self.wakeup = asyncio.Event()
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+        self.wakeup.set()
+
+    # enqueueing
+
+    def send(self, channel, priority = NORMAL, **kwargs):
+        """Queues channel.send(**kwargs), returns a future of the sent message."""
+        item = Outgoing('send', priority, next(self.counter), channel, kwargs)
+        future = asyncio.get_running_loop().create_future()
+        item.futures.append(future)
+        self.push(channel.id, item)
+        return future
+
+    def edit(self, message, priority = COSMETIC, **kwargs):
+        """Queues message.edit(**kwargs), merged into the edit of message that is still waiting if there is one."""
+        queue = self.queue(message.channel.id)
+        item = queue.edits.get(message.id)
+        if item is not None:
+            item.kwargs.update(kwargs)
+            item.priority = min(item.priority, priority)
+            heapq.heapify(queue.heap)
+            self.coalesced += 1
+            return
+        item = Outgoing('edit', priority, next(self.counter), message, kwargs)
+        queue.edits[message.id] = item
+        self.push(message.channel.id, item)
+
+    def reply(self, channel, content, priority = NORMAL):
+        """Queues a short reply (errors), merged with the other replies still waiting in channel."""
+        queue = self.queue(channel.id)
+        if queue.reply is not None:
+            queue.reply.lines[content] += 1
+            self.merged += 1
+            return
+        item = Outgoing('reply', priority, next(self.counter), channel, {})
+        item.lines[content] += 1
+        queue.reply = item
+        self.push(channel.id, item)
+
+    # sending
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            delay = self.dispatch(loop)
+            if delay is None and not any(queue.heap for queue in self.channels.values()):
+                self.worker = None
+                return
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def dispatch(self, loop):
+        """Starts every item that can go now, best priority first. Returns the seconds until
+        the next one could, or None if everything left is waiting for a request in flight."""
+        now = time.monotonic()
+        for id in [id for id, queue in self.channels.items() if not queue.heap and not queue.busy and queue.bucket.wait(now) == 0 and queue.bucket.tokens >= queue.bucket.rate]:
+            del self.channels[id] # idle with a full bucket, nothing to remember
+        heads = sorted((queue.heap[0], id, queue) for id, queue in self.channels.items() if queue.heap and not queue.busy)
+        delay = None
+        for item, id, queue in heads:
+            wait = max(queue.bucket.wait(now), self.bucket.wait(now))
+            if wait > 0:
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            heapq.heappop(queue.heap)
+            if item.kind == 'edit':
+                del queue.edits[item.target.id]
+            elif item.kind == 'reply':
+                queue.reply = None
+            queue.bucket.take(now)
+            self.bucket.take(now)
+            queue.busy = True
+            loop.create_task(self.execute(queue, item))
+        return delay
+
+    async def execute(self, queue, item):
+        self.waits.append(time.monotonic() - item.queued)
+        metrics.observe('outbox_wait', self.waits[-1])
+        try:
+            with metrics.timer('discord_' + item.kind):
+                if item.kind == 'edit':
+                    result = await item.target.edit(**item.kwargs)
+                elif item.kind == 'reply':
+                    result = await item.target.send('\n'.join(line if count == 1 else '{} (x{})'.format(line, count) for line, count in item.lines.items()))
+                else:
+                    result = await item.target.send(**item.kwargs)
+        except Exception as e:
+            self.failed += 1
+            metrics.count('discord_errors')
+            if isinstance(e, disnake.HTTPException) and e.status == 429:
+                self.ratelimited(queue, e.response)
+            if item.futures:
+                for future in item.futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                print('Could not', item.kind, 'message:', e)
+        else:
+            self.sent += 1
+            for future in item.futures:
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            queue.busy = False
+            self.wakeup.set()
+
+    def ratelimited(self, queue, response):
+        """Stops the channel of a 429, or everything for a global one, until Discord's reset time."""
+        headers = getattr(response, 'headers', None) or {}
+        try:
+            delay = float(headers.get('X-RateLimit-Reset-After') or headers.get('Retry-After') or self.per)
+        except ValueError:
+            delay = self.per
+        bucket = self.bucket if headers.get('X-RateLimit-Global') else queue.bucket
+        bucket.blocked = max(bucket.blocked, time.monotonic() + delay)
+
+    # metrics
+
+    def depth(self):
+        return sum(len(queue.heap) for queue in self.channels.values())
+
+    def stats(self):
+        waits = sorted(self.waits)
+        def percentile(p):
+            return waits[min(len(waits) - 1, int(p * len(waits)))] if waits else 0.0
+        return {'depth': self.depth(), 'channels': sum(1 for queue in self.channels.values() if queue.heap),
+                'sent': self.sent, 'coalesced': self.coalesced, 'merged': self.merged, 'failed': self.failed,
+                'wait_p50': percentile(0.5), 'wait_p95': percentile(0.95), 'wait_max': waits[-1] if waits else 0.0}
@@ -0,0 +1,177 @@
+"""Perft: counts the leaf nodes of the move tree to check and benchmark Game.all_moves.
+
+    python perft.py --depth 4                     start position
+    python perft.py --position kiwipete --divide  node count per root move
+    python perft.py --fen "<fen>" --depth 3
+    python perft.py --suite --backend objects     every known position, exits 1 on a mismatch
+    python perft.py --suite --json >> bench_output.txt
+    python perft.py --startup                     import and new game costs, tracked the same way
+
+The counts below come from the Chess Programming Wiki perft pages and
+Martin Sedlak's collection of tricky positions.
+"""
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import bitboards
+import shitty_chessgamelogic as chess
+
+# name, fen, expected node count at depth 1, 2, 3...
+POSITIONS = [
+    ('start', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1', [20, 400, 8902, 197281]),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1', [48, 2039, 97862]),
+    ('endgame', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', [14, 191, 2812, 43238]),
+    ('promotions', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1', [6, 264, 9467]),
+    ('talkchess', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8', [44, 1486, 62379]),
+    ('middlegame', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10', [46, 2079, 89890]),
+    ('illegal ep 1', '3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1', [18, 92, 1670, 10138, 185429]),
+    ('illegal ep 2', '8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1', [13, 102, 1266, 10276, 135655]),
+    ('ep gives check', '8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1', [15, 126, 1928, 13931, 206379]),
+    ('ep pinned horizontally', '8/8/8/8/k2Pp2Q/8/8/3K4 b - d3 0 1', [6, 136, 863, 20471]),
+    ('short castle gives check', '5k2/8/8/8/8/8/8/4K2R w K - 0 1', [15, 66, 1198, 6399, 120330]),
+    ('long castle gives check', '3k4/8/8/8/8/8/8/R3K3 w Q - 0 1', [16, 71, 1286, 7418, 141077]),
+    ('castling rights', 'r3k2r/1b4bq/8/8/8/8/7B/R3K2R w KQkq - 0 1', [26, 1141, 27826]),
+    ('castling through check', 'r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1', [44, 1494, 50509]),
+    ('promote out of check', '2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1', [11, 133, 1442, 19174, 266199]),
+    ('discovered check', '8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1', [29, 165, 5160, 31961]),
+    ('promote to give check', '4k3/1P6/8/8/8/8/K7/8 w - - 0 1', [9, 40, 472, 2661, 38983]),
+    ('underpromote to check', '8/P1k5/K7/8/8/8/8/8 w - - 0 1', [6, 27, 273, 1329, 18135]),
+    ('self stalemate', 'K1k5/8/P7/8/8/8/8/8 w - - 0 1', [2, 6, 13, 63, 382, 2217]),
+    ('stalemate and checkmate', '8/k1P5/8/1K6/8/8/8/8 w - - 0 1', [10, 25, 268, 926, 10857, 43261]),
+    ('stalemate and checkmate 2', '8/8/2k5/5q2/5n2/8/5K2/8 b - - 0 1', [37, 183, 6559, 23527]),
+]
+
+
+def perft(game, depth):
+    """Number of leaf nodes depth plies below the current position of game."""
+    game.all_moves()
+    moves = game.legal_moves()
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+
+    nodes = 0
+    for move in moves:
+        game.push(move)
+        nodes += perft(game, depth - 1)
+        game.pop()
+    return nodes
+
+def divide(game, depth):
+    """Leaf node count below each root move, as a {'e2e4': nodes} dict."""
+    game.all_moves()
+    counts = {}
+    for move in game.legal_moves():
+        game.push(move)
+        counts[chess.Game.longnotation(move)] = perft(game, depth - 1)
+        game.pop()
+    return counts
+
+def run(fen, depth, backend = 'bitboard'):
+    """Returns (nodes, seconds) for one perft run."""
+    game = chess.Game.from_fen(fen, backend)
+    start = time.perf_counter()
+    nodes = perft(game, depth)
+    return nodes, time.perf_counter() - start
+
+def suite(depth = None, backend = 'bitboard', positions = POSITIONS):
+    """Runs every position to depth (or the deepest known count) and yields one result dict each."""
+    for name, fen, expected in positions:
+        d = min(depth or len(expected), len(expected))
+        nodes, seconds = run(fen, d, backend)
+        yield {'name': name, 'depth': d, 'nodes': nodes, 'expected': expected[d - 1],
+               'ok': nodes == expected[d - 1], 'seconds': seconds, 'nps': nodes / seconds if seconds else 0.0,
+               'backend': backend}
+
+def startup(games = 5000):
+    """What a cold start costs: importing the game logic in a fresh interpreter (less the
+    interpreter's own start), building the attack tables versus loading them from the
+    cache file, and creating new games."""
+    def interpreter(code):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check = True)
+        return time.perf_counter() - start
+    base = min(interpreter('pass') for _ in range(3))
+    imported = min(interpreter('import shitty_chessgamelogic') for _ in range(3)) - base
+
+    start = time.perf_counter()
+    bitboards.computetables()
+    built = time.perf_counter() - start
+    bitboards.attacktables() # writes the cache file if it is not there yet
+    start = time.perf_counter()
+    bitboards.split(bitboards.loadtables())
+    loaded = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(games):
+        chess.Game('bitboard')
+    seconds = time.perf_counter() - start
+    return {'name': 'startup', 'import_seconds': imported, 'build_tables_seconds': built, 'load_tables_seconds': loaded,
+            'games_per_second': games / seconds if seconds else 0.0}
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Perft counts and benchmarks for the chess move generator.')
+    parser.add_argument('--fen', help = 'position to search, defaults to the start position')
+    parser.add_argument('--position', choices = [name for name, _, _ in POSITIONS], help = 'one of the known positions')
+    parser.add_argument('--depth', type = int, help = 'plies to search (the suite caps each position at its deepest known count)')
+    parser.add_argument('--backend', default = 'bitboard', choices = sorted(chess.Game.backends))
+    parser.add_argument('--divide', action = 'store_true', help = 'print the node count of every root move')
+    parser.add_argument('--suite', action = 'store_true', help = 'run every known position and compare the counts')
+    parser.add_argument('--startup', action = 'store_true', help = 'time the import and new games instead')
+    parser.add_argument('--json', action = 'store_true', help = 'print one JSON line per result, to keep a history of runs')
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        result = startup()
+        if args.json:
+            result['time'] = time.time()
+            print(json.dumps(result))
+        else:
+            print('Import: {:.1f}ms  Tables: {:.1f}ms built, {:.1f}ms from the cache  New games: {:.0f}/s'.format(
+                1000 * result['import_seconds'], 1000 * result['build_tables_seconds'], 1000 * result['load_tables_seconds'], result['games_per_second']))
+        return 0
+
+    if args.suite:
+        failed = 0
+        nodes = seconds = 0
+        for result in suite(args.depth, args.backend):
+            result['time'] = time.time()
+            failed += not result['ok']
+            nodes += result['nodes']
+            seconds += result['seconds']
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('{:<4} {:<26} depth {} {:>9} nodes (expected {:>9}) {:7.2f}s {:>8.0f} nps'.format(
+                    'ok' if result['ok'] else 'FAIL', result['name'], result['depth'], result['nodes'],
+                    result['expected'], result['seconds'], result['nps']))
+        if not args.json:
+            print('{} failed, {} nodes in {:.2f}s, {:.0f} nps'.format(failed, nodes, seconds, nodes / seconds if seconds else 0.0))
+        return 1 if failed else 0
+
+    fen = args.fen or dict((name, fen) for name, fen, _ in POSITIONS)[args.position or 'start']
+    depth = args.depth or 3
+    game = chess.Game.from_fen(fen, args.backend)
+
+    start = time.perf_counter()
+    if args.divide:
+        counts = divide(game, depth)
+        for move in sorted(counts):
+            print(move + ':', counts[move])
+        nodes = sum(counts.values())
+    else:
+        nodes = perft(game, depth)
+    seconds = time.perf_counter() - start
+
+    if args.json:
+        print(json.dumps({'fen': fen, 'depth': depth, 'nodes': nodes, 'seconds': seconds, 'nps': nodes / seconds if seconds else 0.0, 'backend': args.backend}))
+    else:
+        print('Nodes: {}  Time: {:.2f}s  NPS: {:.0f}'.format(nodes, seconds, nodes / seconds if seconds else 0.0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
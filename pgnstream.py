@@ -0,0 +1,229 @@
+"""Streaming PGN reader and bulk replay across a process pool.
+
+    python pgnstream.py archive.pgn                 replay every game, report games per second
+    python pgnstream.py archive.pgn --errors        also list the games that failed and where
+    python pgnstream.py archive.pgn --json          one JSON line per game
+
+Games are read lazily, one at a time, so files of any size can be validated
+without loading them. Headers, comments, NAGs and (nested) variations are
+parsed properly instead of stripped with str.replace, only the main line is
+replayed.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import shitty_chessgamelogic as chess
+
+HEADER = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+TOKEN = re.compile(r'''
+    (?P<comment>\{[^}]*\}?|;[^\n]*)
+   |(?P<nag>\$\d+)
+   |(?P<open>\()
+   |(?P<close>\))
+   |(?P<castle>[O0]-[O0](?:-[O0])?[+#]?)
+   |(?P<result>1-0|0-1|1/2-1/2|\*)
+   |(?P<number>\d+\.*)
+   |(?P<move>[A-Za-z][A-Za-z0-9=+#-]*)
+   |(?P<suffix>[!?]+)
+''', re.VERBOSE)
+SUFFIXES = {'!': 1, '?': 2, '!!': 3, '??': 4, '!?': 5, '?!': 6}
+PROMOTION = re.compile(r'([a-h][18])([NBRQ])')
+
+
+class Line:
+    """A sequence of SAN moves starting at ply (0 is white's first move), with what was written around them.
+    comments and nags are keyed by the number of plies played when they appear."""
+    def __init__(self, ply = 0):
+        self.ply = ply
+        self.moves = []
+        self.comments = {}
+        self.nags = {}
+        self.variations = []
+
+class PGNGame:
+    def __init__(self, index, headers, mainline, result):
+        self.index = index
+        self.headers = headers
+        self.mainline = mainline
+        self.result = result
+
+ReplayResult = collections.namedtuple('ReplayResult', 'index white black result status plies error_ply error')
+
+
+def normalise(move):
+    if move[0] == '0':
+        move = move.replace('0', 'O')
+    if '=' not in move:
+        move = PROMOTION.sub(r'\1=\2', move)
+    return move.replace('-', '') if move[0] != 'O' else move
+
+def parse_movetext(text):
+    """Returns (main line, result token) of one game's movetext."""
+    main = Line()
+    stack = [main]
+    result = None
+    for match in TOKEN.finditer(text):
+        kind, value = match.lastgroup, match.group()
+        line = stack[-1]
+        ply = line.ply + len(line.moves)
+
+        if kind in {'move', 'castle'}:
+            line.moves.append(normalise(value))
+        elif kind == 'comment':
+            line.comments.setdefault(ply, []).append(value.strip('{}; \n\r\t'))
+        elif kind == 'nag':
+            line.nags.setdefault(ply, []).append(int(value[1:]))
+        elif kind == 'suffix' and value in SUFFIXES:
+            line.nags.setdefault(ply, []).append(SUFFIXES[value])
+        elif kind == 'open':
+            # a variation is an alternative to the move just played
+            variation = Line(max(ply - 1, line.ply))
+            line.variations.append(variation)
+            stack.append(variation)
+        elif kind == 'close' and len(stack) > 1:
+            stack.pop()
+        elif kind == 'result' and len(stack) == 1:
+            result = value
+    return main, result
+
+def incomment(line, comment):
+    # whether a {comment} is still open at the end of line
+    for char in line:
+        if comment:
+            comment = char != '}'
+        elif char == '{':
+            comment = True
+        elif char == ';':
+            break
+    return comment
+
+def read_games(lines):
+    """Yields a PGNGame for every game in an iterable of lines (an open file works), lazily."""
+    index = 0
+    headers = {}
+    movetext = []
+    comment = False
+    for line in lines:
+        stripped = line.strip()
+        if not comment:
+            if stripped.startswith('%'):
+                continue
+            if stripped.startswith('['):
+                if movetext:
+                    yield PGNGame(index, headers, *parse_movetext(''.join(movetext)))
+                    index += 1
+                    headers, movetext = {}, []
+                match = HEADER.match(stripped)
+                if match:
+                    headers[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+                continue
+        if stripped:
+            movetext.append(line if line.endswith('\n') else line + '\n')
+            comment = incomment(line, comment)
+
+    if headers or movetext:
+        yield PGNGame(index, headers, *parse_movetext(''.join(movetext)))
+
+def read_file(path):
+    with open(path, encoding = 'utf-8-sig', errors = 'replace') as file:
+        yield from read_games(file)
+
+
+def replay(game, backend = 'bitboard'):
+    """Plays the main line of a PGNGame and returns a ReplayResult instead of printing."""
+    headers = game.headers
+    if 'FEN' in headers:
+        board = chess.Game.from_fen(headers['FEN'], backend)
+    else:
+        board = chess.Game(backend)
+
+    error_ply = error = None
+    for ply, move in enumerate(game.mainline.moves):
+        board.checkgamestatus()
+        if board.game_status != '':
+            error_ply, error = ply, 'Move after the end of the game'
+            break
+        try:
+            board.playturn(move)
+        except (chess.InvalidMove, chess.AmbiguousMove, chess.ParseError) as e:
+            error_ply, error = ply, type(e).__name__ + ': ' + move
+            break
+    else:
+        board.checkgamestatus()
+
+    return ReplayResult(game.index, headers.get('White', '?'), headers.get('Black', '?'), game.result or headers.get('Result', '*'),
+                        board.game_status, len(board.history), error_ply, error)
+
+def replay_batch(games, backend = 'bitboard'):
+    return [replay(game, backend) for game in games]
+
+def batches(games, size):
+    batch = []
+    for game in games:
+        batch.append(game)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def replay_all(games, workers = None, backend = 'bitboard', batch = 64):
+    """Replays games (any iterable, consumed lazily) on a pool of workers processes and yields
+    ReplayResults in input order. At most two batches per worker are in flight, so memory stays flat.
+    workers = 0 replays in this process."""
+    if workers == 0:
+        for chunk in batches(games, batch):
+            yield from replay_batch(chunk, backend)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for chunk in batches(games, batch):
+            pending.append(pool.submit(replay_batch, chunk, backend))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Validate every game of PGN files by replaying them.')
+    parser.add_argument('files', nargs = '+')
+    parser.add_argument('--workers', type = int, help = 'worker processes, defaults to the number of cores, 0 to stay in process')
+    parser.add_argument('--batch', type = int, default = 64, help = 'games sent to a worker at once')
+    parser.add_argument('--backend', default = 'bitboard', choices = sorted(chess.Game.backends))
+    parser.add_argument('--errors', action = 'store_true', help = 'print every game that failed to replay')
+    parser.add_argument('--json', action = 'store_true', help = 'print one JSON line per game')
+    args = parser.parse_args(argv)
+
+    def games():
+        for path in args.files:
+            yield from read_file(path)
+
+    start = time.perf_counter()
+    count = failed = plies = 0
+    for result in replay_all(games(), args.workers, args.backend, args.batch):
+        count += 1
+        plies += result.plies
+        failed += result.error is not None
+        if args.json:
+            print(json.dumps(result._asdict()))
+        elif args.errors and result.error is not None:
+            print('Game {} ({} - {}): ply {}, {}'.format(result.index + 1, result.white, result.black, result.error_ply + 1, result.error))
+    seconds = time.perf_counter() - start
+
+    if not args.json:
+        print('{} games, {} failed, {} plies in {:.2f}s: {:.1f} games/s, {:.0f} plies/s'.format(
+            count, failed, plies, seconds, count / seconds if seconds else 0.0, plies / seconds if seconds else 0.0))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""Polyglot opening books.
+
+A .bin book is a file of 16-byte big-endian entries (key, move, weight, learn)
+sorted by key, the key being the Polyglot Zobrist hash that Game.position_key
+already is. Books are mmapped, not read: lookups binary-search the mapping, so
+opening one costs nothing and every process using the same file shares the
+same pages. openbook() keeps one Book per path per process.
+"""
+import mmap
+import random
+import struct
+
+ENTRY = struct.Struct('>QHHI')
+KEY = struct.Struct('>Q')
+PROMOTIONS = (None, 'N', 'B', 'R', 'Q')
+# Polyglot writes castling as the king taking its own rook
+CASTLING = {((0, 4), (0, 7)): (0, 6), ((0, 4), (0, 0)): (0, 2), ((7, 4), (7, 7)): (7, 6), ((7, 4), (7, 0)): (7, 2)}
+
+books = {}
+
+
+def openbook(path):
+    """The Book of path, opened once per process."""
+    if path not in books:
+        books[path] = Book(path)
+    return books[path]
+
+def decode(move):
+    """(origin, to, promote) of a Polyglot move, castling still as king takes rook."""
+    return (move >> 9 & 7, move >> 6 & 7), (move >> 3 & 7, move & 7), PROMOTIONS[move >> 12 & 7]
+
+def encode(move):
+    """Polyglot move of an (origin, to, promote) tuple, castling left as the king's own move."""
+    (fromrow, fromcol), (torow, tocol), promote = move
+    return PROMOTIONS.index(promote) << 12 | fromrow << 9 | fromcol << 6 | torow << 3 | tocol
+
+
+class Book:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) if file.seek(0, 2) else b''
+        self.size = len(self.map) // ENTRY.size
+
+    def __len__(self):
+        return self.size
+
+    def first(self, key):
+        # index of the first entry of key, or of the next key if there is none
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if KEY.unpack_from(self.map, middle * ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def entries(self, key):
+        """(move, weight, learn) of every entry of key, move still Polyglot encoded."""
+        index = self.first(key)
+        while index < self.size:
+            entry, move, weight, learn = ENTRY.unpack_from(self.map, index * ENTRY.size)
+            if entry != key:
+                break
+            yield move, weight, learn
+            index += 1
+
+    def moves(self, game):
+        """[(SAN, weight)] of the book moves in the position of game, best first. The SAN can go straight to playturn."""
+        moves = []
+        legal = None
+        for move, weight, _ in self.entries(game.position_key):
+            if legal is None:
+                game.santable()
+                legal = game.sanmoves
+            origin, to, promote = decode(move)
+            piece = game.board[origin]
+            if piece is not None and piece.type == 'K':
+                to = CASTLING.get((origin, to), to)
+            if (origin, to, promote) in legal:
+                moves.append((legal[origin, to, promote], weight))
+        moves.sort(key = lambda move: -move[1])
+        return moves
+
+    def choose(self, game, rng = random):
+        """A book move of the position of game picked at random in proportion to the weights, or None out of book."""
+        moves = [move for move in self.moves(game) if move[1] > 0]
+        if not moves:
+            return None
+        pick = rng.uniform(0, sum(weight for _, weight in moves))
+        for san, weight in moves:
+            pick -= weight
+            if pick <= 0:
+                return san
+        return moves[-1][0]
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        books.pop(self.path, None)
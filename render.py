@@ -0,0 +1,214 @@
+"""PNG board images.
+
+The piece sprites are tiny pixel masks turned into one in-memory atlas at
+import, boards are composited from NumPy arrays and encoded with zlib, and
+finished images are kept in an LRU cache keyed by position and highlights.
+"""
+import zlib
+import struct
+import asyncio
+import collections
+
+import numpy as np
+
+import compactboard
+
+SQUARE = 48 # pixels per square
+LIGHT = (240, 217, 181)
+DARK = (181, 136, 99)
+LASTMOVE = (205, 210, 106)
+CHECK = (235, 97, 80)
+
+# X outline, o body, . transparent
+SPRITES = {
+    'P': ['................',
+          '................',
+          '................',
+          '......XXXX......',
+          '.....XooooX.....',
+          '.....XooooX.....',
+          '......XooX......',
+          '.....XooooX.....',
+          '......XooX......',
+          '......XooX......',
+          '.....XooooX.....',
+          '....XooooooX....',
+          '...XooooooooX...',
+          '...XXXXXXXXXX...',
+          '................',
+          '................'],
+    'N': ['................',
+          '................',
+          '.....XX.X.......',
+          '....XooXoX......',
+          '...XoooooXX.....',
+          '..XooXooooX.....',
+          '..XoooooooXX....',
+          '...XXXXooooX....',
+          '......XoooooX...',
+          '.....XooooooX...',
+          '....XoooooooX...',
+          '....XooooooX....',
+          '...XooooooooX...',
+          '...XXXXXXXXXX...',
+          '................',
+          '................'],
+    'B': ['................',
+          '.......XX.......',
+          '......XooX......',
+          '.....XooXoX.....',
+          '.....XoXooX.....',
+          '....XoXooooX....',
+          '....XooooooX....',
+          '.....XooooX.....',
+          '......XooX......',
+          '.....XooooX.....',
+          '......XooX......',
+          '....XooooooX....',
+          '...XooooooooX...',
+          '...XXXXXXXXXX...',
+          '................',
+          '................'],
+    'R': ['................',
+          '................',
+          '...XX.XXXX.XX...',
+          '...XoXXooXXoX...',
+          '...XooooooooX...',
+          '....XooooooX....',
+          '.....XooooX.....',
+          '.....XooooX.....',
+          '.....XooooX.....',
+          '.....XooooX.....',
+          '....XooooooX....',
+          '...XooooooooX...',
+          '..XooooooooooX..',
+          '..XXXXXXXXXXXX..',
+          '................',
+          '................'],
+    'Q': ['................',
+          '..X....XX....X..',
+          '.XoX..XooX..XoX.',
+          '..XX...XX...XX..',
+          '..XoX.XooX.XoX..',
+          '..XooXooooXooX..',
+          '..XooooooooooX..',
+          '...XooooooooX...',
+          '...XooooooooX...',
+          '....XooooooX....',
+          '....XXXXXXXX....',
+          '...XooooooooX...',
+          '..XooooooooooX..',
+          '..XXXXXXXXXXXX..',
+          '................',
+          '................'],
+    'K': ['.......XX.......',
+          '......XooX......',
+          '.....XXooXX.....',
+          '.....XooooX.....',
+          '......XooX......',
+          '...XXX.XX.XXX...',
+          '..XoooXooXoooX..',
+          '..XooooooooooX..',
+          '..XooooooooooX..',
+          '...XooooooooX...',
+          '....XooooooX....',
+          '....XXXXXXXX....',
+          '...XooooooooX...',
+          '..XooooooooooX..',
+          '..XXXXXXXXXXXX..',
+          '................'],
+}
+COLORS = {1: ((20, 20, 20), (250, 250, 250)), -1: ((20, 20, 20), (70, 70, 70))} # outline, body
+
+
+def sprite(rows, outline, body):
+    """(rgb, mask) arrays of one piece scaled to SQUARE pixels."""
+    chars = np.array([list(row) for row in rows])
+    scale = SQUARE // len(rows)
+    chars = chars.repeat(scale, axis = 0).repeat(scale, axis = 1)
+    rgb = np.zeros(chars.shape + (3,), dtype = np.uint8)
+    rgb[chars == 'X'] = outline
+    rgb[chars == 'o'] = body
+    return rgb, chars != '.'
+
+# ATLAS[code + 6] is the (rgb, mask) sprite of a compactboard piece code
+ATLAS = [None] * 13
+for type, code in compactboard.CODES.items():
+    for color in (1, -1):
+        ATLAS[6 + color * code] = sprite(SPRITES[type], *COLORS[color])
+
+BASE = np.zeros((8 * SQUARE, 8 * SQUARE, 3), dtype = np.uint8)
+for row in range(8):
+    for col in range(8):
+        BASE[(7 - row) * SQUARE:(8 - row) * SQUARE, col * SQUARE:(col + 1) * SQUARE] = LIGHT if (row + col) % 2 else DARK
+
+
+def cell(image, sq):
+    row, col = divmod(sq, 8)
+    return image[(7 - row) * SQUARE:(8 - row) * SQUARE, col * SQUARE:(col + 1) * SQUARE]
+
+def draw(squares, lastmove = None, check = None):
+    """RGB array of the board, white at the bottom. squares is a compactboard int8[64],
+    lastmove a pair of squares to highlight and check the square of a king in check."""
+    image = BASE.copy()
+    for sq in lastmove or ():
+        cell(image, sq)[:] = LASTMOVE
+    if check is not None:
+        cell(image, check)[:] = CHECK
+    for sq in np.flatnonzero(squares):
+        rgb, mask = ATLAS[6 + int(squares[sq])]
+        target = cell(image, sq)
+        target[mask] = rgb[mask]
+    return image
+
+def chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+def encodepng(image):
+    height, width, _ = image.shape
+    raw = np.zeros((height, width * 3 + 1), dtype = np.uint8) # every row starts with filter type 0
+    raw[:, 1:] = image.reshape(height, width * 3)
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw.tobytes(), 6))
+            + chunk(b'IEND', b''))
+
+def renderpng(squares, lastmove = None, check = None):
+    return encodepng(draw(squares, lastmove, check))
+
+
+class BoardRenderer:
+    """Board PNGs for games, with an LRU cache shared by every session."""
+    def __init__(self, maxsize = 512):
+        self.cache = collections.OrderedDict()
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def highlights(game):
+        lastmove = check = None
+        if game.stack:
+            origin, to, _ = game.stack[-1][0]
+            lastmove = (origin[0] * 8 + origin[1], to[0] * 8 + to[1])
+        king = game.pieces[{1: 0, -1: 1}[game.turn]][1, 4]
+        if king.incheck:
+            check = king.pos[0] * 8 + king.pos[1]
+        return lastmove, check
+
+    async def png(self, game, executor = None):
+        """PNG bytes of the current position of game, all_moves must have run for the check highlight.
+        Drawing and encoding run in executor (the loop's default one if None)."""
+        lastmove, check = self.highlights(game)
+        key = (game.position_key, lastmove, check)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self.misses += 1
+        squares = compactboard.CompactPosition.from_game(game).squares
+        png = await asyncio.get_running_loop().run_in_executor(executor, renderpng, squares, lastmove, check)
+        self.cache[key] = png
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last = False)
+        return png
@@ -0,0 +1,378 @@
+"""Running games, driven by the messages the bot routes to them.
+
+Every game lives in its own thread of the lobby and is registered under that
+thread's id, so a guild can run as many games as it wants. The bot has a
+single on_message listener that looks the session up in a dict and hands it
+the message: an idle game is just a Session object and its flag deadline in
+the clocks scheduler, not a coroutine parked in bot.wait_for. When the bot
+runs as several shard processes (supervisor.py), each one only has the
+sessions of its own guilds, and results go to the STATS store they share.
+Finished games are kept in the ARCHIVE, indexed by position.
+"""
+import io
+import time
+import bisect
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+import disnake
+
+import shitty_chessgamelogic as chess
+import engine
+import render
+import outbox
+import tablebase
+import metrics
+import history
+import clocks
+
+TEAMS = {1 : "**White**", -1 : "**Black**"}
+ENGINE_BUDGET = 5.0 # most seconds of search per engine move
+ENGINE_MOVES = 30 # moves the engine spreads the time left on its clock over
+ENGINE_MARGIN = 0.5 # seconds kept on the engine's clock for replaying the game and answering
+ENGINE_FLOOR = 0.1 # least seconds of search, when the clock allows it
+BOOK = None # path of a Polyglot book for the engine's openings and /book, from the .env book entry
+TABLEBASES = None # directory of tablebase.py tables, from the .env tablebases entry
+AUTOCOMPLETE = 25 # most moves /move suggests
+ADJUDICATE = True # end the games the tablebases have solved instead of playing them out
+STATS = None # globalstats store of the results and leaderboards, shared by the shard processes
+ARCHIVE = None # archive.Archive of the finished games
+
+# engine searches run here, never on the event loop, so other games keep playing while the bot thinks
+engine_pool = ProcessPoolExecutor(max_workers = 2, initializer = metrics.disable)
+
+renderer = render.BoardRenderer()
+
+# every message the games send goes through here, boards first
+outgoing = outbox.Outbox()
+
+# the flag-fall deadlines of every game, served by one task
+scheduler = clocks.Scheduler()
+
+for stage in ('all_moves', 'threefoldrepetition', 'translate', 'checkgamestatus'):
+    metrics.instrument(chess.Game, stage)
+metrics.gauge('outbox_depth', outgoing.depth)
+metrics.gauge('clocks_pending', lambda: len(scheduler))
+
+
+class Session:
+    def __init__(self, game, lobby, roles, engine_color = None, store = None, clock = None):
+        self.game = game
+        self.lobby = lobby
+        self.roles = roles # [white role, black role]
+        self.engine_color = engine_color
+        self.channel = None # thread the moves are played in
+        self.thread = None # thread with the history message
+        self.thread_msg = None # the history message
+        self.history = history.History(game.history, [move for _, move in game.played()])
+        self.legal = None # (ply, sankeys, SANs) of the legal moves sorted by sankey, for /move
+        self.lock = asyncio.Lock()
+        self.clock = clock if clock is not None else clocks.Clock()
+        self.timer = None # scheduler entry of the flag fall
+        self.turnstart = time.time() # wall clock, for the store
+        self.task = None
+        self.registry = None
+        self.store = store # storage.GameStore keeping the game across restarts
+        self.players = {} # member id: (color, moves played)
+        self.result = None # 1 white won, -1 black won, 0 draw, when the status alone does not say
+
+    @property
+    def id(self):
+        return self.channel.id
+
+    async def start(self, name, registry):
+        welcome = await outgoing.send(self.lobby, content = "> Welcome to this new game of chess, time control **" + clocks.name(self.clock.control) + "**: run out of time and you lose.\nGLHF all !")
+        self.channel = await self.lobby.create_thread(name = name, message = welcome)
+        registry.add(self)
+
+        hello = await outgoing.send(self.lobby, content = "Use this thread to navigate to previous moves")
+        await hello.pin()
+        self.thread = await self.lobby.create_thread(name = "You can click the moves to go see its board state.\n", message=hello)
+        self.thread_msg = await outgoing.send(self.thread, outbox.COSMETIC, content = history.INTRO, components = history.controls(self.id, 0, self.history))
+
+        self.turnstart = time.time()
+        self.clock.start(self.game.turn)
+        self.arm()
+        metrics.count('games_started')
+        if self.store is not None:
+            self.store.begin(self)
+        await self.advance()
+
+    async def restore(self, spent):
+        """Carries on a game rebuilt after a restart, the side to play having already spent seconds on its move."""
+        self.turnstart = time.time() - spent
+        self.clock.start(self.game.turn, time.monotonic() - spent)
+        self.game.checkgamestatus()
+        if self.game.game_status != '':
+            await self.finish()
+            return
+        self.arm()
+        await outgoing.send(self.channel, content = "> I'm back! " + TEAMS[self.game.turn] + " to play, you still have **" + clocks.minutes(self.clock.left(self.game.turn)) + "**.")
+        if self.game.turn == self.engine_color:
+            self.task = asyncio.get_running_loop().create_task(self.enginemove())
+
+    async def postboard(self):
+        game = self.game
+        if game.history:
+            lastmove = ' *' + game.history[-1] + '*'
+        else:
+            lastmove = 'None'
+
+        description = "Last move:" + lastmove
+        if game.game_status == '':
+            # Discord counts the relative timestamp down by itself, the board is not edited for it
+            left = self.clock.left(game.turn)
+            description += "\n" + self.clock.describe() + "\n" + TEAMS[game.turn] + " runs out of time <t:" + str(int(time.time() + left)) + ":R>"
+        payload = disnake.Embed(title = TEAMS[game.turn] + " to play.", description = description)
+        payload.set_image(url = "attachment://board.png")
+        with metrics.timer('render'):
+            png = await renderer.png(game)
+
+        with metrics.timer('send_board'):
+            await outgoing.send(self.channel, outbox.URGENT, embed = payload, file = disnake.File(io.BytesIO(png), filename = "board.png"))
+
+    def played(self):
+        """Bookkeeping for an accepted move."""
+        metrics.count('moves')
+        self.history.append(self.game.stack[-1][0])
+        self.clock.press()
+        self.arm() # now, the deadline of the side that moved may pass while the board is posted
+        self.turnstart = time.time()
+        self.game.all_moves() # gives the SAN its + or # before it is stored, checkgamestatus() then reuses the moves
+        if self.store is not None:
+            self.store.move(self, self.game.history[-1])
+
+    async def advance(self):
+        """Shows the position after a move, then waits for the next one or ends the game."""
+        self.game.checkgamestatus()
+        if self.game.game_status == '' and TABLEBASES is not None and ADJUDICATE:
+            self.adjudicate()
+        await self.postboard()
+
+        if self.game.game_status != '':
+            await self.finish()
+            return
+
+        if self.game.turn == self.engine_color:
+            self.task = asyncio.get_running_loop().create_task(self.enginemove())
+        else:
+            self.legalmoves() # the autocomplete and the translate of the next move both use it
+
+    def adjudicate(self):
+        result = tablebase.probe(self.game, TABLEBASES)
+        if result is None:
+            return
+        wdl, dtm = result
+        if wdl == 0:
+            self.game.game_status = 'Draw: the tablebase says nobody can win'
+        else:
+            self.result = self.game.turn * wdl
+            winner = {1: 'White', -1: 'Black'}[self.result]
+            self.game.game_status = winner + ' Wins: the tablebase has mate in ' + str((dtm + 1) // 2)
+
+    def arm(self):
+        """Puts the flag fall of the side to play in the scheduler, in place of the previous one."""
+        if self.timer is not None:
+            scheduler.cancel(self.timer)
+        self.timer = scheduler.at(self.clock.deadline(), self.ontimeout)
+
+    def ontimeout(self):
+        if self.game.game_status != '' or not self.clock.flagged():
+            return
+        metrics.count('timeouts')
+        if self.timer is not None:
+            scheduler.cancel(self.timer)
+            self.timer = None
+        self.result = -self.game.turn
+        self.game.game_status = '> ' + TEAMS[self.game.turn] + " `lost` on time."
+        self.task = asyncio.get_running_loop().create_task(self.finish())
+
+    async def finish(self):
+        if self.timer is not None:
+            scheduler.cancel(self.timer)
+            self.timer = None
+        if self.registry is not None:
+            self.registry.remove(self)
+        metrics.count('games_finished')
+        if self.store is not None:
+            self.store.finish(self)
+        if STATS is not None:
+            asyncio.get_running_loop().create_task(STATS.record(self.id, self.lobby.guild.id, self.outcome(), len(self.game.history), dict(self.players)))
+        if ARCHIVE is not None:
+            asyncio.get_running_loop().create_task(ARCHIVE.record(self.id, self.lobby.guild.id, self.game, self.outcome(), dict(self.players), self.engine_color))
+        await outgoing.send(self.channel, outbox.URGENT, content = '> **' + self.game.game_status + '**')
+
+    def outcome(self):
+        if self.result is not None:
+            return self.result
+        if 'Wins' in self.game.game_status:
+            return -self.game.turn # checkmated
+        return 0
+
+    def enginebudget(self):
+        """Seconds of search the engine's clock affords for this move: its share of the time left plus most
+        of what the increment or delay gives back, ENGINE_BUDGET at most, never enough to run out."""
+        control = self.clock.control
+        left = self.clock.left(self.engine_color)
+        budget = min(ENGINE_BUDGET, max(left - control.delay, 0.0) / ENGINE_MOVES + 0.8 * (control.increment + control.delay))
+        return min(max(budget, ENGINE_FLOOR), max(left - ENGINE_MARGIN, 0.0))
+
+    async def enginemove(self):
+        budget = self.enginebudget()
+        with metrics.timer('engine'):
+            # waiting for a free worker counts on the clock too, the search ends by the same wall time anyway
+            result = await asyncio.get_running_loop().run_in_executor(engine_pool, engine.think, list(self.game.history), budget, None, BOOK, TABLEBASES, time.time() + budget)
+        async with self.lock:
+            if self.game.game_status != '':
+                return
+            self.game.playturn(result.notation)
+            self.played()
+            if result.source == 'book':
+                await outgoing.send(self.channel, outbox.URGENT, content = "> Engine played **{}** (book)".format(result.notation))
+            elif result.source == 'tablebase':
+                await outgoing.send(self.channel, outbox.URGENT, content = "> Engine played **{}** (tablebase)".format(result.notation))
+            else:
+                await outgoing.send(self.channel, outbox.URGENT, content = "> Engine played **{}** (depth {}, {} nodes, {:.0f} nodes/s)".format(result.notation, result.depth, result.nodes, result.nps))
+            await self.advance()
+
+    def legalmoves(self):
+        """(ply, sankeys, SANs) of the legal moves of the position, built once per turn."""
+        ply = len(self.game.history)
+        if self.legal is None or self.legal[0] != ply:
+            self.game.santable()
+            moves = sorted((chess.sankey(san).lower(), san) for san in self.game.sanmoves.values())
+            self.legal = (ply, [key for key, _ in moves], [san for _, san in moves])
+        return self.legal
+
+    def suggestions(self, prefix):
+        """Legal SAN moves starting like prefix, whatever its case, captures and check marks: nf or Nxf3 both give Nxf3."""
+        if self.game.game_status != '':
+            return []
+        _, keys, sans = self.legalmoves()
+        prefix = chess.sankey(prefix.strip()).lower()
+        first = bisect.bisect_left(keys, prefix)
+        last = first
+        while last < len(keys) and last - first < AUTOCOMPLETE and keys[last].startswith(prefix):
+            last += 1
+        return sans[first:last]
+
+    def allowed(self, member):
+        """Whether member is in the team to play."""
+        game = self.game
+        return game.turn != self.engine_color and self.roles[(game.turn-1)//2] in getattr(member, 'roles', ())
+
+    async def handle(self, message):
+        """Called by the dispatcher for every message sent in this game's thread."""
+        if not self.allowed(message.author):
+            return
+        error = await self.submit(message.author, message.content)
+        if error is not None:
+            outgoing.reply(self.channel, error)
+
+    async def submit(self, member, move):
+        """Plays move for member, from a message or /move. Returns why it was refused, None if it was played."""
+        game = self.game
+        async with self.lock:
+            if game.game_status != '':
+                return 'The game is over.'
+            if self.clock.flagged():
+                # the scheduler has not got to it yet, a move sent too late is not played
+                self.ontimeout()
+                return 'Out of time.'
+            start = time.perf_counter()
+            try:
+                if move == 'resign':
+                    game.game_status = TEAMS[game.turn] + ' resigns.'
+                    self.result = -game.turn
+                    await self.finish()
+                    return None
+                color = game.turn
+                with metrics.timer('playturn'):
+                    game.playturn(move)
+                self.players[member.id] = (color, self.players.get(member.id, (color, 0))[1] + 1)
+                self.played()
+            except chess.InvalidMove:
+                metrics.count('invalid_moves')
+                return 'Invalid Move (can be my fault)'
+            except chess.AmbiguousMove:
+                metrics.count('invalid_moves')
+                return 'Ambiguous Move'
+            except chess.ParseError:
+                metrics.count('invalid_moves')
+                return 'Failed to parse Move'
+            await self.advance()
+            metrics.observe('turn', time.perf_counter() - start)
+            return None
+
+
+class SessionRegistry:
+    """Running sessions by channel id, and the channel ids of each guild's games."""
+    def __init__(self):
+        self.sessions = {}
+        self.guilds = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, session):
+        session.registry = self
+        self.sessions[session.id] = session
+        self.guilds.setdefault(session.lobby.guild.id, set()).add(session.id)
+
+    def remove(self, session):
+        if self.sessions.pop(session.id, None) is not None:
+            ids = self.guilds[session.lobby.guild.id]
+            ids.discard(session.id)
+            if not ids:
+                del self.guilds[session.lobby.guild.id]
+
+    def get(self, channel_id):
+        return self.sessions.get(channel_id)
+
+    def inguild(self, guild_id):
+        return [self.sessions[id] for id in self.guilds.get(guild_id, ())]
+
+    async def dispatch(self, message):
+        session = self.sessions.get(message.channel.id)
+        if session is not None and not message.author.bot:
+            await session.handle(message)
+
+
+async def resume(bot, registry, store, owns = None, resources = None):
+    """Rebuilds every unfinished game of store by replaying its moves, and re-attaches it to its threads.
+    owns(guild_id) limits it to the guilds of this shard process, resources is the guildindex.GuildIndex
+    to find the team roles in."""
+    for stored in await store.running(owns):
+        if registry.get(stored.id) is not None:
+            continue
+        try:
+            channel = bot.get_channel(stored.id) or await bot.fetch_channel(stored.id)
+            lobby = bot.get_channel(stored.lobby) or await bot.fetch_channel(stored.lobby)
+            thread = bot.get_channel(stored.thread) or await bot.fetch_channel(stored.thread)
+        except disnake.HTTPException as e:
+            print('Could not resume game', stored.id, e)
+            continue
+
+        game = chess.Game(backend = 'bitboard')
+        try:
+            for move in stored.moves:
+                game.all_moves()
+                game.playturn(move)
+        except (chess.InvalidMove, chess.AmbiguousMove, chess.ParseError):
+            print('Could not replay game', stored.id)
+            continue
+
+        if resources is not None:
+            roles = resources.teams(lobby.guild)
+        else:
+            roles = [disnake.utils.get(lobby.guild.roles, name="chessbot team white"), disnake.utils.get(lobby.guild.roles, name="chessbot team black")]
+        clock = clocks.Clock.loads(stored.clock) if stored.clock else clocks.Clock()
+        session = Session(game, lobby, roles, stored.engine_color, store, clock)
+        session.players = stored.players
+        session.channel, session.thread = channel, thread
+        if stored.thread_msg is not None:
+            # its buttons answer by custom_id, nothing to fetch or attach
+            session.thread_msg = disnake.Object(stored.thread_msg)
+
+        registry.add(session)
+        await session.restore(stored.updated - stored.turnstart)
@@ -1,8 +1,10 @@
 import re
-import copy
 
 import numpy as np
 
+import bitboards
+import zobrist
+
 class InvalidMove(Exception):
     pass
 
@@ -12,6 +14,28 @@ class AmbiguousMove(Exception):
 class ParseError(Exception):
     pass
 
+SANCLEAN = re.compile(r'e\.p\.|[\sx:=+#!?()-]')
+SANSYNTAX = re.compile(r'[KQRBNP]?[a-h]?[1-8]?[a-h][1-8][QRBN]?|[a-h]{2}[QRBN]?|O-?O(-?O)?')
+
+def sankey(move):
+    """Move input without what does not change its meaning: Nxf3+ and N-f3 are Nf3, exd5 is ed5, 0-0 is OO, e7e8q is e7e8Q."""
+    key = SANCLEAN.sub('', move)
+    if key and set(key) <= set('O0o'):
+        return 'O' * len(key)
+    if len(key) > 2 and key[-1] in 'qrbn' and key[-2] in '18':
+        key = key[:-1] + key[-1].upper()
+    return key
+
+# the four quarter turns of each knight, king, rook and bishop step, in the order the pieces try them
+def quarterturns(step):
+    turns = []
+    for i in range(4):
+        step = (-step[1], step[0])
+        turns.append(step)
+    return turns
+
+TURNS = {step: quarterturns(step) for step in [(2, 1), (2, -1), (1, 0), (1, 1)]}
+
 class Piece:
 
     chess_symbols = {1: {'K': '♔', 'Q': '♕', 'B': '♗', 'N': '♘', 'P': '♙', 'R': '♖'}, -1: {'K': '♚', 'Q': '♛', 'B': '♝', 'N': '♞', 'P': '♟', 'R': '♜'}}
@@ -41,47 +65,43 @@ class Piece:
 
     @staticmethod
     def is_inside(index):
-        return np.min(index) >= 0 and np.max(index) <= 7
-
-    @staticmethod
-    def rotation90(point, center = np.array([0,0])):
-        return (point - center)[::-1] * (-1, 1) + center
+        return 0 <= index[0] <= 7 and 0 <= index[1] <= 7
 
     def merrygoround(self, board, shift, attacker = False):
-        point = np.array(self.pos) + shift
-        for i in range(4):
-            point = Piece.rotation90(point, np.array(self.pos))
-            if Piece.is_inside(point) and (board[tuple(point)] is None or attacker or board[tuple(point)].color != self.color):
-                self.moves.append(tuple(point))
-                if board[tuple(point)] is not None and board[tuple(point)].type == 'K':
-                    board[tuple(point)].incheck.append(self.pos)
+        row, col = self.pos
+        for drow, dcol in TURNS[shift]:
+            point = (row + drow, col + dcol)
+            if 0 <= point[0] <= 7 and 0 <= point[1] <= 7 and (board[point] is None or attacker or board[point].color != self.color):
+                self.moves.append(point)
+                if board[point] is not None and board[point].type == 'K':
+                    board[point].incheck.append(self.pos)
 
     def straightline(self, board, increment, attacker = False):
-        for i in range(4):
-            increment = Piece.rotation90(increment)
-            point = np.array(self.pos) + increment
+        for drow, dcol in TURNS[increment]:
+            row, col = self.pos[0] + drow, self.pos[1] + dcol
             block = []
-            while Piece.is_inside(point):
-                cur = board[tuple(point)]
+            while 0 <= row <= 7 and 0 <= col <= 7:
+                point = (row, col)
+                cur = board[point]
                 if cur is None:
-                    self.moves.append(tuple(point))
-                    block.append(tuple(point))
+                    self.moves.append(point)
+                    block.append(point)
                 elif cur.color == self.color:
                     if attacker:
-                        self.moves.append(tuple(point))
+                        self.moves.append(point)
                     break
 
                 elif cur.color != self.color:
-                    self.moves.append(tuple(point))
-                    if board[tuple(point)] is not None and board[tuple(point)].type == 'K':
-                        board[tuple(point)].incheck.append(self.pos)
-                        board[tuple(point)].blockcheck += block
-
-                    point += increment
-                    if Piece.is_inside(point) and board[tuple(point)] is not None and board[tuple(point)].type == 'K':
-                        board[tuple(point - increment)].pinned = set(block+[self.pos])
+                    self.moves.append(point)
+                    if cur.type == 'K':
+                        cur.incheck.append(self.pos)
+                        cur.blockcheck += block
+
+                    row, col = row + drow, col + dcol
+                    if 0 <= row <= 7 and 0 <= col <= 7 and board[row, col] is not None and board[row, col].type == 'K':
+                        cur.pinned = set(block+[self.pos])
                     break
-                point += increment
+                row, col = row + drow, col + dcol
 
     def diag1(self, board, side, forward_side, attacker = False):
         if Piece.is_inside(forward_side) and board[forward_side] is not None and board[forward_side].color != self.color:
@@ -95,7 +115,6 @@ class Piece:
 
         if Piece.is_inside(side) and board[side] is not None and board[side].color != self.color and board[side].sp == 'En Passant':
             self.moves.append(forward_side)
-            print('yo')
 
     def reset(self):
         self.moves = []
@@ -111,17 +130,18 @@ class Piece:
 
         if self.type == 'P':
 
-            forward = tuple(np.array(self.pos) + (self.color, 0))
+            row, col = self.pos
+            forward = (row + self.color, col)
 
             if Piece.is_inside(forward) and board[forward] is None and king is not None:
                 self.moves.append(forward)
 
-                forward2 = tuple(np.array(self.pos) + (self.color * 2, 0))
+                forward2 = (row + self.color * 2, col)
                 if (self.pos[0] * self.color) % 7 == 1 and board[forward2] is None:
                     self.moves.append(forward2)
 
-            self.diag1(board, tuple(np.array(self.pos) + (0, -1)), tuple(np.array(self.pos) + (self.color, -1)), attacker)
-            self.diag1(board, tuple(np.array(self.pos) + (0, 1)), tuple(np.array(self.pos) + (self.color, 1)), attacker)
+            self.diag1(board, (row, col - 1), (row + self.color, col - 1), attacker)
+            self.diag1(board, (row, col + 1), (row + self.color, col + 1), attacker)
 
 
         elif self.type == 'N':
@@ -135,9 +155,9 @@ class Piece:
 
             backrank = {1: 0, -1: 7}[self.color]
 
-            if board[backrank, 7] is not None and self.sp == 'Castle' == board[backrank, 7].sp and {(backrank, i) for i in range(4, 7)}.intersection(attacked_set) == set() and np.equal(board[backrank,5:7], None).all():
+            if board[backrank, 7] is not None and self.sp == 'Castle' == board[backrank, 7].sp and {(backrank, i) for i in range(4, 7)}.intersection(attacked_set) == set() and board[backrank, 5] is None and board[backrank, 6] is None:
                 self.moves.append((backrank, 6))
-            if board[backrank, 0] is not None and self.sp == 'Castle' == board[backrank, 0].sp and {(backrank, i) for i in range(2, 5)}.intersection(attacked_set) == set() and np.equal(board[backrank,2:4], None).all():
+            if board[backrank, 0] is not None and self.sp == 'Castle' == board[backrank, 0].sp and {(backrank, i) for i in range(2, 5)}.intersection(attacked_set) == set() and board[backrank, 2] is None and board[backrank, 3] is None:
                 self.moves.append((backrank, 2))
             self.moves = list(set(self.moves) - attacked_set)
 
@@ -157,20 +177,25 @@ class Piece:
             elif len(king.incheck) == 1:
                 self.moves = list(set(self.moves).intersection(set(king.incheck + king.blockcheck)))
 
-    def move(self, board, pieces, to, promote = None):
-        side = tuple(np.array(to) + (-self.color, 0))
+    def move(self, board, pieces, to, promote = None, validate = True):
+        """Plays the move and returns the Zobrist key difference of the pieces it moved, took or promoted.
+        validate = False skips the check against self.moves, for callers that already know the move is legal."""
+        side = (to[0] - self.color, to[1])
         if promote is None:
             promote = 'Q'
 
-        if to in self.moves:
+        if not validate or to in self.moves:
+            key = zobrist.piece(self.color, self.type, self.pos)
 
             if self.type != 'K':
                 self.sp = ''
 
             if board[to] is not None:
+                key ^= zobrist.piece(board[to].color, board[to].type, to)
                 pieces[board[to].id] = None
 
             elif self.type == 'P' and board[to] is None and board[side] is not None and board[side].sp == 'En Passant':
+                key ^= zobrist.piece(board[side].color, board[side].type, side)
                 pieces[board[side].id] = None
                 board[side] = None
 
@@ -182,6 +207,7 @@ class Piece:
 
             board[self.pos], board[to] = None, self
             self.pos = to
+            key ^= zobrist.piece(self.color, self.type, to)
 
             if self.type == 'K' and self.sp == 'Castle':
                 if to[1] % 4 == 2:
@@ -193,14 +219,23 @@ class Piece:
                         rook_from = (self.pos[0], 7)
                         rook_to = (self.pos[0], 5)
 
+                    key ^= zobrist.piece(self.color, 'R', rook_from) ^ zobrist.piece(self.color, 'R', rook_to)
                     board[rook_from].pos = rook_to
                     board[rook_from], board[rook_to] = None, board[rook_from]
                 self.sp = ''
+            return key
         else:
             raise InvalidMove
 
 class Game:
-    def __init__(self):
+    backends = {'objects', 'bitboard'}
+    startkey = None # Zobrist key of the starting position, computed by the first game
+
+    def __init__(self, backend = 'objects'):
+        if backend not in Game.backends:
+            raise ValueError('Unknown move generation backend: ' + str(backend))
+        self.backend = backend
+
         piecetype = ['R', 'N', 'B', 'Q', 'K', 'B', 'N', 'R']
         self.pieces = np.array([[[Piece(1, 'P', (1, i), (0, 0, i)) for i in range(8)],  # white pawns
                             [Piece(1, piecetype[i], (0, i), (0, 1, i)) for i in range(8)]], # white pieces
@@ -213,19 +248,160 @@ class Game:
         self.board[6:, :] = self.pieces[1]
 
         self.turn = 1
-        self.allpositions = []
         self.moves = [[],[]] # white moves, black moves
         self.game_status = ''
         self.fiftymoves = 0
+        self.fullmove = 1 # FEN move number, goes up after each black move
         self.history = []
         self.lastmove = ''
-        self.regex_translate = re.compile('((?P<piece>[BKNPQR])?(?P<from_y>[a-h])?(?P<from_x>[1-8])?(?P<takes>x)?(?P<to_yx>[a-h][1-8])(?P<promote>=[BNQR])?|(?P<long>O-O-O)|(?P<short>O-O))(?P<check>\+)?(?P<mate>#)?')
-        self.regex_pawnortakes = re.compile('[Px]')
+        self.stack = [] # what pop needs to take back each pushed move
+        self.enpassant = None # square skipped by a pawn that just moved two squares
+        self.fresh = False # whether Piece.moves are those of the current position
+        self.sans = None # santable of the current position, built on demand
+        self.sanmoves = {}
+        self.checkpending = False
+
+        if Game.startkey is None:
+            Game.startkey = self.computekey()
+        self.position_key = Game.startkey
+        self.repetitions = {self.position_key: 1} # position key -> times the position was reached
+    @classmethod
+    def from_fen(cls, fen, backend = 'objects'):
+        """Sets up a game from a FEN: placement, side to move, castling, en passant, halfmove clock and move number."""
+        fields = fen.split()
+        if len(fields) < 4:
+            raise ParseError
+
+        self = cls(backend)
+        self.pieces = np.full((2, 2, 8), None)
+        self.board = np.full((8, 8), None)
+
+        ranks = fields[0].split('/')
+        if len(ranks) != 8:
+            raise ParseError
+        for row, rank in enumerate(ranks[::-1]):
+            col = 0
+            for char in rank:
+                if char.isdigit():
+                    col += int(char)
+                    continue
+                if char.upper() not in Piece.chess_symbols[1] or col > 7:
+                    raise ParseError
+                color = 1 if char.isupper() else -1
+                type = char.upper()
+                current = {1: 0, -1: 1}[color]
+                if type == 'K':
+                    slots = [(current, 1, 4)]
+                elif type == 'P':
+                    slots = [(current, 0, i) for i in range(8)]
+                else:
+                    slots = [(current, 1, i) for i in range(8) if i != 4] + [(current, 0, i) for i in range(8)]
+                id = next((slot for slot in slots if self.pieces[slot] is None), None)
+                if id is None:
+                    raise ParseError
+                piece = Piece(color, type, (row, col), id)
+                piece.sp = ''
+                self.pieces[id] = piece
+                self.board[row, col] = piece
+                col += 1
+        if self.pieces[0, 1, 4] is None or self.pieces[1, 1, 4] is None:
+            raise ParseError
+
+        if fields[1] not in {'w', 'b'} or (fields[3] != '-' and (len(fields[3]) != 2 or fields[3][0] not in 'abcdefgh' or fields[3][1] not in '36')):
+            raise ParseError
+        self.turn = {'w': 1, 'b': -1}[fields[1]]
+
+        for char, row, col in (('K', 0, 7), ('Q', 0, 0), ('k', 7, 7), ('q', 7, 0)):
+            if char in fields[2]:
+                for pos in ((row, 4), (row, col)):
+                    if self.board[pos] is not None:
+                        self.board[pos].sp = 'Castle'
+
+        if fields[3] != '-':
+            self.enpassant = int(fields[3][1]) - 1, ord(fields[3][0]) - 97
+            pawn = self.board[self.enpassant[0] - self.turn, self.enpassant[1]]
+            if pawn is not None:
+                pawn.sp = 'En Passant'
+
+        try:
+            if len(fields) > 4:
+                self.fiftymoves = int(fields[4])
+            if len(fields) > 5:
+                self.fullmove = max(int(fields[5]), 1)
+        except ValueError:
+            raise ParseError
+
+        self.position_key = self.computekey()
+        self.repetitions = {self.position_key: 1}
+        return self
+
+    def fen(self):
+        """FEN of the current position, Game.from_fen gives it back with all its state."""
+        rows = []
+        for row in range(7, -1, -1):
+            text, empty = '', 0
+            for piece in self.board[row]:
+                if piece is None:
+                    empty += 1
+                    continue
+                if empty:
+                    text, empty = text + str(empty), 0
+                text += piece.type if piece.color == 1 else piece.type.lower()
+            rows.append(text + (str(empty) if empty else ''))
+
+        rights = self.castlingrights()
+        castling = ''.join(char for bit, char in zip((1, 2, 4, 8), 'KQkq') if rights & bit) or '-'
+        enpassant = '-' if self.enpassant is None else chr(self.enpassant[1] + 97) + str(self.enpassant[0] + 1)
+        return ' '.join(['/'.join(rows), 'w' if self.turn == 1 else 'b', castling, enpassant, str(self.fiftymoves), str(self.fullmove)])
+
     def __repr__(self):
 
         return str(np.select([np.equal(self.board, None)], [''] ,self.board)[::-1]).replace(' [', '').replace('[', '').replace(']', '').replace("''",'.')
 
+    def castlingrights(self):
+        """Castling rights as Polyglot bits: 1 white short, 2 white long, 4 black short, 8 black long."""
+        rights = 0
+        for color, row, bit in ((1, 0, 1), (-1, 7, 4)):
+            king = self.board[row, 4]
+            if king is None or king.type != 'K' or king.color != color or king.sp != 'Castle':
+                continue
+            for col, shift in ((7, 0), (0, 1)):
+                rook = self.board[row, col]
+                if rook is not None and rook.type == 'R' and rook.color == color and rook.sp == 'Castle':
+                    rights |= bit << shift
+        return rights
+
+    def enpassantkey(self):
+        # like Polyglot, the en-passant column only counts when a pawn is there to take
+        if self.enpassant is None:
+            return 0
+        row = self.enpassant[0] - self.turn
+        for col in (self.enpassant[1] - 1, self.enpassant[1] + 1):
+            if 0 <= col <= 7 and self.board[row, col] is not None and self.board[row, col].type == 'P' and self.board[row, col].color == self.turn:
+                return zobrist.enpassant(self.enpassant[1])
+        return 0
+
+    def computekey(self):
+        """Zobrist key of the position from scratch, playturn keeps position_key up to date incrementally."""
+        key = zobrist.castling(self.castlingrights()) ^ self.enpassantkey()
+        for piece in self.pieces.flat:
+            if piece is not None:
+                key ^= zobrist.piece(piece.color, piece.type, piece.pos)
+        if self.turn == 1:
+            key ^= zobrist.TURN
+        return key
+
     def all_moves(self):
+        if self.backend == 'bitboard':
+            bitboards.all_moves(self)
+        else:
+            self.objects_moves()
+        self.fresh = True
+        self.sans = None
+        if self.checkpending:
+            self.markcheck()
+
+    def objects_moves(self):
         dico = {1 : (0,1), -1: (1,0)}
         current, opponent = dico[self.turn]
 
@@ -261,8 +437,7 @@ class Game:
                 self.game_status = dico[-king.color] + ' Wins'
 
     def threefoldrepetition(self):
-        self.allpositions.append(copy.deepcopy(self.pieces))
-        if np.all(self.allpositions == self.pieces, axis = (1,2,3)).sum() == 3:
+        if self.repetitions[self.position_key] >= 3:
             self.game_status = 'Draw by repetition'
 
     def insufficientmaterial(self):
@@ -279,113 +454,203 @@ class Game:
             self.game_status = 'Draw by insufficient material'
 
     def fiftymovesrule(self):
-        if self.lastmove != '' and self.regex_pawnortakes.match(self.lastmove):
-            self.fiftymoves = 0
-        else:
-            self.fiftymoves += 1
-
-        if self.fiftymoves == 100:
+        if self.fiftymoves >= 100:
             self.game_status = 'Draw by 50-move rule'
 
     def translate(self, move):
-        match = self.regex_translate.match(move)
-        if match is None:
-            raise ParseError
-
-        piece = match.group('piece')
-        from_x = match.group('from_x')
-        from_y = match.group('from_y')
-        to_yx = match.group('to_yx')
-        promote = match.group('promote')
-        long = match.group('long')
-        short = match.group('short')
-        takes = match.group('takes')
-        check = match.group('check')
-        mate = match.group('mate')
-
-        dico = {1: 0, -1: 1}
-        current = dico[self.turn]
-        king = self.pieces[current][1, 4]
-
-        if piece is None:
-            piece = 'P'
-
-        if to_yx is not None:
-            to = int(to_yx[1]) - 1, ord(to_yx[0]) - 97
-
-
-            if from_x is not None:
-                x = int(from_x) - 1
-
-            if from_y is not None:
-                y = ord(from_y) - 97
-
-            elif piece == 'P':
-                from_y = to_yx[0]
-                y = ord(from_y) - 97
-
-
-            if from_x is None or from_y is None:
-                possiblepieces = []
-                if from_x is not None:
-                    for p in self.board[x, :]:
-                        if p is not None and p.type == piece and p.color == self.turn and (to in p.moves):
-                            possiblepieces.append(p)
-
-                elif from_y is not None:
-                    for p in self.board[:, y]:
-                        if p is not None and p.type == piece and p.color == self.turn and (to in p.moves):
-                            possiblepieces.append(p)
-
+        """(origin, to, canonical SAN, promote) of the legal move written as move, a single lookup in santable."""
+        key = sankey(move)
+        table = self.santable()
+        if key not in table:
+            raise InvalidMove if SANSYNTAX.fullmatch(key) else ParseError
+        if table[key] is None:
+            raise AmbiguousMove
+        origin, to, promote = table[key]
+        return origin, to, self.sanmoves[table[key]], promote
+
+    def santable(self):
+        """{sankey of an input: (origin, to, promote)} for every legal move, built once per position.
+        Every move is under its SAN and its long, UCI and lenient spellings (Ng1f3, g1f3, ed5...),
+        a spelling that fits several moves (Nd2 when both knights can go) maps to None."""
+        if self.sans is None:
+            if not self.fresh:
+                self.all_moves()
+            self.buildsans()
+        return self.sans
+
+    def san(self, move):
+        """Canonical SAN of a legal (origin, to, promote) move, without the check suffix."""
+        self.santable()
+        return self.sanmoves[move]
+
+    def buildsans(self):
+        moves = self.legal_moves()
+        targets = {}
+        for origin, to, _ in moves:
+            targets.setdefault((self.board[origin].type, to), set()).add(origin)
+
+        self.sanmoves = {}
+        self.sans = {}
+        aliases = []
+        for move in moves:
+            origin, to, promote = move
+            piece = self.board[origin]
+            file, rank = chr(origin[1] + 97), str(origin[0] + 1)
+            square = chr(to[1] + 97) + str(to[0] + 1)
+
+            if piece.type == 'K' and abs(to[1] - origin[1]) == 2:
+                san = 'O-O' if to[1] == 6 else 'O-O-O'
+                spellings = ['K' + square, 'K' + file + rank + square]
+            elif piece.type == 'P':
+                san = (file + 'x' if to[1] != origin[1] else '') + square + ('=' + promote if promote else '')
+                spellings = ['P' + san, 'P' + file + rank + square + (promote or '')]
+                if to[1] != origin[1]:
+                    spellings += [file + square[0] + (promote or ''), 'P' + square + (promote or '')] # ed, Pxd5
+            else:
+                others = targets[piece.type, to] - {origin}
+                if not others:
+                    disambiguation = ''
+                elif all(other[1] != origin[1] for other in others):
+                    disambiguation = file
+                elif all(other[0] != origin[0] for other in others):
+                    disambiguation = rank
                 else:
-                    for p in self.pieces[current].flatten():
-                        if p is not None and p.type == piece and (to in p.moves):
-                            possiblepieces.append(p)
+                    disambiguation = file + rank
+                san = piece.type + disambiguation + ('x' if self.board[to] is not None else '') + square
+                spellings = [piece.type + square, piece.type + file + square, piece.type + rank + square, piece.type + file + rank + square]
+            spellings.append(Game.longnotation(move))
+
+            self.sanmoves[move] = san
+            self.sans[sankey(san)] = move
+            aliases += [(move, spelling) for spelling in spellings]
+
+        canonical = set(self.sans)
+        for move, alias in aliases:
+            key = sankey(alias)
+            if key not in canonical:
+                self.sans[key] = move if self.sans.get(key, move) == move else None
+
+    def markcheck(self):
+        # the SAN of the last move gets its + or # once the replies are known
+        self.checkpending = False
+        king = self.pieces[{1: 0, -1: 1}[self.turn]][1, 4]
+        if king.incheck and self.history and self.history[-1][-1] not in '+#':
+            self.history[-1] += '#' if not self.moves[{1: 0, -1: 1}[self.turn]] else '+'
 
-                if len(possiblepieces) == 0:
-                    raise InvalidMove
-                elif len(possiblepieces) >= 2:
-                    raise AmbiguousMove
+    def checkgamestatus(self):
+        if not self.fresh:
+            self.all_moves()
 
-                else:
-                    x,y = possiblepieces[0].pos
+        self.threefoldrepetition()
+        self.insufficientmaterial()
+        self.fiftymovesrule()
+        self.checkmate()
 
-        if long is not None:
-            piece = 'K'
-            to = king.pos[0], 2
-            x,y = king.pos
-            notation = move
-        elif short is not None:
-            piece = 'K'
-            to = king.pos[0], 6
-            x, y = king.pos
-            notation = move
 
-        if to_yx is not None:
-            notation = piece + str(x+1) + chr(y+97) + (takes or '') + to_yx + (check or '') + (mate or '') + (promote or '')
 
+    @staticmethod
+    def longnotation(move):
+        """(origin, to, promote) tuple as from and to squares, like e2e4 or e7e8q."""
+        origin, to, promote = move
+        return chr(origin[1] + 97) + str(origin[0] + 1) + chr(to[1] + 97) + str(to[0] + 1) + (promote or '').lower()
+
+    def legal_moves(self):
+        """(origin, to, promote) for every legal move of the side to play, all_moves must have been called."""
+        current = {1: 0, -1: 1}[self.turn]
+        moves = []
+        for piece in self.pieces[current].flat:
+            if piece is not None:
+                for to in piece.moves:
+                    if piece.type == 'P' and to[0] in {0, 7}:
+                        moves += [(piece.pos, to, promote) for promote in 'QRBN']
+                    else:
+                        moves.append((piece.pos, to, None))
+        return moves
+
+    def push(self, move):
+        """Plays move, either user input like playturn or an (origin, to, promote) tuple from legal_moves.
+        Tuples are not checked, so they stay valid after all_moves ran on a deeper position."""
+        if isinstance(move, str):
+            origin, to, notation, promote = self.translate(move)
+            validate = True
+        else:
+            origin, to, promote = move
+            notation = Game.longnotation(move)
+            validate = False
+
+        piece = self.board[origin]
+        captured = self.board[to]
+        if captured is None and piece.type == 'P' and to[1] != origin[1]:
+            captured = self.board[origin[0], to[1]] # en passant
+        rook = None
+        if piece.type == 'K' and piece.sp == 'Castle' and to[1] in {2, 6}:
+            rook = self.board[origin[0], {2: 0, 6: 7}[to[1]]]
+
+        undo = ((origin, to, promote), piece, piece.type, piece.sp, captured, rook, self.enpassant, self.fiftymoves, self.position_key, self.lastmove, self.game_status)
+
+        key = self.position_key ^ zobrist.castling(self.castlingrights()) ^ self.enpassantkey()
+        key ^= piece.move(self.board, self.pieces, to, promote, validate)
+        self.stack.append(undo)
+
+        if piece.type == 'P' and abs(to[0] - origin[0]) == 2:
+            self.enpassant = ((origin[0] + to[0]) // 2, to[1])
+        else:
+            self.enpassant = None
+        if undo[2] == 'P' or captured is not None:
+            self.fiftymoves = 0
+        else:
+            self.fiftymoves += 1
 
-        if promote is not None:
-            promote = promote[1]
+        if self.turn == -1:
+            self.fullmove += 1
+        self.turn *= -1
+        self.history.append(notation)
+        self.checkpending = isinstance(move, str)
+        self.fresh = False
+        self.sans = None
+        self.lastmove = notation
+        self.position_key = key ^ zobrist.castling(self.castlingrights()) ^ self.enpassantkey() ^ zobrist.TURN
+        self.repetitions[self.position_key] = self.repetitions.get(self.position_key, 0) + 1
+
+    def pop(self):
+        """Takes back the last pushed move and returns it as an (origin, to, promote) tuple.
+        The board is restored in place, Piece.moves are stale until the next all_moves."""
+        move, piece, type, sp, captured, rook, self.enpassant, self.fiftymoves, key, self.lastmove, self.game_status = self.stack.pop()
+        origin, to, promote = move
+
+        self.repetitions[self.position_key] -= 1
+        if self.repetitions[self.position_key] == 0:
+            del self.repetitions[self.position_key]
+        self.position_key = key
+        self.turn *= -1
+        if self.turn == -1:
+            self.fullmove -= 1
+        self.history.pop()
+        self.checkpending = False
+        self.fresh = False
+        self.sans = None
 
-        return (x,y), to, notation, promote
+        self.board[to] = None
+        piece.type, piece.sp, piece.pos = type, sp, origin
+        self.board[origin] = piece
 
-    def checkgamestatus(self):
-        self.all_moves()
+        if captured is not None:
+            self.board[captured.pos] = captured
+            self.pieces[captured.id] = captured
 
-        self.threefoldrepetition()
-        self.insufficientmaterial()
-        self.fiftymovesrule()
-        self.checkmate()
+        if rook is not None:
+            self.board[rook.pos] = None
+            rook.pos = (origin[0], {2: 0, 6: 7}[to[1]])
+            self.board[rook.pos] = rook
 
+        return move
 
+    def played(self):
+        """[(position key, (origin, to, promote))] of every move pushed, with the key of the position it was played in."""
+        return [(undo[8], undo[0]) for undo in self.stack]
 
     def playturn(self, userinput):
-        origin, to, notation, promote = self.translate(userinput)
-        self.history.append(userinput)
-        self.lastmove = notation
-        self.board[origin].move(self.board, self.pieces, to, promote)
-        self.turn *= -1
+        self.push(userinput)
 
     def play(self):
         while True:
@@ -406,12 +671,13 @@ class Game:
                     break
 
     def pgnreplay(self, pgn):
-        pgn = pgn.replace('+', '').replace('?', '').replace('!', '').replace('\n', ' ').replace('-', '').replace('OOO','O-O-O').replace('OO','O-O')
-        pgn = re.sub('\d+\.','', pgn)
-        pgn = re.sub('  +',' ', pgn)
-        pgn = re.sub('^ | $','', pgn)
-        print(pgn)
-        pgn = pgn.split(' ')
+        import pgnstream # pgnstream imports this module
+
+        game = next(pgnstream.read_games(pgn.splitlines(True)), None)
+        if game is None: # no game in the text at all
+            raise ParseError
+        pgn = game.mainline.moves
+        print(' '.join(pgn))
 
         print(self)
         for move in pgn:
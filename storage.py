@@ -0,0 +1,173 @@
+"""Crash-safe game persistence in SQLite (WAL mode).
+
+Every accepted move is appended to the moves table; every SNAPSHOT_EVERY
+plies the rows of a game are folded into its games.moves column so the log
+stays short. Writes are queued and flushed in batches by one background task
+on a dedicated thread, so a move never waits for the disk.
+
+After a restart, running() gives back every unfinished game with its move
+list, and sessions.resume fast-forwards them. Several shard processes can
+share the file: each one only loads and stamps the games of its own guilds.
+"""
+import json
+import time
+import sqlite3
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+FLUSH_INTERVAL = 0.05 # seconds the writer waits to batch more writes
+HEARTBEAT = 15.0 # seconds between "still running" stamps, used to give back the time left on the clock
+SNAPSHOT_EVERY = 40 # plies
+BUSY_TIMEOUT = 30.0 # seconds to wait for another shard process's write
+ADDED = {'clock': "TEXT DEFAULT ''", 'players': "TEXT DEFAULT ''"} # columns files from older versions lack
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY, -- the game thread
+    guild INTEGER, lobby INTEGER, thread INTEGER, thread_msg INTEGER,
+    engine_color INTEGER, status TEXT DEFAULT '',
+    moves TEXT DEFAULT '', -- JSON list of the moves up to snapshot_ply
+    snapshot_ply INTEGER DEFAULT 0,
+    created REAL, turnstart REAL, updated REAL,
+    clock TEXT DEFAULT '', -- clocks.Clock.dumps() at turnstart
+    players TEXT DEFAULT '' -- JSON {member id: [color, moves played]}
+);
+CREATE TABLE IF NOT EXISTS moves (
+    game INTEGER, ply INTEGER, move TEXT, at REAL,
+    PRIMARY KEY (game, ply)
+);
+'''
+
+StoredGame = collections.namedtuple('StoredGame', 'id guild lobby thread thread_msg engine_color moves turnstart updated clock players')
+
+
+class GameStore:
+    def __init__(self, path = 'chessbot.sqlite3'):
+        self.connection = sqlite3.connect(path, timeout = BUSY_TIMEOUT, check_same_thread = False, isolation_level = None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(games)')]
+        for column, definition in ADDED.items():
+            if column not in columns:
+                try: # another shard process may be adding it too
+                    self.connection.execute('ALTER TABLE games ADD COLUMN {} {}'.format(column, definition))
+                except sqlite3.OperationalError:
+                    pass
+        self.executor = ThreadPoolExecutor(max_workers = 1) # sqlite connections want one thread
+        self.queue = None
+        self.writer = None
+        self.live = set() # ids of the running games of this process, the heartbeat stamps only those
+
+    def start(self):
+        if self.writer is None:
+            self.queue = asyncio.Queue()
+            self.writer = asyncio.get_running_loop().create_task(self.write())
+
+    # these only queue the write and return at once
+
+    def begin(self, session):
+        now = time.time()
+        self.live.add(session.id)
+        self.queue.put_nowait(('INSERT OR REPLACE INTO games (id, guild, lobby, thread, thread_msg, engine_color, created, turnstart, updated, clock) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (session.id, session.lobby.guild.id, session.lobby.id, session.thread.id, session.thread_msg.id if session.thread_msg else None,
+                                session.engine_color, now, session.turnstart, now, session.clock.dumps())))
+
+    def move(self, session, move):
+        ply = len(session.game.history)
+        self.queue.put_nowait(('INSERT OR REPLACE INTO moves VALUES (?, ?, ?, ?)', (session.id, ply, move, session.turnstart)))
+        self.queue.put_nowait(('UPDATE games SET turnstart = ?, thread_msg = ?, clock = ?, players = ? WHERE id = ?',
+                               (session.turnstart, session.thread_msg.id if session.thread_msg else None, session.clock.dumps(), json.dumps(session.players), session.id)))
+        if ply % SNAPSHOT_EVERY == 0:
+            self.queue.put_nowait(('compact', session.id))
+
+    def update(self, session):
+        self.queue.put_nowait(('UPDATE games SET thread_msg = ? WHERE id = ?', (session.thread_msg.id if session.thread_msg else None, session.id)))
+
+    def finish(self, session):
+        self.live.discard(session.id)
+        self.queue.put_nowait(('UPDATE games SET status = ? WHERE id = ?', (session.game.game_status, session.id)))
+        self.queue.put_nowait(('compact', session.id))
+
+    async def flush(self):
+        """Waits until everything queued so far is on disk."""
+        done = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(('flush', done))
+        await done
+
+    async def write(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                ops = [await asyncio.wait_for(self.queue.get(), HEARTBEAT)]
+            except asyncio.TimeoutError:
+                ops = []
+            await asyncio.sleep(FLUSH_INTERVAL)
+            while not self.queue.empty():
+                ops.append(self.queue.get_nowait())
+
+            flushed = [op[1] for op in ops if op[0] == 'flush']
+            ops = [op for op in ops if op[0] != 'flush']
+            now = time.time()
+            ops += [('UPDATE games SET updated = ? WHERE id = ?', (now, id)) for id in self.live]
+            try:
+                await loop.run_in_executor(self.executor, self.commit, ops)
+            except sqlite3.Error as e:
+                print('Could not save games:', e)
+            for done in flushed:
+                if not done.done():
+                    done.set_result(None)
+
+    def commit(self, ops):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE') # take the write lock now, other shard processes may be writing
+        try:
+            for sql, params in ops:
+                if sql == 'compact':
+                    self.compact(params)
+                else:
+                    connection.execute(sql, params)
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def compact(self, game):
+        rows = self.connection.execute('SELECT ply, move FROM moves WHERE game = ? ORDER BY ply', (game,)).fetchall()
+        if not rows:
+            return
+        moves, = self.connection.execute('SELECT moves FROM games WHERE id = ?', (game,)).fetchone()
+        moves = json.dumps((json.loads(moves) if moves else []) + [move for _, move in rows])
+        self.connection.execute('UPDATE games SET moves = ?, snapshot_ply = ? WHERE id = ?', (moves, rows[-1][0], game))
+        self.connection.execute('DELETE FROM moves WHERE game = ?', (game,))
+
+    def load(self, owns = None):
+        games = []
+        for id, guild, lobby, thread, thread_msg, engine_color, moves, turnstart, updated, clock, players in self.connection.execute(
+                "SELECT id, guild, lobby, thread, thread_msg, engine_color, moves, turnstart, updated, clock, players FROM games WHERE status = ''").fetchall():
+            if owns is not None and not owns(guild):
+                continue
+            moves = json.loads(moves) if moves else []
+            moves += [move for move, in self.connection.execute('SELECT move FROM moves WHERE game = ? ORDER BY ply', (id,))]
+            players = {int(member): tuple(played) for member, played in json.loads(players).items()} if players else {}
+            games.append(StoredGame(id, guild, lobby, thread, thread_msg, engine_color, moves, turnstart, updated, clock, players))
+        return games
+
+    def loadmoves(self, game):
+        row = self.connection.execute('SELECT moves FROM games WHERE id = ?', (game,)).fetchone()
+        if row is None:
+            return None
+        moves = json.loads(row[0]) if row[0] else []
+        return moves + [move for move, in self.connection.execute('SELECT move FROM moves WHERE game = ? ORDER BY ply', (game,))]
+
+    async def moves(self, game):
+        """Move list of the game played in thread game, finished or not, None if there is none."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.loadmoves, game)
+
+    async def running(self, owns = None):
+        """StoredGame of every game that was not finished, with its full move list.
+        owns(guild_id) keeps only the games of the guilds of this process."""
+        games = await asyncio.get_running_loop().run_in_executor(self.executor, self.load, owns)
+        self.live.update(game.id for game in games)
+        return games
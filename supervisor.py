@@ -0,0 +1,115 @@
+"""Runs the bot as several processes, each owning some of the gateway shards.
+
+Discord sends the events of a guild to shard (guild_id >> 22) % shard_count,
+so giving each process a set of shards partitions the guilds, and with them
+the games, between processes: a process only ever sees its own games and runs
+their move generation and rendering on its own core.
+
+    python supervisor.py            # .env: shards=8, processes=4 (defaults: one of each per core)
+
+Every worker is chessbot.py started with CHESSBOT_SHARD_IDS and
+CHESSBOT_SHARD_COUNT in its environment. A worker that exits is started again,
+waiting longer each time it dies young. Games survive it in the database and
+come back with the worker; results shared between processes go through
+globalstats.
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+
+from dotenv import dotenv_values
+
+RESTART_DELAY = 5.0 # seconds before restarting a worker that exited...
+MAX_RESTART_DELAY = 300.0 # ...doubled every time it dies young, up to this
+HEALTHY = 120.0 # seconds a worker has to run to be considered started fine
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chessbot.py')
+
+
+def shardof(guild_id, shard_count):
+    return (guild_id >> 22) % shard_count
+
+def partition(shard_count, processes):
+    """Shard ids of each process."""
+    return [list(range(i, shard_count, processes)) for i in range(min(processes, shard_count))]
+
+def owner():
+    """Function telling whether a guild id belongs to this process, None when it is not a shard worker."""
+    ids = os.environ.get('CHESSBOT_SHARD_IDS')
+    if not ids:
+        return None
+    ids = set(int(id) for id in ids.split(','))
+    count = int(os.environ['CHESSBOT_SHARD_COUNT'])
+    return lambda guild_id: shardof(guild_id, count) in ids
+
+
+class Worker:
+    def __init__(self, shard_ids, shard_count):
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.started = 0.0
+        self.restarts = 0
+        self.delay = RESTART_DELAY
+
+    @property
+    def name(self):
+        return 'shards ' + ','.join(map(str, self.shard_ids))
+
+    async def start(self):
+        env = dict(os.environ, CHESSBOT_SHARD_IDS = ','.join(map(str, self.shard_ids)), CHESSBOT_SHARD_COUNT = str(self.shard_count))
+        self.process = await asyncio.create_subprocess_exec(sys.executable, SCRIPT, env = env, cwd = os.path.dirname(SCRIPT))
+        self.started = time.monotonic()
+        print(self.name, 'started, pid', self.process.pid)
+
+    async def watch(self, stopping):
+        while not stopping.is_set():
+            await self.start()
+            code = await self.process.wait()
+            if stopping.is_set():
+                return
+            if time.monotonic() - self.started > HEALTHY:
+                self.delay = RESTART_DELAY
+            print(self.name, 'exited with', code, '- restarting in', self.delay, 'seconds')
+            try:
+                await asyncio.wait_for(stopping.wait(), self.delay)
+            except asyncio.TimeoutError:
+                pass
+            self.delay = min(self.delay * 2, MAX_RESTART_DELAY)
+            self.restarts += 1
+
+    def stop(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+
+
+async def supervise(shard_count, processes):
+    workers = [Worker(ids, shard_count) for ids in partition(shard_count, processes)]
+    stopping = asyncio.Event()
+    def stop():
+        stopping.set()
+        for worker in workers:
+            worker.stop()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop)
+        except NotImplementedError: # windows
+            pass
+    try:
+        await asyncio.gather(*(worker.watch(stopping) for worker in workers))
+    finally:
+        stop()
+
+def main():
+    config = dotenv_values('.env')
+    processes = int(config.get('processes') or os.cpu_count() or 1)
+    shard_count = int(config.get('shards') or processes)
+    print('Running', shard_count, 'shards in', min(processes, shard_count), 'processes')
+    asyncio.run(supervise(shard_count, processes))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
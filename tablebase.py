@@ -0,0 +1,475 @@
+"""Endgame tablebases for up to 4 pieces, generated by retrograde analysis.
+
+    python tablebase.py KQK KRK KPK KBNK KRKP       generate them, and the endings they convert to
+    python tablebase.py KRKP --out tb --workers 4   somewhere else, on 4 processes
+
+A table holds, for every position of an ending with either side to move, the
+result for the side to move (wdl: 1 win, 0 draw, -1 loss) and the distance to
+mate in plies (dtm), saved as NAME.wdl.npy and NAME.dtm.npy and memory-mapped
+when probed. Endings are named by the white pieces then the black ones, the
+stronger side being white; positions with the colours the other way round are
+probed mirrored.
+
+The index is symmetry reduced: the white king is mirrored onto files a-d, and
+onto ranks 1-4 as well when there are no pawns. Castling, en passant and the
+fifty-move rule are ignored.
+
+Generation works on whole arrays of positions at once: a first pass counts the
+moves of every position that stay in the ending and looks up the ones that
+leave it (captures, promotions) in the smaller tables, split in chunks over a
+process pool; then mates are propagated backwards ply by ply, unmaking moves
+from the positions decided at the previous ply.
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import bitboards
+import compactboard
+
+ORDER = 'KQRBNP'
+VALUES = {'K': 0, 'Q': 9, 'R': 5, 'B': 3, 'N': 3, 'P': 1}
+DIRECTORY = 'tablebases'
+CHUNK = 1 << 20 # positions per task of the first pass
+
+SQUARES = np.arange(64)
+ROWS, COLS = SQUARES // 8, SQUARES % 8
+
+def bits(bb):
+    return [bool(bb >> sq & 1) for sq in range(64)]
+
+LEAPS = {'K': np.array([bits(bb) for bb in bitboards.KING_ATTACKS]), 'N': np.array([bits(bb) for bb in bitboards.KNIGHT_ATTACKS])}
+PAWN_CAPTURES = {1: np.array([bits(bb) for bb in bitboards.PAWN_ATTACKS[0]]), -1: np.array([bits(bb) for bb in bitboards.PAWN_ATTACKS[1]])}
+
+# BETWEEN[a, b, sq]: sq is strictly between a and b on a line
+BETWEEN = np.zeros((64, 64, 64), dtype = bool)
+for a in range(64):
+    for b in range(64):
+        BETWEEN[a, b, list(bitboards.squares(bitboards.BETWEEN[a][b]))] = True
+
+DROW, DCOL = ROWS[:, None] - ROWS[None, :], COLS[:, None] - COLS[None, :]
+ALIGNED = {'R': ((DROW == 0) | (DCOL == 0)) & (SQUARES[:, None] != SQUARES[None, :]),
+           'B': (abs(DROW) == abs(DCOL)) & (DROW != 0)}
+ALIGNED['Q'] = ALIGNED['R'] | ALIGNED['B']
+
+KNIGHT_STEPS = [(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)]
+KING_STEPS = bitboards.ROOK_DIRECTIONS + bitboards.BISHOP_DIRECTIONS
+# (drow, dcol, distance) of every move of a piece type
+STEPS = {'K': [(dr, dc, 1) for dr, dc in KING_STEPS],
+         'N': [(dr, dc, 1) for dr, dc in KNIGHT_STEPS],
+         'R': [(dr, dc, k) for dr, dc in bitboards.ROOK_DIRECTIONS for k in range(1, 8)],
+         'B': [(dr, dc, k) for dr, dc in bitboards.BISHOP_DIRECTIONS for k in range(1, 8)],
+         'Q': [(dr, dc, k) for dr, dc in KING_STEPS for k in range(1, 8)]}
+
+def shifted(dr, dc, k):
+    row, col = ROWS + dr * k, COLS + dc * k
+    return np.where((row >= 0) & (row < 8) & (col >= 0) & (col < 8), row * 8 + col, -1)
+
+TARGETS = {(dr, dc, k): shifted(dr, dc, k) for type in STEPS for dr, dc, k in STEPS[type]}
+TARGETS.update({(dr, dc, 1): shifted(dr, dc, 1) for dr in (1, 2, -1, -2) for dc in (-1, 0, 1)})
+
+
+def ending(white, black):
+    """(name, swapped) of the table holding positions with these pieces (letters, kings included),
+    swapped if the table has them with the colours the other way round."""
+    white = 'K' + ''.join(sorted(white.replace('K', ''), key = ORDER.index))
+    black = 'K' + ''.join(sorted(black.replace('K', ''), key = ORDER.index))
+    def strength(side):
+        return sum(VALUES[type] for type in side), len(side), [-ORDER.index(type) for type in side]
+    if strength(black) > strength(white):
+        return black + white, True
+    return white + black, False
+
+def sides(name):
+    split = name.index('K', 1)
+    return name[:split], name[split:]
+
+def dependencies(name):
+    """Names of the tables the captures and promotions of name lead to."""
+    white, black = sides(name)
+    names = set()
+    for side, other, color in ((white, black, 1), (black, white, -1)):
+        for i, type in enumerate(side):
+            if type == 'K':
+                continue
+            rest = side[:i] + side[i + 1:]
+            names.add(ending(*((rest, other) if color == 1 else (other, rest)))[0])
+            if type == 'P':
+                for promote in 'QRBN':
+                    names.add(ending(*((rest + promote, other) if color == 1 else (other, rest + promote)))[0])
+    names.discard('KK')
+    return names
+
+
+class Ending:
+    """Pieces and index of one table: white king, black king, other white pieces, other black pieces."""
+    def __init__(self, name):
+        white, black = sides(name)
+        self.name = name
+        self.pieces = [('K', 1), ('K', -1)] + [(type, 1) for type in white[1:]] + [(type, -1) for type in black[1:]]
+        self.pawns = 'P' in name
+        self.slots = np.array([sq for sq in range(64) if COLS[sq] < 4 and (self.pawns or ROWS[sq] < 4)])
+        self.slotindex = np.full(64, -1)
+        self.slotindex[self.slots] = np.arange(len(self.slots))
+        self.shape = (2, len(self.slots)) + (64,) * (len(self.pieces) - 1)
+        self.size = int(np.prod(self.shape))
+
+    def encode(self, stm, squares):
+        """Index of the positions with stm (0 white to move, 1 black) and the squares of self.pieces, mirrored as needed."""
+        flip = np.where(COLS[squares[0]] > 3, 7, 0)
+        if not self.pawns:
+            flip |= np.where(ROWS[squares[0]] > 3, 56, 0)
+        index = stm * len(self.slots) + self.slotindex[squares[0] ^ flip]
+        for sq in squares[1:]:
+            index = index * 64 + (sq ^ flip)
+        return index
+
+    def decode(self, index):
+        stm, slot, *squares = np.unravel_index(index, self.shape)
+        return stm, [self.slots[slot]] + list(squares)
+
+
+def attacks(type, color, origin, target, blockers):
+    """Whether a type piece of color on origin attacks target, blockers being the squares of the other pieces."""
+    if type in LEAPS:
+        return LEAPS[type][origin, target]
+    if type == 'P':
+        return PAWN_CAPTURES[color][origin, target]
+    hit = ALIGNED[type][origin, target]
+    for sq in blockers:
+        hit &= ~BETWEEN[origin, target, sq]
+    return hit
+
+def attacked(pieces, squares, color, target, captured = None):
+    """Whether target is attacked by a piece of color, skipping the piece indices in captured (-1 for none)."""
+    hit = np.zeros(len(target), dtype = bool)
+    for i, (type, c) in enumerate(pieces):
+        if c == color:
+            attack = attacks(type, c, squares[i], target, [sq for j, sq in enumerate(squares) if j != i])
+            hit |= attack if captured is None else attack & (captured != i)
+    return hit
+
+def positionlegal(end, stm, squares):
+    """Distinct squares, no pawn on the first or last rank, the side that just moved not in check."""
+    legal = np.ones(len(squares[0]), dtype = bool)
+    for i in range(len(squares)):
+        for j in range(i):
+            legal &= squares[i] != squares[j]
+        if end.pieces[i][0] == 'P':
+            legal &= (ROWS[squares[i]] > 0) & (ROWS[squares[i]] < 7)
+    color = 1 - 2 * stm
+    king = squares[1 if color == 1 else 0]
+    return legal & ~attacked(end.pieces, squares, color, king)
+
+
+tables = {} # (directory, name): (Ending, wdl, dtm)
+
+def table(name, directory = DIRECTORY):
+    if (directory, name) not in tables:
+        path = os.path.join(directory, name)
+        tables[directory, name] = (Ending(name), np.load(path + '.wdl.npy', mmap_mode = 'r'), np.load(path + '.dtm.npy', mmap_mode = 'r'))
+    return tables[directory, name]
+
+def lookup(stm, pieces, directory = DIRECTORY):
+    """(wdl, dtm) arrays for positions with stm (0 white to move, 1 black) and pieces [(type, color, squares)],
+    from whichever table holds them. Raises FileNotFoundError if it was not generated."""
+    name, swapped = ending(''.join(type for type, color, _ in pieces if color == 1), ''.join(type for type, color, _ in pieces if color == -1))
+    if name == 'KK':
+        zeros = np.zeros(len(pieces[0][2]), dtype = np.int8)
+        return zeros, zeros.astype(np.int16)
+    end, wdl, dtm = table(name, directory)
+    if swapped:
+        pieces = [(type, -color, sq ^ 56) for type, color, sq in pieces]
+        stm = 1 - stm
+    remaining = list(pieces)
+    squares = []
+    for type, color in end.pieces:
+        for k, (t, c, sq) in enumerate(remaining):
+            if t == type and c == color:
+                squares.append(sq)
+                del remaining[k]
+                break
+    index = end.encode(stm, squares)
+    return wdl[index], dtm[index]
+
+
+def firstpass(name, directory, start, stop):
+    """For positions start..stop (all with the same side to move): whether they are legal, how many of their
+    moves stay in the ending, and what their captures and promotions lead to. Returns (legal, counter, mate,
+    winat, lossat): the plies of the fastest win by conversion, and of the slowest conversion loss."""
+    end = Ending(name)
+    pieces = end.pieces
+    index = np.arange(start, stop)
+    stm, squares = end.decode(index)
+    stm = int(stm[0])
+    mover = 1 - 2 * stm
+    king = 0 if mover == 1 else 1
+    legal = positionlegal(end, stm, squares)
+
+    counter = np.zeros(len(index), dtype = np.int16)
+    winat = np.zeros(len(index), dtype = np.int16)
+    lossat = np.zeros(len(index), dtype = np.int16)
+    draw = np.zeros(len(index), dtype = bool)
+
+    def play(i, target, valid, promotes):
+        # valid: the move is pseudo-legal up to the occupation of target
+        valid = valid & legal
+        target = np.where(valid, target, squares[i])
+        captured = np.full(len(index), -1)
+        for j, (type, color) in enumerate(pieces):
+            if j != i:
+                same = squares[j] == target
+                if color == mover or j == 1 - king:
+                    valid &= ~same
+                else:
+                    captured[same] = j
+        after = list(squares)
+        after[i] = target
+        valid &= ~attacked(pieces, after, -mover, after[king], captured)
+        for promote in promotes:
+            inside = valid & (captured < 0) & (promote is None)
+            counter[inside] += 1
+            for j in ([-1] if promote is not None else []) + [j for j in range(len(pieces)) if pieces[j][1] != mover]:
+                rows = np.flatnonzero(valid & (captured == j))
+                if len(rows) == 0:
+                    continue
+                result = [(promote if k == i and promote else type, color, after[k][rows]) for k, (type, color) in enumerate(pieces) if k != j]
+                wdl, dtm = lookup(1 - stm, result, directory)
+                dtm = dtm.astype(np.int16) + 1
+                wins = rows[wdl == -1]
+                winat[wins] = np.where(winat[wins] > 0, np.minimum(winat[wins], dtm[wdl == -1]), dtm[wdl == -1])
+                draw[rows[wdl == 0]] = True
+                losses = rows[wdl == 1]
+                lossat[losses] = np.maximum(lossat[losses], dtm[wdl == 1])
+
+    for i, (type, color) in enumerate(pieces):
+        if color != mover:
+            continue
+        sq = squares[i]
+        if type == 'P':
+            last = 7 if mover == 1 else 0
+            one = TARGETS[mover, 0, 1][sq]
+            empty = np.ones(len(index), dtype = bool)
+            for j in range(len(pieces)):
+                empty &= squares[j] != one
+            promotes = ['Q', 'R', 'B', 'N']
+            play(i, one, empty & (ROWS[one] != last), [None])
+            play(i, one, empty & (ROWS[one] == last), promotes)
+            two = TARGETS[2 * mover, 0, 1][sq]
+            start = (ROWS[sq] == (1 if mover == 1 else 6)) & empty
+            for j in range(len(pieces)):
+                start &= squares[j] != two
+            play(i, two, start, [None])
+            for dc in (-1, 1):
+                target = TARGETS[mover, dc, 1][sq]
+                enemy = np.zeros(len(index), dtype = bool)
+                for j, (t, c) in enumerate(pieces):
+                    if c != mover:
+                        enemy |= squares[j] == target
+                enemy &= target >= 0
+                play(i, target, enemy & (ROWS[target] != last), [None])
+                play(i, target, enemy & (ROWS[target] == last), promotes)
+            continue
+        for dr, dc, k in STEPS[type]:
+            target = TARGETS[dr, dc, k][sq]
+            valid = target >= 0
+            if k > 1:
+                clipped = np.where(valid, target, sq)
+                for j in range(len(pieces)):
+                    if j != i:
+                        valid &= ~BETWEEN[sq, clipped, squares[j]]
+            play(i, target, valid, [None])
+
+    incheck = attacked(pieces, squares, -mover, squares[king])
+    mate = legal & (counter == 0) & (winat == 0) & ~draw & (lossat == 0) & incheck
+    counter[(winat > 0) | draw] += 1000 # a way out: never a loss
+    return legal, counter, mate, winat, lossat
+
+
+def unmoves(end, index):
+    """Indices of the positions with a move (staying in the ending) to the positions index."""
+    predecessors = []
+    half = end.size // 2
+    for side in (0, 1):
+        positions = index[(index >= half) == bool(side)]
+        if len(positions) == 0:
+            continue
+        stm, squares = end.decode(positions)
+        mover = -(1 - 2 * side)
+        for i, (type, color) in enumerate(end.pieces):
+            if color != mover:
+                continue
+            sq = squares[i]
+            if type == 'P':
+                origins = [(TARGETS[-mover, 0, 1][sq], None), (TARGETS[-2 * mover, 0, 1][sq], TARGETS[-mover, 0, 1][sq])]
+                steps = []
+                for origin, via in origins:
+                    valid = (origin >= 0) & (ROWS[np.maximum(origin, 0)] > 0) & (ROWS[np.maximum(origin, 0)] < 7)
+                    if via is not None:
+                        valid &= ROWS[sq] == (3 if mover == 1 else 4)
+                    steps.append((origin, valid, via))
+            else:
+                steps = []
+                for dr, dc, k in STEPS[type]:
+                    origin = TARGETS[-dr, -dc, k][sq]
+                    valid = origin >= 0
+                    if k > 1:
+                        clipped = np.where(valid, origin, sq)
+                        for j in range(len(squares)):
+                            if j != i:
+                                valid &= ~BETWEEN[clipped, sq, squares[j]]
+                    steps.append((origin, valid, None))
+            for origin, valid, via in steps:
+                origin = np.where(valid, origin, 0)
+                for j in range(len(squares)):
+                    if j != i:
+                        valid &= squares[j] != origin
+                        if via is not None:
+                            valid &= squares[j] != via
+                rows = np.flatnonzero(valid)
+                before = [s[rows] for s in squares]
+                before[i] = origin[rows]
+                predecessors.append(end.encode(1 - side, before))
+    return np.concatenate(predecessors) if predecessors else np.zeros(0, dtype = np.int64)
+
+
+def generate(name, directory = DIRECTORY, workers = None, log = print):
+    """Builds the table of name (its dependencies must exist already) and saves it in directory."""
+    end = Ending(name)
+    size = end.size
+    half = size // 2
+    start = time.perf_counter()
+
+    legal = np.zeros(size, dtype = bool)
+    counter = np.zeros(size, dtype = np.int16)
+    wdl = np.zeros(size, dtype = np.int8)
+    dtm = np.zeros(size, dtype = np.int16) # the slowest conversion loss until decided
+    wins, losses = {}, {} # ply: index arrays of candidates
+
+    def bucket(buckets, ply, positions):
+        if len(positions):
+            buckets.setdefault(int(ply), []).append(positions)
+
+    # a chunk never mixes white and black to move
+    chunks = [(low, min(low + CHUNK, stop)) for first, stop in ((0, half), (half, size)) for low in range(first, stop, CHUNK)]
+    if workers == 0 or (workers or os.cpu_count() or 1) == 1:
+        results = (firstpass(name, directory, low, high) for low, high in chunks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(workers)
+        results = pool.map(firstpass, *zip(*[(name, directory, low, high) for low, high in chunks]))
+    for (low, high), (chunklegal, chunkcounter, mate, winat, lossat) in zip(chunks, results):
+        legal[low:high] = chunklegal
+        counter[low:high] = chunkcounter
+        dtm[low:high] = lossat
+        positions = np.arange(low, high)
+        bucket(losses, 0, positions[mate])
+        for ply in np.unique(winat[winat > 0]):
+            bucket(wins, ply, positions[winat == ply])
+        stuck = chunklegal & (chunkcounter == 0) & (lossat > 0)
+        for ply in np.unique(lossat[stuck]):
+            bucket(losses, ply, positions[stuck & (lossat == ply)])
+    if pool is not None:
+        pool.shutdown()
+
+    ply = 0
+    while wins or losses:
+        won = np.unique(np.concatenate(wins.pop(ply, [np.zeros(0, dtype = np.int64)])))
+        won = won[wdl[won] == 0]
+        wdl[won], dtm[won] = 1, ply
+        lost = np.unique(np.concatenate(losses.pop(ply, [np.zeros(0, dtype = np.int64)])))
+        lost = lost[wdl[lost] == 0]
+        wdl[lost], dtm[lost] = -1, ply
+
+        if len(lost):
+            before = unmoves(end, lost)
+            bucket(wins, ply + 1, before[legal[before] & (wdl[before] == 0)])
+        if len(won):
+            before, count = np.unique(unmoves(end, won), return_counts = True)
+            counter[before] -= count.astype(np.int16)
+            before = before[(counter[before] == 0) & (wdl[before] == 0) & legal[before]]
+            after = np.maximum(ply + 1, dtm[before])
+            for at in np.unique(after):
+                bucket(losses, at, before[after == at])
+        ply += 1
+
+    dtm[wdl == 0] = 0
+    os.makedirs(directory, exist_ok = True)
+    path = os.path.join(directory, name)
+    np.save(path + '.wdl.npy', wdl)
+    np.save(path + '.dtm.npy', dtm)
+    tables.pop((directory, name), None)
+    if log:
+        log('{}: {} positions, {} legal, {} won, {} lost, longest mate {} plies, {:.1f}s'.format(
+            name, size, int(legal.sum()), int((wdl == 1).sum()), int((wdl == -1).sum()), int(dtm.max()), time.perf_counter() - start))
+
+def generateall(names, directory = DIRECTORY, workers = None, force = False, log = print):
+    """Generates names and the tables they depend on, smallest first, skipping the ones already there unless force."""
+    done = set()
+    def visit(name):
+        if name in done:
+            return
+        done.add(name)
+        for dependency in sorted(dependencies(name)):
+            visit(dependency)
+        if force or not os.path.exists(os.path.join(directory, name + '.dtm.npy')):
+            generate(name, directory, workers, log)
+    for name in names:
+        white, black = sides(name)
+        visit(ending(white, black)[0])
+
+
+def probe(game, directory = DIRECTORY):
+    """(wdl, dtm) of the position of game for the side to move, or None when no table holds it
+    (more than 4 pieces, castling rights, an en passant capture, or a table that was not generated)."""
+    squares = compactboard.CompactPosition.from_game(game).squares
+    occupied = np.flatnonzero(squares)
+    if len(occupied) > 4 or game.castlingrights() or game.enpassantkey():
+        return None
+    pieces = [(compactboard.LETTERS[abs(squares[sq])], 1 if squares[sq] > 0 else -1, np.array([sq])) for sq in occupied]
+    try:
+        wdl, dtm = lookup(0 if game.turn == 1 else 1, pieces, directory)
+    except FileNotFoundError:
+        return None
+    return int(wdl[0]), int(dtm[0])
+
+def bestmove(game, directory = DIRECTORY):
+    """(move, wdl, dtm) of the perfect move of game, winning fastest or losing slowest, or None outside the tables."""
+    game.all_moves()
+    best = None
+    for move in game.legal_moves():
+        game.push(move)
+        result = probe(game, directory)
+        game.pop()
+        if result is None:
+            best = None
+            break
+        wdl, dtm = -result[0], result[1] + 1
+        score = (wdl, -dtm if wdl > 0 else dtm)
+        if best is None or score > best[0]:
+            best = (score, move, wdl, dtm)
+    game.all_moves()
+    return best[1:] if best else None
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Generate endgame tablebases by retrograde analysis.')
+    parser.add_argument('endings', nargs = '+', help = 'like KQK, KRK, KPK, KBNK, KRKP')
+    parser.add_argument('--out', default = DIRECTORY, help = 'directory of the tables')
+    parser.add_argument('--workers', type = int, help = 'processes for the first pass, defaults to the number of cores, 0 to stay in process')
+    parser.add_argument('--force', action = 'store_true', help = 'generate again the tables already there')
+    args = parser.parse_args(argv)
+
+    for name in args.endings:
+        if not name.startswith('K') or name.count('K') != 2 or set(name) - set(ORDER) or len(name) > 4:
+            parser.error('not an ending of up to 4 pieces: ' + name)
+    generateall(args.endings, args.out, args.workers, args.force)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())